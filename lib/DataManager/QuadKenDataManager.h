@@ -19,11 +19,15 @@
 
 namespace Quadken {
 
+// 複数のDataManagerをまとめたデータの識別子（[件数][識別子...][データ...]）
+constexpr uint8_t BATCH_IDENTIFIER = 0xFC;
+
 // シンプルな基底クラス
 class DataManagerBase {
 public:
     virtual ~DataManagerBase() = default;
     virtual void unpack(const std::vector<uint8_t>& buffer) = 0;
+    virtual void unpackFrom(const uint8_t* data) = 0;
     virtual std::vector<uint8_t> pack() const = 0;
     virtual size_t getExpectedSize() const = 0;
     virtual size_t getElementSize() const = 0;
@@ -44,6 +48,38 @@ public:
         // identifierで見つけたインスタンスにデータを直接設定
         instance->unpack(buffer);
     }
+
+    // まとめたデータ（[件数][識別子...][データ...]）を1回でunpackする
+    // データの長さは識別子から決まる。全体の長さを確認してから書き込むので、途中までの更新はない
+    // 戻り値はunpackした識別子のリスト
+    static std::vector<uint8_t> unpackBatch(const std::vector<uint8_t>& buffer) {
+        if (buffer.empty() || buffer.size() < 1u + buffer[0]) {
+            THROW_INVALID_ARGUMENT("Batch header too short");
+        }
+        const size_t count = buffer[0];
+        auto& global_instances = getGlobalInstances();
+        std::vector<uint8_t> identifiers(buffer.begin() + 1, buffer.begin() + 1 + count);
+        std::vector<DataManagerBase*> instances(count);
+        size_t total = 1 + count;
+        for (size_t i = 0; i < count; i++) {
+            auto it = global_instances.find(identifiers[i]);
+            if (it == global_instances.end()) {
+                THROW_RUNTIME_ERROR("No instance found for identifier in batch");
+            }
+            instances[i] = it->second;
+            total += it->second->getExpectedSize();
+        }
+        if (buffer.size() != total) {
+            THROW_INVALID_ARGUMENT("Batch size mismatch");
+        }
+
+        size_t offset = 1 + count;
+        for (size_t i = 0; i < count; i++) {
+            instances[i]->unpackFrom(buffer.data() + offset);
+            offset += instances[i]->getExpectedSize();
+        }
+        return identifiers;
+    }
     
 protected:
     static std::map<uint8_t, DataManagerBase*>& getGlobalInstances() {
@@ -101,6 +137,11 @@ public:
         std::memcpy(data_.data(), buffer.data(), buffer.size());
     }
 
+    // 長さ確認済みのデータを直接コピーする（unpackBatch用）
+    void unpackFrom(const uint8_t* data) override {
+        std::memcpy(data_.data(), data, length_ * sizeof(T));
+    }
+
     size_t getExpectedSize() const override {
         return length_ * sizeof(T);
     }
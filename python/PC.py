@@ -5,10 +5,13 @@ import yaml
 import math
 # from simple_pid import PID
 # import matplotlib.pyplot as plt
-from tools.tcp import create_tcp
-from tools.data_manager import DataManager , DataType
+from tools.tcp import create_tcp, Reconnector
+from tools.data_manager import DataManager , ChangeTracker, BATCH_IDENTIFIER
+from tools.protocol import Protocol
 from tools.controller import Controller , Button
 from tools.calc import Calc
+from tools.log import get_logger
+from tools.telemetry import Telemetry, TELEMETRY_IDENTIFIER
 
 
 # 設定ファイルの読み込み
@@ -26,22 +29,39 @@ PORT = 5000
 
 tcp = create_tcp(HOST, PORT)
 
+# 制御ループごとの出力はカテゴリごとに件数を制限する（config.yamlのlog）
+bno_log = get_logger('bno')
+servo_log = get_logger('servo')
+telemetry_log = get_logger('telemetry')
+
 legs_servo_num = [6,7,8,11]
 bno_camera_offset = -130
 # bno_legs_offset = 45
 # bno_tank_offset = 0
 
 
-# ESP1用サーボデータ（4個）とESP2用サーボデータ（12個）
-batt_servo_data = DataManager(0x11, 4, DataType.UINT8)  # ESP1用サーボ（4個）- 識別子0x11
-legs_servo_data = DataManager(0x12, 12, DataType.UINT8)  # ESP2用サーボ（12個）- 識別子0x12
+# データ管理インスタンスの作成（識別子・長さはprotocol.yamlで定義）
+# 12要素以下のベクトルではNumPyの呼び出しのほうが遅いため、リストのDataManagerを使う（test/array_data_manager.py）
+protocol = Protocol()
+messages = protocol.build()
+batt_servo_data = messages['batt_servo']  # ESP1用サーボ（4個）- 識別子0x11
+legs_servo_data = messages['legs_servo']  # ESP2用サーボ（12個）- 識別子0x12
+
+bldc_data = messages['bldc']
+bno_data = messages['bno']
+config = messages['config']
+
+class UserExit(Exception):
+    """ユーザーの操作による終了（再接続しない）"""
 
-bldc_data = DataManager(0x02, 2, DataType.INT8)
-bno_data = DataManager(0x03, 3, DataType.INT8)
-config = DataManager(0xFF, 1, DataType.UINT8)
 
 # config.yamlからmain_intervalを読み込み
 main_interval = config_data.get('main', {}).get('interval', 0.1)
+# これより古いBNOの角度では右スティックの向きを計算しない（秒）
+bno_max_age = config_data.get('main', {}).get('bno_max_age', 0.5)
+rtt_report_ticks = 50  # RTTを表示する間隔（メインループの回数）
+# 制御データは変化したときと、keepalive秒ごとにだけ送る
+control_tracker = ChangeTracker(config_data.get('main', {}).get('keepalive', 1.0))
 
 def batt_servo_control(twist,l1,num):
     batt_servo_values = batt_servo_data.get()  # デフォルト位置で初期化
@@ -93,12 +113,19 @@ def batt_servo_control(twist,l1,num):
     batt_servo_data.update(batt_servo_values)
 
 async def main():
-    bno = bno_data.get()
-    theta, phi, bno_twist = bno[0], bno[1]*3, bno[2]*2
-    twist = bno_twist - bno_camera_offset
-    twist = twist if twist <= 180 else twist - 360  # ヘディングを-180〜180に変換
-    twist = -twist
-    print(f"θ: {theta}° φ: {phi}° twist: {twist}°")
+    bno = bno_data.get_if_fresh(bno_max_age)
+    if bno is None:
+        # 角度が届いていない（古い）間は、古いヘディングで右スティックの向きを決めない
+        age = bno_data.age()
+        twist = None
+        bno_log.warning("⚠️ BNOの角度が古いため右スティックの操作を止めています（%s）",
+                        '未受信' if age is None else f'{age:.1f}秒前')
+    else:
+        theta, phi, bno_twist = bno[0], bno[1]*3, bno[2]*2
+        twist = bno_twist - bno_camera_offset
+        twist = twist if twist <= 180 else twist - 360  # ヘディングを-180〜180に変換
+        twist = -twist
+        bno_log.info("θ: %s° φ: %s° twist: %s°", theta, phi, twist)
 
     # L1,R1押し込み状態を取得
     l1_pressed = controller.is_button_pressed(Button.L1)
@@ -119,7 +146,7 @@ async def main():
         await tcp.send(config.identifier(), config.pack())
         return
     if controller.pushed_button(Button.SELECT):  # SELECTボタン
-        raise EOFError("ユーザーがSelectボタンで終了")  # 明示的に終了を伝える
+        raise UserExit("ユーザーがSelectボタンで終了")  # 明示的に終了を伝える
 
 
 
@@ -139,7 +166,7 @@ async def main():
             legs_servo_values[i] = max(0, min(180, int(90 + left_angle * 0.5)))  # 角度に基づくサーボ制御
 
 
-    if right_magnitude > 0.2:  # 右スティックが動いている場合
+    if right_magnitude > 0.2 and twist is not None:  # 右スティックが動いている場合（角度が新しいときのみ）
         # controller_angle = right_angle - twist
         # ver_power = math.sin(math.radians(controller_angle)) * 180 * right_magnitude
         # hor_power = math.cos(math.radians(controller_angle)) * 180 * right_magnitude
@@ -186,7 +213,7 @@ async def main():
 
     bldc_values = [bldc_speed, bldc_speed]  # 2つのBLDCモーター用
     
-    print(f"{legs_servo_values}")
+    servo_log.info("%s", legs_servo_values)
 
     # データを更新
     legs_servo_data.update(legs_servo_values)
@@ -194,64 +221,122 @@ async def main():
     bldc_data.update(bldc_values)
     
     
-    await asyncio.gather(
-        tcp.send(batt_servo_data.identifier(), batt_servo_data.pack()),  # ESP1（4個のサーボ）
-        tcp.send(legs_servo_data.identifier(), legs_servo_data.pack()),  # ESP2（12個のサーボ）
-        tcp.send(bldc_data.identifier(), bldc_data.pack())
-    )
+    # 変化したデータ（またはkeepalive経過分）だけを送る。複数あれば1つのフレームにまとめる
+    due = control_tracker.due([
+        batt_servo_data,  # ESP1（4個のサーボ）
+        legs_servo_data,  # ESP2（12個のサーボ）
+        bldc_data,
+    ])
+    if len(due) > 1:
+        await tcp.send(BATCH_IDENTIFIER, DataManager.pack_batch(due))
+    elif due:
+        await tcp.send(due[0].identifier(), due[0].pack())
+
+
+def handle_image(identifier, data):
+    # 画像データ（受信バッファのmemoryviewをそのままデコード）
+    img_array = np.frombuffer(data, dtype=np.uint8)
+    frame = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
+    
+    if frame is not None:
+        cv2.imshow('Async TCP Stream', frame)
+        cv2.waitKey(1)
 
+def handle_data(identifier, data):
+    # 受信バッファから直接コピーする（リストは必要なときにget()で作られる）
+    bno_data.unpack_from(data)
+
+def handle_telemetry(identifier, data):
+    # ESPからの通知をRaspが集計したフレーム（最新の値は各DataManagerにも入る）
+    try:
+        values = Telemetry.unpack(protocol, data)
+    except ValueError as e:
+        telemetry_log.warning("⚠️ テレメトリ: %s", e)
+        return
+    for name, value in values.items():
+        telemetry_log.info("📨 %s: %d件 最新 %s 最小 %s 最大 %s 平均 %s", name, value['samples'],
+                           value['latest'], value['min'], value['max'], value['mean'])
+
+def format_rtt(stats):
+    # RTTの統計を表示用の文字列にする
+    if stats['srtt'] is None:
+        return "RTT 未計測"
+    return (f"RTT 平均 {stats['srtt'] * 1000:.1f}ms p50 {stats['p50'] * 1000:.1f}ms "
+            f"p99 {stats['p99'] * 1000:.1f}ms")
+
+def handle_link(session, degraded):
+    # pongが届かなくなったら通信劣化として知らせる
+    if degraded:
+        print(f"⚠️ 通信劣化: pongが届いていません（{format_rtt(session.heartbeat.stats())}）")
+    else:
+        print(f"✅ 通信回復: {format_rtt(session.heartbeat.stats())}")
+
+# 画像とBNO・テレメトリのフレームは受信コールバック内でまとめて処理する
+tcp.on(0x00, handle_image)
+tcp.on(bno_data.identifier(), handle_data)
+tcp.on(TELEMETRY_IDENTIFIER, handle_telemetry)
+tcp.on_link_change(handle_link)
 
 async def Hreceive_Rasp():
-    while True:
-        data_type, size, data = await tcp.receive()
-
-        if data_type == 0x00:  # 画像データ
-            img_array = np.frombuffer(data, dtype=np.uint8)
-            frame = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-            
-            if frame is not None:
-                cv2.imshow('Async TCP Stream', frame)
-                cv2.waitKey(1)
-            continue
-            
+    async for data_type, size, data in tcp.frames():
         received_data = DataManager.unpack(data_type, data)
         # print(f"📥 受信 : {received_data}")
+    raise EOFError("接続が切断されました。")
 
-async def tcp_client():
-    print("🔵 接続中...")
-    try:
-        host , port = await tcp.connect()
-    except ConnectionRefusedError as e:
-        print(f"🚫 接続エラー: ラズパイのプログラムを起動してない可能性あり")
-        print(f"⚠️ 詳細: {e}")
-        return
-
-    print(f"🔗 接続: {host}:{port}")
+def control_snapshot():
+    # 再接続後に送り直す最後の制御データ（サーボ・BLDC）
+    return [
+        (batt_servo_data.identifier(), batt_servo_data.pack()),
+        (legs_servo_data.identifier(), legs_servo_data.pack()),
+        (bldc_data.identifier(), bldc_data.pack()),
+    ]
 
-    receive_task = asyncio.create_task(Hreceive_Rasp())
+# 接続が切れてもコントローラーとDataManagerの状態を保ったまま再接続する
+link = Reconnector(tcp, snapshot=control_snapshot)
 
+async def tcp_client():
     try:
         while True:
-            # main()とsleepを分離して並行実行
-            await asyncio.gather(
-                main(),
-                asyncio.sleep(main_interval)
-            )
-            if receive_task.done():
-                if receive_task.exception():
-                    raise receive_task.exception()
-
-    except (asyncio.IncompleteReadError , EOFError):
-        print("🔴 Raspberry Pi側から接続が終了されました")
-    except (ConnectionResetError, OSError) as e:
-        print("🔌 接続がリセットされました、またはネットワークが利用不可になりました。")
-        print(f"⚠️ 詳細: {e}")    
+            print("🔵 接続中...")
+            host , port = await link.connect()
+            print(f"🔗 接続: {host}:{port} ({tcp.address})")
+
+            receive_task = asyncio.create_task(Hreceive_Rasp())
+
+            try:
+                tick = 0
+                while True:
+                    # main()とsleepを分離して並行実行
+                    await asyncio.gather(
+                        main(),
+                        asyncio.sleep(main_interval)
+                    )
+                    tick += 1
+                    if tcp.heartbeat and tick % rtt_report_ticks == 0:
+                        print(f"📶 {format_rtt(tcp.heartbeat.stats())}")
+                    if receive_task.done():
+                        if receive_task.exception():
+                            raise receive_task.exception()
+
+            except (asyncio.IncompleteReadError , EOFError):
+                print("🔴 Raspberry Pi側から接続が終了されました。再接続します")
+            except (ConnectionResetError, OSError) as e:
+                print("🔌 接続がリセットされました、またはネットワークが利用不可になりました。再接続します")
+                print(f"⚠️ 詳細: {e}")
+            finally:
+                receive_task.cancel()
+                await asyncio.gather(receive_task, return_exceptions=True)
+
+    except UserExit as e:
+        print(f"🛑 {e}")
     finally:
         print("🧹 切断処理中...")
-        receive_task.cancel()
-        await asyncio.gather(receive_task, return_exceptions=True)
         await tcp.close()
+        if tcp.recorder:
+            tcp.recorder.close()  # 記録待ちのフレームを書き込む
+            print(f"📼 記録: {tcp.recorder}")
         cv2.destroyAllWindows()
+        print(f"📊 {link.stats()}")
         print("✅ 終了しました")
 
 asyncio.run(tcp_client())
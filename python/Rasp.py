@@ -1,15 +1,46 @@
 import asyncio
-from tools.tcp import Tcp
-from tools.data_manager import DataManager , DataType
-from tools.ble import Ble
+import time
+from tools.tcp import create_tcp, LatestSender
+from tools.data_manager import DataManager, BATCH_IDENTIFIER
+from tools.protocol import Protocol
+from tools.ble import Ble, create_backend
+from tools.ble_mailbox import BleMailbox, BleRelay
+from tools.ble_manager import BleManager, CONNECTED, DISCONNECTED
 from tools.bno import BNOSensor
 from tools.camera import Picam
+from tools.log import get_logger
+from tools.telemetry import Telemetry
 
 main_interval = 0.1  # メインループの実行間隔（秒）
+bno_rate = 100.0     # BNO055の角度を読み取りスレッドで読む回数（1秒あたり）
+bno_max_age = 0.2    # これより古い角度はPCに送らない（読み取りが止まっている, 秒）
 camera_interval = 0.1  # カメラのフレーム取得間隔（秒）
-
-# Hto_ESPが複数同時に実行されないようにするため、やむなく実装
-esp_task = None
+camera_high_water = 128 * 1024  # 未送信がこれを超えたら古いフレームを捨てる（バイト）
+camera_low_water = 32 * 1024    # 未送信がこれを下回ったら送信を再開（バイト）
+camera_report_frames = 100      # 送信統計を表示する間隔（フレーム数）
+ble_keepalive = 1.0  # ESPへ同じデータを送り直す間隔（秒）。これより短い間の同じデータは送らない
+ble_max_age = 0.25   # PCから受け取ってからこれより古いサーボ・BLDCの値はESPへ書き込まない（秒）
+ble_command_max_age = 3.0  # 設定コマンドを書き込む期限（秒）
+esp_setup_timeout = 10.0  # 接続要求からESPが接続して通知を開始するのを待つ時間（過ぎたらセットアップコマンドは送らない, 秒）
+relay_report_interval = 1.0  # 中継した最新の値を表示する間隔（秒, 0で表示しない）
+telemetry_interval = 0.5  # ESPからの通知を集計してPCに送る間隔（秒）
+telemetry_capacity = 1024  # 集計するまで溜めておく通知の数（溢れたら古いものから上書き）
+
+# 周期的な出力はカテゴリごとに件数を制限し、エラーのときは直近のイベントをlogsに書き出す（config.yamlのlog）
+bno_log = get_logger('bno')
+relay_log = get_logger('relay')
+esp_log = get_logger('esp')
+camera_log = get_logger('camera')
+pc_log = get_logger('pc')
+
+# データ管理インスタンスと中継表の作成（識別子・長さ・中継先はprotocol.yamlで定義）
+protocol = Protocol()
+messages = protocol.build()
+esp1_servo_data = messages['batt_servo']  # ESP1用サーボ（4個）- 識別子0x11
+esp2_servo_data = messages['legs_servo']  # ESP2用サーボ（12個）- 識別子0x12
+bldc_data = messages['bldc']
+bno_data = messages['bno']
+config = messages['config']
 
 # ESP32デバイスのMACアドレス一覧（必要に応じて追加）
 devices = [
@@ -18,262 +49,315 @@ devices = [
     # {"num": 2, "address": "08:D1:F9:36:FF:3E" , "char_uuid": "abcd1234-5678-90ab-cdef-123456789002"}, #正方形
     # {"num": 2, "address": "CC:7B:5C:E8:E3:32" , "char_uuid": "abcd1234-5678-90ab-cdef-123456789002"}, #角なし
 ]
-esps = [Ble(device['num'], device['address'], device['char_uuid']) for device in devices]
+# config.yamlのble.backendがsimなら実機の代わりにプロセス内の疑似ESPに接続する（PCだけで中継を試せる）
+ble_backend = create_backend(protocol)
+esps = [Ble(device['num'], device['address'], device['char_uuid'], backend=ble_backend) for device in devices]
+esp_by_num = {esp.num: esp for esp in esps}
 
 HOST = '0.0.0.0'  # 例: '192.168.0.10'
 PORT = 5000
 
-tcp = Tcp(HOST, PORT)
+# サーバーはdebug_modeでも実際に待ち受ける（TcpかUdpTcp）
+tcp = create_tcp(HOST, PORT, server=True)
 
 bno = BNOSensor()  # BNO055センサのインスタンス作成
 
-# データ管理インスタンスの作成
-esp1_servo_data = DataManager(0x11, 4, DataType.UINT8)   # ESP1用サーボ（4個）- 識別子0x11
-esp2_servo_data = DataManager(0x12, 12, DataType.UINT8)  # ESP2用サーボ（12個）- 識別子0x12
-bldc_data = DataManager(0x02, 2, DataType.INT8)
-bno_data = DataManager(0x03, 3, DataType.INT8)
-config = DataManager(0xFF, 1, DataType.UINT8)
+# ESPごとの書き込み待ち（識別子ごとに最新の値だけを残し、書き込みタスクがBLEの速さで送る）
+# 同じ内容の書き込みは省き、まとめたフレームを受け取れるESPには1回の書き込みで送る
+batch_devices = protocol.batch_devices()
+mailboxes = {esp.num: BleMailbox(esp, ble_keepalive, batch=esp.num in batch_devices,
+                                 max_age=ble_max_age, command_max_age=ble_command_max_age) for esp in esps}
+
+# サーボ・BLDCは受信コールバック内で長さだけ確認し、デコードせずにそのままESPへ中継する
+relay = BleRelay(protocol, mailboxes)
+for identifier in relay.identifiers:
+    tcp.on(identifier, relay.forward)
+tcp.on(BATCH_IDENTIFIER, relay.forward_batch)
 
 async def shutdown():
     print("🧹 シャットダウン処理中...")
     
-    # ESP32デバイスとの切断
-    for esp in esps:
-        await esp.disconnect()
-        print(f"❌ 切断: {esp}")
+    # ESP32デバイスとの切断（準備待ち・監視タスクを止めてから切断する）
+    for task in setup_tasks.values():
+        task.cancel()
+    await ble_manager.stop()
+    for num, stats in ble_manager.stats().items():
+        print(f"❌ 切断: ESP32-{num} 接続試行 {stats['attempts']}, 失敗 {stats['failures']}, "
+              f"再接続 {stats['reconnects']}")
     
-    # BNO055センサとの切断
+    # 疑似ESPが受け取った書き込み（ble.backend: sim のとき）
+    if hasattr(ble_backend, 'stats'):
+        for num, stats in ble_backend.stats().items():
+            print(f"📊 疑似ESP32-{num}: {stats}")
+
+    # BNO055センサとの切断（読み取りスレッドを止めてから切断する）
+    bno.stop_sampler()
+    stats = bno.stats()
+    rate = f"{stats['achieved_rate']:.0f}" if stats['achieved_rate'] is not None else "-"
+    read = f"{stats['read_p99'] * 1000:.1f}ms" if stats['read_p99'] is not None else "-"
+    print(f"📊 BNO055: {stats['samples']}サンプル ({rate}/{stats['rate']:.0f}回/秒), I2C読み取りp99 {read}, "
+          f"I2Cエラー {stats['i2c_errors']}, 接続失敗 {stats['connect_failures']}, 間に合わず {stats['overruns']}")
     if bno.is_connected():
         bno.disconnect()
     
+    # PCから受け取った制御データの新しさ（受け取った回数・受け取る間隔の最大値）
+    for name, data in messages.items():
+        stats = data.stats()
+        if stats['sequence']:
+            print(f"📊 {name}: {stats['sequence']}回, 最大間隔 {stats['max_gap'] * 1000:.0f}ms, "
+                  f"最後に受け取ってから {stats['age']:.1f}秒")
+
+    # ESPごとの書き込み待ちの統計（まとめた数・書き込み時間）
+    print(f"📊 中継: {relay.stats()}")
+    for num, mailbox in mailboxes.items():
+        stats = mailbox.stats()
+        latency = f"{stats['latency_p99'] * 1000:.1f}ms" if stats['latency_p99'] is not None else "-"
+        print(f"📊 ESP32-{num}: 書き込み {stats['written']}/{stats['put']}, まとめ {stats['coalesced']}, "
+              f"同じ内容 {stats['unchanged']}, 期限切れ {stats['expired']}, 失敗 {stats['errors']}, "
+              f"最大待ち {stats['max_depth']}, 遅延p99 {latency}")
+        stats = esp_by_num[num].stats()
+        write = f"{stats['write_p99'] * 1000:.1f}ms" if stats['write_p99'] is not None else "-"
+        print(f"📊 ESP32-{num}: {stats['writes']}回 {stats['bytes']}バイト ({stats['writes_per_s']:.0f}回/秒), "
+              f"再試行 {stats['retried']}, 失敗 {stats['failures']}, 電波 {stats['airtime'] * 1000:.1f}ms, "
+              f"書き込みp99 {write}")
+
+    # ESPからの通知の集計（上書き・不正な通知の数、PCに送ったフレーム）
+    stats = telemetry.stats()
+    print(f"📊 テレメトリ: 通知 {stats['received']}, 上書き {stats['overwritten']}, 不正 {stats['invalid']}, "
+          f"送信 {stats['frames']}フレーム {stats['bytes']}バイト")
+
+    # フレーム形式とシーケンス番号から数えた欠落・入れ替わり
+    for session in tcp.sessions:
+        stats = session.protocol.framing_stats()
+        print(f"📊 {session}: v{stats['receive_version']}, {stats['received']}フレーム, "
+              f"欠落 {stats['lost']} ({stats['gaps']}回), 入れ替わり {stats['reordered']}")
+
     # TCP接続の切断
     await tcp.close()
+    if tcp.recorder:
+        tcp.recorder.close()  # 記録待ちのフレームを書き込む
+        print(f"📼 記録: {tcp.recorder}")
     print("✅ シャットダウン完了")
     exit(0)
 
-async def ensure_bno_connection():
-    """BNO055センサーの接続を確保する（再接続機能付き）"""
-    if not bno.is_connected():
-        try:
-            print("🔄 BNO055センサーに接続中...")
-            bno.connect()
-            print("✅ BNO055センサー接続成功")
-            return True
-        except Exception as e:
-            print(f"⚠️ BNO055センサー接続失敗: {e}")
-            return False
-    return True
-
 async def main():
-    # BNO055センサの接続確保（再接続機能付き）
-    if not await ensure_bno_connection():
+    # BNO055の角度は読み取りスレッドがI2Cから読むので、ここでは最新のサンプルを見るだけ（イベントループは止まらない）
+    sample = bno.latest()
+    if sample is None:
         return
+    _, sampled_at, (phi, theta, twist) = sample
+    if time.monotonic() - sampled_at > bno_max_age:
+        bno_log.warning("⚠️ BNO055の角度が古いため送りません (%.1f秒前)", time.monotonic() - sampled_at)
+        return
+    bno_log.info("θ: %s° φ: %s° twist: %s°", theta, phi, twist)
 
-    # BNO055センサからの角度情報取得
-    try:
-        bno_euler = bno.euler()  # BNO055センサからの角度情報取得
-        phi, theta, twist = bno_euler
-        print(f"θ: {theta}° φ: {phi}° twist: {twist}°")
-
-        # 角度データの範囲チェックと変換
-        if theta is not None and phi is not None and twist is not None:
-            # ヘディングを-180〜180に変換
-#            if theta > 180:
- #               theta = theta - 360
-
-            # データを-90〜90の範囲に制限してint8に変換
-            theta_scaled = theta
-            phi_scaled = phi//3
-            twist_scaled = twist//2
-
-
-            bno_data.update([theta_scaled, phi_scaled, twist_scaled])
-            # PCにデータを送信
-            await tcp.send(bno_data.identifier(), bno_data.pack())
-            
-    except Exception as e:
-        print(f"❌ BNO055センサーエラー: {e}")
-        # 接続が切れた可能性があるため、次回のループで再接続を試行
-        if "接続が切れています" in str(e) or "接続されていません" in str(e):
-            print("🔄 次回ループで再接続を試行します")
+    # ヘディングを-180〜180に変換
+#    if theta > 180:
+ #       theta = theta - 360
 
+    # データを-90〜90の範囲に制限してint8に変換
+    theta_scaled = theta
+    phi_scaled = phi//3
+    twist_scaled = twist//2
 
-# 通知を受け取ったときのコールバック
-def Hreceive_ESP(device_num , identifier, data):
-    print("おかしい")
-    # # データを更新
-    # received_data = DataManager.unpack(identifier, data)
-    # print(f"📨 受信 from ESP-{device_num}: {received_data}")
+    try:
+        bno_data.update([theta_scaled, phi_scaled, twist_scaled])
+        # PCにデータを送信
+        await tcp.send(bno_data.identifier(), bno_data.pack())
+    except Exception as e:
+        bno_log.error("❌ BNO055の角度を送れません: %s", e)
 
-    # # PCにデータを送信
-    # asyncio.create_task(tcp.send(identifier, data))
 
-async def Hto_ESP():
-    # ESP32との接続
-    while True:
-        try:
-            print("🔄 ESP32との接続を開始...")
-            for esp in esps:
-                await esp.connect(Hreceive_ESP)
-                print(f"✅ {esp} に接続完了")
-            break
-        except Exception as e:
-            print(f"⚠️ ESP32接続エラー: {e}")
-            await asyncio.sleep(2.5)
-        
-    print("✅ ESP32との接続完了")
+# ESPからの通知はリングバッファに溜め、一定間隔で集計（最新・最小・最大・平均）してPCに送る
+telemetry = Telemetry(protocol, tcp.send, telemetry_interval, telemetry_capacity)
 
-    try:
-        while True:
-            await asyncio.sleep(1000)
-    except Exception as e:
-        print(f"⚠️ データ送信失敗: {e}")
-    except asyncio.CancelledError:
-        pass
-    finally:
-        print(f"❌ 切断")
-        for esp in esps:
-            await esp.disconnect()
-            print(f"❌ 切断: {esp}")
+# 通知を受け取ったときのコールバック（コピーするだけでタスクは作らない）
+def Hreceive_ESP(device_num , identifier, data):
+    telemetry.receive(device_num, identifier, data)
+
+# ESPごとの監視タスクで同時に接続し、切れたESPだけを接続し直す
+ble_manager = BleManager(esps, Hreceive_ESP)
+
+def handle_ble(esp, state):
+    if state == CONNECTED:
+        mailboxes[esp.num].reset()  # 接続し直したESPには次のデータを必ず送る
+        print(f"✅ {esp} に接続完了")
+    elif state == DISCONNECTED and ble_manager.is_running():
+        esp_log.warning("⚠️ %s との接続が切れました。接続し直します", esp)
+
+ble_manager.on_state_change(handle_ble)
+
+def send_config(value: int, nums=None):
+    # ESPに設定コマンドを送る（書き込みはESPごとの書き込みタスクが行い、受信ループは待たない）
+    # nums: 送るESPのdevice番号（省略時は両方）
+    config.update([value])
+    data = config.pack()
+    for num, mailbox in mailboxes.items():
+        if nums is None or num in nums:
+            mailbox.send_command(config.identifier(), data)
+
+# 接続要求ごとにESPの準備を待つタスク（device番号 -> タスク）
+setup_tasks = {}
+
+async def Hsetup_ESP(esp):
+    # ESPが接続して通知を開始したらすぐにセットアップコマンドを送る（接続に時間がかかっても取りこぼさない）
+    if await ble_manager.wait_ready(esp.num, esp_setup_timeout):
+        send_config(1, [esp.num])
+        print(f"✅ {esp} にセットアップコマンドを送信します")
+    else:
+        esp_log.warning("⚠️ %s が%.0f秒以内に接続できませんでした。セットアップコマンドは接続後にL1ボタンで送ってください",
+                        esp, esp_setup_timeout)
+
+def start_setup():
+    # ESPごとに準備を待つタスクを起動する（待っている間もPCからの受信は止まらない）
+    for esp in esps:
+        task = setup_tasks.get(esp.num)
+        if task is None or task.done():
+            setup_tasks[esp.num] = asyncio.create_task(Hsetup_ESP(esp))
 
-async def Hreceive_PC():
-    global esp_task
+async def Hreceive_PC(session):
+    # 操縦権のない接続からの制御フレーム(0x11, 0x12, 0x02, 0xFF)はTcp側で捨てられる
+    # BLEへの書き込みは待たない（遅いESPがあってもPCからの受信は止まらない）
     while True:
-        identifier, size, data = await tcp.receive()
+        identifier, size, data = await session.receive()
         if identifier == 0xFF:
             if data[0] == 1:  # 接続要求
-                esp_task.cancel() if esp_task else None  # 既存のタスクをキャンセル
-                esp_task = asyncio.create_task(Hto_ESP())
-                # ESP接続後にセットアップコマンドを送信
-                await asyncio.sleep(2)  # ESP接続の安定化を待つ
-                try:
-                    config.update([1])  # セットアップコマンド
-                    setup_data = config.pack()
-                    # 両方のESPにセットアップコマンドを送信
-                    await asyncio.gather(
-                        esps[0].send(config.identifier(), setup_data),  # ESP1
-                        esps[1].send(config.identifier(), setup_data),  # ESP2
-                    )
-                    print("✅ ESP両方にセットアップコマンドを送信しました")
-                except Exception as e:
-                    print(f"⚠️ セットアップコマンド送信エラー: {e}")
+                if not ble_manager.is_running():
+                    print("🔄 ESP32との接続を開始...")
+                ble_manager.start()  # 接続済み・接続中のESPはそのまま
+                start_setup()  # 接続して通知を開始したESPから順にセットアップコマンドを送信
+                print("⏳ ESP接続後にセットアップコマンドを送信します")
                 continue
             if data[0] == 2:  # L1ボタンでのセットアップ要求
-                try:
-                    config.update([1])  # セットアップコマンド
-                    setup_data = config.pack()
-                    # 両方のESPにセットアップコマンドを送信
-                    await asyncio.gather(
-                        esps[0].send(config.identifier(), setup_data),  # ESP1
-                        esps[1].send(config.identifier(), setup_data),  # ESP2
-                    )
-                    print("✅ L1ボタンによりESP両方にセットアップコマンドを送信しました")
-                except Exception as e:
-                    print(f"⚠️ L1セットアップコマンド送信エラー: {e}")
+                send_config(1)  # セットアップコマンド
+                print("✅ L1ボタンによりESP両方にセットアップコマンドを送信します")
                 continue
             if data[0] == 3:  # R1ボタンでのconfig 3要求
-                try:
-                    config.update([3])  # config 3コマンド
-                    config3_data = config.pack()
-                    # 両方のESPにconfig 3コマンドを送信
-                    await asyncio.gather(
-                        esps[0].send(config.identifier(), config3_data),  # ESP1
-                        esps[1].send(config.identifier(), config3_data),  # ESP2
-                    )
-                    print("✅ R1ボタンによりESP両方にconfig 3コマンドを送信しました")
-                except Exception as e:
-                    print(f"⚠️ config 3コマンド送信エラー: {e}")
+                send_config(3)  # config 3コマンド
+                print("✅ R1ボタンによりESP両方にconfig 3コマンドを送信します")
                 continue
             if data[0] == 0:  # 終了要求
                 await shutdown()
                 return
 
-        received_data = DataManager.unpack(identifier, data)
-        print(f"📨 受信 from PC: {received_data}")
-        
-        try:
-            if identifier == esp1_servo_data.identifier():  # ESP1サーボデータの場合（4個）- 識別子0x11
-                # ESP1にサーボデータを送信（識別子を0x01に変換）
-                await esps[0].send(0x01, data)  # ESP1に4個のサーボデータを送信
-                
-            elif identifier == esp2_servo_data.identifier():  # ESP2サーボデータの場合（12個）- 識別子0x12
-                # ESP2にサーボデータを送信（識別子を0x01に変換）
-                await esps[1].send(0x01, data)  # ESP2に12個のサーボデータを送信
-
-            elif identifier == bldc_data.identifier():  # BLDCデータの場合
-                # ESP2 (index 1) にBLDCデータを送信
-                if len(esps) > 1:
-                    await esps[1].send(identifier, data)
-            
-        except ConnectionError as e:
-            print(f"{e}")
+        # 中継するフレームは受信ハンドラー（relay.forward）で処理済みのため、ここにはRasp宛てのものだけが届く
+        route = protocol.route(identifier)
+        if route is None or route.size != size:
+            pc_log.warning("⚠️ 不明なフレーム: 識別子 0x%02X, %dバイト", identifier, size)
             continue
+        received_data = DataManager.unpack(identifier, data)
+        pc_log.info("📨 受信 from PC: %s", received_data)
 
 
-async def Hsend_image_PC():
+async def Hrelay_report():
+    # 中継した最新の値を一定間隔で表示する（表示するときだけリストにデコードされる）
+    reported = {}  # 識別子 -> 表示したときの受け取った回数
     while True:
-        print("🔄 カメラ初期化中...")
-        picam = Picam()
-        try:
-            # カメラ設定と起動
-            picam.start()
-            print("✅ カメラ準備完了")
-
-            # フレーム送信ループ
-            while True:
-                data = await picam.get()  # フレームを取得
-                await tcp.send(0x00, data)  # データをPCに送信
-                await asyncio.sleep(camera_interval)  # 次のフレームまで待機
-
-        except asyncio.TimeoutError:
-            print("⚠ フレーム取得タイムアウト。再試行します。")
-        except Exception as e: # エラー取得めんどい
-            print(f"❌ : {e}")
-
-        finally:
-            picam.close()
-            print("📷 カメラ停止")
-
-        print("⏳ カメラ再接続待機中（500秒）...")
-        await asyncio.sleep(500)
-
-async def Hto_PC(addr):
-    # PCとの接続待機
-    print(f"🔗 接続: {addr}")
-
-    # PCとの送受信を起動
-    receive_task = asyncio.create_task(Hreceive_PC())
-    send_image_task = asyncio.create_task(Hsend_image_PC())
+        await asyncio.sleep(relay_report_interval)
+        values = []
+        for identifier in relay.identifiers:
+            manager = protocol.route(identifier).manager
+            if manager.sequence() != reported.get(identifier, 0):
+                reported[identifier] = manager.sequence()
+                values.append(f"{protocol.route(identifier).message.name}={manager.get()}")
+        if values:
+            relay_log.info("📨 受信 from PC: %s", ', '.join(values))
+
 
-    # PCとの切断時処理
+async def Hsend_image_PC():
+    # 回線が混雑している間は最新フレームだけを残して古いフレームを捨てる
+    camera_sender = LatestSender(tcp, 0x00, high_water=camera_high_water, low_water=camera_low_water)
+    sender_task = asyncio.create_task(camera_sender.run())
     try:
         while True:
-            await asyncio.gather(
-                main(),
-                asyncio.sleep(main_interval)  # メインループの実行間隔
-            )
-            if receive_task.done():
-                if receive_task.exception() is not None:
-                    raise receive_task.exception()
+            print("🔄 カメラ初期化中...")
+            picam = Picam()
+            try:
+                # カメラ設定と起動
+                picam.start()
+                print("✅ カメラ準備完了")
+
+                # フレーム取得ループ（送信は待たない）
+                while True:
+                    data = await picam.get()  # フレームを取得
+                    camera_sender.put(data)  # 最新フレームとして送信待ちにする
+                    if camera_sender.captured % camera_report_frames == 0:
+                        camera_log.info("📷 %s", camera_sender.stats())
+                    await asyncio.sleep(camera_interval)  # 次のフレームまで待機
+
+            except asyncio.TimeoutError:
+                camera_log.warning("⚠ フレーム取得タイムアウト。再試行します。")
+            except Exception as e: # エラー取得めんどい
+                camera_log.error("❌ カメラエラー: %s", e)
+
+            finally:
+                picam.close()
+                print("📷 カメラ停止")
+
+            print("⏳ カメラ再接続待機中（500秒）...")
+            await asyncio.sleep(500)
+    finally:
+        sender_task.cancel()
+        print(f"📷 送信統計: {camera_sender.stats()}")
+
+def handle_link(session, degraded):
+    # PCからのpongが届かなくなったら通信劣化として知らせる
+    stats = session.heartbeat.stats()
+    if degraded:
+        pc_log.warning("⚠️ 通信劣化: %s", session)
+    else:
+        print(f"✅ 通信回復: {session} RTT平均 {stats['srtt'] * 1000:.1f}ms p99 {stats['p99'] * 1000:.1f}ms")
+
+tcp.on_link_change(handle_link)
 
+async def Hmain():
+    # 接続中の全PCにBNO055の角度を配信するメインループ
+    while True:
+        await asyncio.gather(
+            main(),
+            asyncio.sleep(main_interval)  # メインループの実行間隔
+        )
+
+async def Hto_PC(session):
+    # PCとの接続（操縦用・閲覧用PCが複数接続できる）
+    print(f"🔗 接続: {session}")
+
+    # PCとの切断時処理（ESP32との接続は切らない）
+    try:
+        await Hreceive_PC(session)
     except (ConnectionResetError, BrokenPipeError) as e:
         print(f"⚠️ 接続エラー: {e}")
     except (asyncio.IncompleteReadError , EOFError):
         print("🔴 PCから接続が終了されました")
     finally:
         print("🧹 切断処理中...")
-        receive_task.cancel()
-        send_image_task.cancel()
-        await asyncio.gather(receive_task, send_image_task, return_exceptions=True)
-        await tcp.close()
-        print(f"❌ 切断: {addr}")
+        await session.close()
+        print(f"❌ 切断: {session}")
 
 async def server():
 
     print("🔵 TCPサーバー起動中...")
     server , addr = await tcp.start_server(Hto_PC)
     print(f"🚀 サーバー起動: {addr}")
-    async with server:
-        await server.serve_forever()
+
+    # BNO055の読み取りスレッド（接続・再接続もスレッドが行う）
+    bno.start_sampler(bno_rate)
+    # 角度とカメラ画像は接続ごとではなく1つずつ動かし、全接続に配信する
+    main_task = asyncio.create_task(Hmain())
+    send_image_task = asyncio.create_task(Hsend_image_PC())
+    # ESPごとの書き込みタスク（PCからの受信とは別に、BLEの速さで最新の値を書き込む）
+    writer_tasks = [asyncio.create_task(mailbox.run()) for mailbox in mailboxes.values()]
+    # ESPからの通知を集計してPCに送るタスク
+    telemetry_task = asyncio.create_task(telemetry.run())
+    tasks = [main_task, send_image_task, telemetry_task] + writer_tasks
+    if relay_report_interval > 0:
+        tasks.append(asyncio.create_task(Hrelay_report()))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 asyncio.run(server())
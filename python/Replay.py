@@ -0,0 +1,39 @@
+import argparse
+import asyncio
+from tools.tcp import ReplayServer
+from tools.frame_log import FrameLog, SENT, RECEIVED
+
+# Rasp.pyの代わりに、記録したログ（config.yamlのtcp.record）を再生する
+# PC.pyのHOSTをこのPC（'localhost'など）に変えて接続する
+
+HOST = '0.0.0.0'
+PORT = 5000
+
+parser = argparse.ArgumentParser(description="記録したフレームのログを再生するサーバー")
+parser.add_argument('log', help="ログファイル (.qkl)")
+parser.add_argument('--speed', type=float, default=1.0, help="再生速度（0で待たずに全力で送る）")
+parser.add_argument('--start', type=float, default=0.0, help="再生を始める時刻（記録開始からの秒）")
+parser.add_argument('--pc', action='store_true', help="PC.pyで記録したログ（受信したフレームを再生する）")
+parser.add_argument('--only', type=lambda x: int(x, 0), nargs='*', help="再生する識別子（例: 0x00 0x03）")
+parser.add_argument('--loop', action='store_true', help="最後まで再生したら繰り返す")
+args = parser.parse_args()
+
+async def main():
+    log = FrameLog(args.log)
+    print(f"📼 {log}")
+    for identifier in log.identifiers():
+        print(f"   0x{identifier:02X}: {log.count(identifier)}フレーム")
+    if log.truncated:
+        print("⚠️ ログの末尾が欠けています（記録中に終了した可能性あり）")
+
+    replay = ReplayServer(log, HOST, PORT, speed=args.speed, direction=RECEIVED if args.pc else SENT,
+                          identifiers=args.only, start=args.start, loop=args.loop)
+    server , addr = await replay.start_server()
+    print(f"🚀 再生サーバー起動: {addr}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        log.close()
+
+asyncio.run(main())
@@ -0,0 +1,129 @@
+"""
+ArrayDataManager（NumPy配列でデータを持つDataManager）のテスト
+- すべてのDataTypeでDataManagerと同じバイト列（ESP32と同じリトルエンディアン）になること
+- 配列をまとめて・マスクで更新できること、リストのAPIもそのまま使えること
+- 配列がそのまま送信バッファになっていること
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import struct
+import time
+
+import numpy as np
+from tools.data_manager import DataManager, DataType
+from tools.array_data_manager import ArrayDataManager
+
+ITERATIONS = 100000
+
+
+def test_layout():
+    """DataManagerと同じバイト列になることを確認"""
+    print("=== バイト列のテスト ===")
+    for i, data_type in enumerate(DataType):
+        size = struct.calcsize(data_type.value)
+        low = -(2 ** (8 * size - 1)) if data_type.name.startswith('INT') else 0
+        high = 2 ** (8 * size - (1 if data_type.name.startswith('INT') else 0)) - 1
+        values = [low, high, 0, 1]
+        reference = DataManager(0x40 + i, 4, data_type)
+        array = ArrayDataManager(0x50 + i, 4, data_type)
+        reference.update(values)
+        array.update(values)
+        assert array.pack() == reference.pack() == struct.pack('<' + data_type.value * 4, *values)
+        assert array.array().dtype == np.dtype('<' + data_type.value), "リトルエンディアンに固定するべき"
+        assert DataManager.unpack(0x50 + i, reference.pack()) == values
+        print(f"✓ {data_type.name}: {array.pack().hex()}")
+    print()
+
+
+def test_update():
+    """まとめて・マスクで更新でき、リストのAPIも使えることを確認"""
+    print("=== 更新のテスト ===")
+    legs = ArrayDataManager(0x60, 12, DataType.UINT8)
+
+    # PC.pyと同じく、get()のリストを書き換えてからupdate()する
+    values = legs.get()
+    values[6] = 90
+    legs.update(values)
+    assert legs.get()[6] == 90 and legs.version() == 1
+    legs.update(values)
+    assert legs.version() == 1, "同じ内容では増えないべき"
+
+    # 脚4本（6, 7, 8, 11番）をまとめて更新
+    mask = np.zeros(12, dtype=bool)
+    mask[[6, 7, 8, 11]] = True
+    legs.update(120, mask=mask)
+    assert legs.get() == [0] * 6 + [120, 120, 120, 0, 0, 120]
+    legs.update(np.arange(12) * 10, mask=mask)
+    assert legs.get() == [0] * 6 + [60, 70, 80, 0, 0, 110]
+    assert legs.version() == 3
+
+    # 配列を直接書き換えてcommit()
+    legs.array()[:6] = 45
+    legs.commit()
+    assert legs.version() == 4 and legs.pack()[:6] == bytes([45] * 6)
+
+    for bad in ([0] * 11, [256] + [0] * 11, [-1] + [0] * 11):
+        try:
+            legs.update(bad)
+            raise AssertionError(f"{bad} はValueErrorになるべき")
+        except ValueError:
+            pass
+    legs.update(300 * np.ones(12), mask=~np.ones(12, dtype=bool))  # 更新しない要素は範囲外でもよい
+    print("✓ 更新の確認OK\n")
+
+
+def test_send_buffer():
+    """配列がそのまま送信バッファになっていることを確認"""
+    print("=== 送信バッファのテスト ===")
+    bno = ArrayDataManager(0x61, 3, DataType.INT8)
+    buffer = bno.pack_into()
+    bno.update([-1, 2, -3])
+    assert bytes(buffer) == bytes([0xFF, 2, 0xFD]), "パックせずに配列のメモリを送れるべき"
+
+    received = memoryview(bytes([0x03, 0, 0, 0, 3]) + bytes([10, 20, 30]))
+    array = bno.unpack_from(received, 5)
+    assert array.tolist() == [10, 20, 30] and bno.version() == 2
+    bno.unpack_from(received, 5)
+    assert bno.version() == 2, "同じ内容を受信しても増えないべき"
+    frame = bytearray(8)
+    bno.pack_into(frame, 5)
+    assert frame[5:] == bytes([10, 20, 30])
+    print("✓ 送信バッファの確認OK\n")
+
+
+def bench():
+    """サーボ12個の更新と送信データ作成の時間をDataManagerと比較する"""
+    print(f"=== ベンチマーク（{ITERATIONS}回） ===")
+    legs_num = [6, 7, 8, 11]
+    reference = DataManager(0x70, 12, DataType.UINT8)
+    array = ArrayDataManager(0x71, 12, DataType.UINT8)
+    mask = np.zeros(12, dtype=bool)
+    mask[legs_num] = True
+
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        values = reference.get()
+        for n in legs_num:
+            values[n] = i % 180
+        reference.update(values)
+        reference.pack()
+    list_time = (time.perf_counter() - start) / ITERATIONS
+
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        array.update(i % 180, mask=mask)
+        array.pack_into()
+    array_time = (time.perf_counter() - start) / ITERATIONS
+    assert array.pack() == reference.pack()
+    print(f"DataManager     （リスト + pack）      : {list_time * 1e9:6.0f} ns/回")
+    print(f"ArrayDataManager（マスク更新 + 送信バッファ）: {array_time * 1e9:6.0f} ns/回")
+
+
+if __name__ == "__main__":
+    test_layout()
+    test_update()
+    test_send_buffer()
+    bench()
+    print("\nテスト完了")
@@ -0,0 +1,132 @@
+"""
+DataManagerのパック・アンパックのベンチマーク
+すべてのDataTypeと、実際に使っている形（サーボ12個・4個、BLDC、BNO）について、
+1回あたりの時間（ns）と確保したメモリ（バイト）を比較する
+- 従来: struct.pack(書式文字列, *リスト) / list(struct.unpack(...))
+- pack(): コンパイル済みStructで新しいbytesを返す
+- pack_into()/unpack_from(): 自身のバッファを使い回す（確保なし）
+unpack()/unpack_from()には受信時刻・番号の記録（_touch）が含まれるため、その時間も別に表示する。
+内容が変わったかの比較は受信のたびには行わず、version()を呼んだときに行う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import struct
+import time
+import tracemalloc
+
+from tools.data_manager import DataManager, DataType
+
+ITERATIONS = 100000
+ALLOC_ITERATIONS = 1000
+
+# (識別子, 長さ, 型, 名前) ※識別子は実機で使っていないもの
+CASES = [(0x40 + i, 4, data_type, data_type.name) for i, data_type in enumerate(DataType)] + [
+    (0x50, 12, DataType.UINT8, "サーボ12個"),
+    (0x51, 4, DataType.UINT8, "サーボ4個"),
+    (0x52, 2, DataType.INT8, "BLDC"),
+    (0x53, 3, DataType.INT8, "BNO"),
+]
+
+
+def sample(data_type: DataType, length: int) -> list:
+    """型の範囲内の値のリスト"""
+    limit = 2 ** (8 * struct.calcsize(data_type.value) - 1) - 1
+    return [(i * 37) % limit for i in range(length)]
+
+
+def measure(func, iterations: int = ITERATIONS) -> float:
+    """1回あたりの時間（ns）"""
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def allocated(func) -> float:
+    """1回あたりに新しく確保したメモリ（バイト）
+    戻り値を保持しておき、呼び出しごとに新しいオブジェクトを作っているかを数える
+    """
+    func()
+    kept = [None] * ALLOC_ITERATIONS
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(ALLOC_ITERATIONS):
+        kept[i] = func()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (current - before) / ALLOC_ITERATIONS
+
+
+def bench_case(identifier: int, length: int, data_type: DataType, name: str):
+    manager = DataManager(identifier, length, data_type)
+    values = sample(data_type, length)
+    manager.update(values)
+    packed = manager.pack()
+    fmt = '<' + data_type.value * length
+    received = bytearray(5 + len(packed))  # 受信バッファ（ヘッダー5バイトの後ろにデータ）
+    received[5:] = packed
+    view = memoryview(received)
+
+    results = {
+        'pack(従来)': lambda: struct.pack(fmt, *values),
+        'pack()': manager.pack,
+        'pack_into()': manager.pack_into,
+        'unpack(従来)': lambda: list(struct.unpack(fmt, view[5:])),
+        'unpack()': lambda: DataManager.unpack(identifier, view[5:]),
+        'unpack_from()': lambda: manager.unpack_from(view, 5),
+        ' うち時刻の記録': manager._touch,
+    }
+    row = []
+    for label, func in results.items():
+        row.append((label, measure(func), allocated(func)))
+
+    # 結果が同じであることを確認
+    assert bytes(manager.pack_into()) == struct.pack(fmt, *values)
+    assert list(manager.unpack_from(view, 5)) == values
+    assert manager.get() == values
+
+    print(f"--- {name} ({length}×{data_type.name}, {len(packed)}バイト) ---")
+    for label, ns, size in row:
+        print(f"{label:14s}: {ns:7.1f} ns/回  {size:6.1f} バイト/回")
+    return dict((label, (ns, size)) for label, ns, size in row)
+
+
+def test_correctness():
+    """unpack_fromで受信した内容がget()/pack()/バージョンに反映されることを確認"""
+    print("=== unpack_from の確認 ===")
+    bno = DataManager(0x60, 3, DataType.INT8)
+    view = bno.unpack_from(bytes([0xFF, 1, 2]))
+    assert list(view) == [-1, 1, 2] and bno.version() == 1
+    bno.unpack_from(bytes([0xFF, 1, 2]))
+    assert bno.version() == 1, "同じ内容では増えないべき"
+    assert bno.pack() == bytes([0xFF, 1, 2])
+    assert bno.get() == [-1, 1, 2]
+    bno.update([-1, 1, 2])
+    assert bno.version() == 1, "受信した内容と同じ更新では増えないべき"
+    bno.update([0, 0, 0])
+    assert bno.version() == 2
+
+    wide = DataManager(0x61, 2, DataType.INT32)
+    wide.update([-2, 70000])
+    assert wide.pack() == struct.pack('<ii', -2, 70000), "ESP32と同じリトルエンディアンでパックするべき"
+    frame = bytearray(4 + wide.size())
+    wide.pack_into(frame, 4)
+    assert frame[4:] == wide.pack()
+    try:
+        wide.unpack_from(bytes(3))
+        raise AssertionError("長さが足りなければValueErrorになるべき")
+    except ValueError:
+        pass
+    print("✓ OK\n")
+
+
+if __name__ == "__main__":
+    test_correctness()
+    print(f"=== ベンチマーク（{ITERATIONS}回） ===")
+    results = [bench_case(*case) for case in CASES]
+    for result in results:
+        assert result['pack_into()'][1] < 1, "pack_intoはメモリを確保しないべき"
+        assert result['unpack_from()'][1] < 1, "unpack_fromはメモリを確保しないべき"
+    print("\nテスト完了")
@@ -0,0 +1,131 @@
+"""
+Raspの中継（PC -> ESP）の1フレームあたりのCPU時間のベンチマーク
+- 変更前: 受信キューにコピー -> receive() -> DataManager.unpackでリストにデコード -> 表示 -> 書き込み待ち
+- 変更後: 受信コールバック内でBleRelay.forward（長さの確認とバッファへのコピーのみ） -> 書き込み待ち
+ESPに送るバイト列が受信したものと同じこと、get()を呼んだときだけデコードされることも確認する
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import io
+import struct
+import time
+
+from tools.data_manager import DataManager
+from tools.protocol import Protocol
+from tools.tcp import FrameProtocol
+from tools.ble_mailbox import BleMailbox, BleRelay
+
+TICKS = 30000
+CHUNK = 1 << 16
+HEADER = struct.Struct('>BI')
+
+
+class NullEsp:
+    """書き込み先（このベンチマークでは書き込みタスクを動かさない）"""
+
+    async def send(self, identifier: int, data: bytes, deadline: float = None):
+        pass
+
+
+def build_stream(protocol: Protocol):
+    """1tickでESP1サーボ・ESP2サーボ・BLDCが届くストリームを作る"""
+    frames = []
+    for tick in range(TICKS):
+        for name in ('batt_servo', 'legs_servo', 'bldc'):
+            message = protocol.messages[name]
+            value = tick % 100
+            frames.append((message.identifier, bytes([value]) * message.size()))
+    stream = b''.join(HEADER.pack(identifier, len(data)) + data for identifier, data in frames)
+    return stream, frames
+
+
+def feed(frame_protocol: FrameProtocol, stream: bytes):
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(stream):
+        buffer = frame_protocol.get_buffer(-1)
+        n = min(len(buffer), CHUNK, len(stream) - offset)
+        buffer[:n] = view[offset:offset + n]
+        frame_protocol.buffer_updated(n)
+        offset += n
+
+
+async def relay_before(protocol: Protocol, mailboxes: dict, stream: bytes, count: int, out) -> float:
+    """変更前のHreceive_PCと同じ処理のCPU時間（秒/フレーム）"""
+    frame_protocol = FrameProtocol()
+    start = time.process_time()
+    feed(frame_protocol, stream)
+    for _ in range(count):
+        identifier, size, data = await frame_protocol.receive()
+        route = protocol.route(identifier)
+        if route is None or route.size != size:
+            continue
+        received_data = DataManager.unpack(identifier, data)
+        if out is not None:
+            print(f"📨 受信 from PC: {received_data}", file=out)
+        for device, ble_identifier in route.targets:
+            mailboxes[device].put(ble_identifier, route.manager)
+    return (time.process_time() - start) / count
+
+
+async def relay_after(relay: BleRelay, stream: bytes, count: int) -> float:
+    """BleRelayを受信ハンドラーにした場合のCPU時間（秒/フレーム）"""
+    handlers = [None] * 256
+    for identifier in relay.identifiers:
+        handlers[identifier] = relay.forward
+    frame_protocol = FrameProtocol(handlers)
+    start = time.process_time()
+    feed(frame_protocol, stream)
+    assert not frame_protocol._frames, "中継するフレームは受信キューに入らないべき"
+    return (time.process_time() - start) / count
+
+
+def drain(mailboxes: dict) -> dict:
+    """書き込み待ちを空にする（BLEでの識別子 -> DataManager）"""
+    slots = {}
+    for device, mailbox in mailboxes.items():
+        for ble_identifier, manager, _, _ in mailbox._slots.values():
+            slots[(device, ble_identifier)] = manager
+        mailbox._slots.clear()
+    return slots
+
+
+async def main():
+    protocol = Protocol()
+    protocol.build()
+    mailboxes = {link['device']: BleMailbox(NullEsp()) for link in protocol.links.values()}
+    relay = BleRelay(protocol, mailboxes)
+    stream, frames = build_stream(protocol)
+    count = len(frames)
+    print(f"=== 中継のCPU時間 ({count}フレーム) ===")
+
+    before_print = await relay_before(protocol, mailboxes, stream, count, io.StringIO())
+    before = await relay_before(protocol, mailboxes, stream, count, None)
+    drain(mailboxes)
+    after = await relay_after(relay, stream, count)
+    print(f"変更前（表示あり）: {before_print * 1e6:6.2f} µs/フレーム")
+    print(f"変更前（表示なし）: {before * 1e6:6.2f} µs/フレーム")
+    print(f"BleRelay          : {after * 1e6:6.2f} µs/フレーム ({before / after:.1f}倍)")
+    assert after < before, "デコードしない中継の方が速いべき"
+    assert relay.stats() == {'forwarded': count, 'invalid': 0}
+
+    # 最後のtickの値がそのまま書き込み待ちにあり、デコードはget()まで行われない
+    slots = drain(mailboxes)
+    last = dict(frames[-3:])
+    for (device, ble_identifier), manager in slots.items():
+        assert manager.pack() == last[manager.identifier()], "受信したバイト列をそのまま送るべき"
+        assert manager._stale, "get()を呼ぶまでリストにデコードしないべき"
+        assert manager.get() == list(last[manager.identifier()])
+        print(f"✓ ESP{device} 0x{ble_identifier:02X} <- 0x{manager.identifier():02X} {manager.pack().hex()}")
+
+    # 長さが違うフレームは中継しない
+    relay.forward(protocol.messages['legs_servo'].identifier, memoryview(bytes(11)))
+    assert relay.stats()['invalid'] == 1 and not drain(mailboxes)
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
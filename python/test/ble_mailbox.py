@@ -0,0 +1,165 @@
+"""
+BleMailbox（ESPごとの最新値の書き込み待ち）のテスト
+- PCからの受信ループがBLEの書き込みを待たないこと（書き込みが遅いESPでも受信の間隔が乱れない）
+- 書き込み中に届いた値はまとめられ、最後の値が必ず書き込まれること
+- まとめたフレームを受け取れるESPには1回の書き込みで送ること
+- 設定コマンドは上書きされず順番通りに、値より先に書き込まれること
+- 書き込みに失敗しても書き込みタスクが止まらないこと
+BLEの代わりに、書き込みに一定時間かかる疑似的なESPを使う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import time
+
+from tools.data_manager import DataManager, DataType, BATCH_IDENTIFIER
+from tools.ble_mailbox import BleMailbox
+
+WRITE_TIME = 0.02    # 疑似ESPの1回の書き込み時間（BLEの接続間隔程度）
+FRAME_INTERVAL = 0.002  # PCからフレームが届く間隔
+FRAMES = 200
+
+servo = DataManager(0x12, 12, DataType.UINT8)
+bldc = DataManager(0x02, 2, DataType.INT8)
+config = DataManager(0xFF, 1, DataType.UINT8)
+
+
+class SlowEsp:
+    """書き込みにwrite_time秒かかる疑似ESP"""
+
+    def __init__(self, write_time: float = WRITE_TIME):
+        self.write_time = write_time
+        self.written = []  # (識別子, データ)
+        self.connected = True
+
+    def __repr__(self):
+        return "SlowEsp"
+
+    async def send(self, identifier: int, data: bytes, deadline: float = None):
+        if not self.connected:
+            raise ConnectionError("SlowEsp は接続されていません。")
+        await asyncio.sleep(self.write_time)
+        self.written.append((identifier, bytes(data)))
+
+
+async def receive_loop(relay) -> float:
+    """PCから一定間隔でサーボの値が届く受信ループ
+    :return: 受信ループの遅れ（最後のフレームの予定時刻からの遅れ, 秒）
+    """
+    start = time.perf_counter()
+    for i in range(FRAMES):
+        servo.update([i % 256] * 12)
+        await relay(0x01, servo)
+        delay = start + (i + 1) * FRAME_INTERVAL - time.perf_counter()
+        await asyncio.sleep(max(0.0, delay))
+    return time.perf_counter() - (start + FRAMES * FRAME_INTERVAL)
+
+
+async def test_non_blocking():
+    print("=== 受信ループが書き込みを待たないことの確認 ===")
+    # 変更前: 受信ループで書き込みを待つ
+    esp = SlowEsp()
+    lag_inline = await receive_loop(lambda identifier, manager: esp.send(identifier, manager.pack()))
+
+    # 変更後: 書き込み待ちに入れるだけ
+    esp = SlowEsp()
+    mailbox = BleMailbox(esp, keepalive=0)
+    task = asyncio.create_task(mailbox.run())
+    put_times = []
+
+    async def relay(identifier, manager):
+        begin = time.perf_counter()
+        mailbox.put(identifier, manager)
+        put_times.append(time.perf_counter() - begin)
+
+    lag_mailbox = await receive_loop(relay)
+    await asyncio.sleep(WRITE_TIME * 3)
+    task.cancel()
+    stats = mailbox.stats()
+    print(f"受信ループの遅れ: 書き込みを待つ {lag_inline * 1000:.0f}ms, 書き込み待ちに入れる {lag_mailbox * 1000:.0f}ms")
+    print(f"put: 最大 {max(put_times) * 1e6:.1f}µs")
+    print(stats)
+    assert lag_inline > FRAMES * WRITE_TIME * 0.5, "書き込みを待つと受信ループが遅れるはず"
+    assert lag_mailbox < lag_inline / 10, "書き込み待ちに入れるだけなら受信ループは遅れないべき"
+    assert esp.written[-1] == (0x01, bytes([(FRAMES - 1) % 256] * 12)), "最後の値が書き込まれるべき"
+    assert stats['coalesced'] > 0 and stats['written'] + stats['coalesced'] == stats['put']
+    assert stats['depth'] == 0 and stats['max_depth'] == 1
+    assert stats['write_p50'] >= WRITE_TIME * 0.9
+    print("✓ 受信ループが遅れず、最後の値が書き込まれることを確認\n")
+
+
+async def test_update_during_write():
+    print("=== 書き込み中の更新の確認 ===")
+    esp = SlowEsp()
+    mailbox = BleMailbox(esp, keepalive=10.0)
+    task = asyncio.create_task(mailbox.run())
+    servo.update([1] * 12)
+    mailbox.put(0x01, servo)
+    await asyncio.sleep(WRITE_TIME / 2)  # 書き込み中に更新
+    servo.update([2] * 12)
+    mailbox.put(0x01, servo)
+    await asyncio.sleep(WRITE_TIME * 3)
+    mailbox.put(0x01, servo)  # 同じ内容は書き込まない
+    await asyncio.sleep(WRITE_TIME * 2)
+    task.cancel()
+    assert esp.written == [(0x01, bytes([1] * 12)), (0x01, bytes([2] * 12))], esp.written
+    assert mailbox.stats()['unchanged'] == 1
+    print("✓ 書き込み中に届いた値も書き込まれ、同じ内容は省かれることを確認\n")
+
+
+async def test_batch_and_commands():
+    print("=== まとめたフレームと設定コマンドの確認 ===")
+    esp = SlowEsp()
+    mailbox = BleMailbox(esp, keepalive=0, batch=True)
+    servo.update([3] * 12)
+    bldc.update([-5, 5])
+    mailbox.put(0x01, servo)
+    mailbox.put(0x02, bldc)
+    for value in (1, 3):
+        config.update([value])
+        mailbox.send_command(config.identifier(), config.pack())
+    assert mailbox.depth() == 4
+    task = asyncio.create_task(mailbox.run())
+    await asyncio.sleep(WRITE_TIME * 5)
+    task.cancel()
+    assert esp.written[:2] == [(0xFF, bytes([1])), (0xFF, bytes([3]))], "コマンドは順番通りに先に書き込むべき"
+    assert len(esp.written) == 3
+    identifier, data = esp.written[2]
+    assert identifier == BATCH_IDENTIFIER
+    assert data[:3] == bytes([2, 0x01, 0x02]), "サーボとBLDCを1回で送るべき"
+    assert data[3:] == servo.pack() + bldc.pack()
+    print(f"✓ {len(esp.written)}回の書き込み: {[f'0x{i:02X}' for i, _ in esp.written]}\n")
+
+
+async def test_errors():
+    print("=== 書き込み失敗の確認 ===")
+    esp = SlowEsp()
+    esp.connected = False
+    mailbox = BleMailbox(esp, keepalive=0)
+    task = asyncio.create_task(mailbox.run())
+    servo.update([4] * 12)
+    mailbox.put(0x01, servo)
+    await asyncio.sleep(0.01)
+    mailbox.put(0x01, servo)
+    await asyncio.sleep(0.01)
+    assert mailbox.stats()['errors'] == 2 and not task.done(), "失敗しても書き込みタスクは止まらないべき"
+    esp.connected = True
+    mailbox.put(0x01, servo)
+    await asyncio.sleep(WRITE_TIME * 2)
+    task.cancel()
+    assert esp.written == [(0x01, bytes([4] * 12))]
+    print("✓ 接続が戻ると書き込めることを確認\n")
+
+
+async def main():
+    await test_non_blocking()
+    await test_update_during_write()
+    await test_batch_and_commands()
+    await test_errors()
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,152 @@
+"""
+BleManager（ESPごとの監視タスクによる接続）のテスト
+- すべてのESPに同時に接続し、起動から全ESP接続までの時間が一番遅いESPの接続時間になること
+- 接続に失敗したESPだけが待ち時間を伸ばしながら再試行し、続けて失敗したらスキャンし直すこと
+- 接続が切れたら自動で接続し直し、状態の変化が通知されること
+BLEの代わりに、接続に一定時間かかる疑似的なESPを使う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import time
+
+from tools.ble_manager import BleManager, CONNECTING, CONNECTED, DISCONNECTED, BACKOFF
+
+CONFIG = {'initial_delay': 0.02, 'max_delay': 0.1, 'factor': 2.0, 'jitter': 0.0,
+          'rescan_failures': 2, 'check_interval': 0.05}
+
+
+class FakeEsp:
+    """接続にscan_time + connect_time秒かかる疑似ESP（failsの回数だけ接続に失敗する）"""
+
+    def __init__(self, num: int, scan_time: float, connect_time: float, fails: int = 0):
+        self.num = num
+        self.scan_time = scan_time
+        self.connect_time = connect_time
+        self.fails = fails
+        self.connected = False
+        self.device = None
+        self.scans = 0
+        self._listeners = []
+
+    def __repr__(self):
+        return f"FakeEsp-{self.num}"
+
+    async def connect(self, receive_func):
+        if self.device is None:
+            self.scans += 1
+            await asyncio.sleep(self.scan_time)
+            self.device = object()
+        await asyncio.sleep(self.connect_time)
+        if self.fails > 0:
+            self.fails -= 1
+            raise ConnectionError(f"ESP32-{self.num} への接続に失敗しました。")
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def forget(self):
+        self.device = None
+
+    def on_disconnect(self, listener):
+        self._listeners.append(listener)
+
+    def drop(self):
+        """ESP側から接続が切れる"""
+        self.connected = False
+        for listener in self._listeners:
+            listener(self)
+
+
+def receive(device_num, identifier, data):
+    pass
+
+
+async def test_cold_start():
+    print("=== 起動から全ESP接続までの時間 ===")
+    # 変更前: 1台ずつ接続する
+    esps = [FakeEsp(1, 0.2, 0.1), FakeEsp(2, 0.3, 0.15)]
+    start = time.perf_counter()
+    for esp in esps:
+        await esp.connect(receive)
+    sequential = time.perf_counter() - start
+
+    # 変更後: 同時に接続する
+    esps = [FakeEsp(1, 0.2, 0.1), FakeEsp(2, 0.3, 0.15)]
+    manager = BleManager(esps, receive, CONFIG)
+    start = time.perf_counter()
+    manager.start()
+    assert await manager.wait_connected(timeout=2.0)
+    concurrent = time.perf_counter() - start
+    await manager.stop()
+    print(f"1台ずつ: {sequential * 1000:.0f}ms, 同時: {concurrent * 1000:.0f}ms "
+          f"(一番遅いESP {0.45 * 1000:.0f}ms)")
+    print(manager.stats())
+    assert concurrent < 0.45 + 0.1 and concurrent < sequential * 0.8, "一番遅いESPの接続時間で全て接続されるべき"
+    assert not any(esp.connected for esp in esps), "stop()で切断されるべき"
+    print("✓ 同時に接続されることを確認\n")
+
+
+async def test_backoff():
+    print("=== 接続失敗時の再試行 ===")
+    esps = [FakeEsp(1, 0.01, 0.01), FakeEsp(2, 0.01, 0.01, fails=3)]
+    manager = BleManager(esps, receive, CONFIG)
+    states = []
+    manager.on_state_change(lambda esp, state: states.append((esp.num, state)))
+    manager.start()
+    await asyncio.sleep(0.05)
+    assert manager.state(1) == CONNECTED and manager.state(2) in (CONNECTING, BACKOFF), "失敗したESPだけが再試行を待つべき"
+    assert await manager.wait_connected(timeout=1.0)
+    await manager.stop()
+    stats = manager.stats()
+    print(stats)
+    assert stats[1]['attempts'] == 1 and stats[2]['attempts'] == 4 and stats[2]['failures'] == 3
+    assert esps[1].scans == 2, "2回続けて失敗したらスキャンし直すべき"
+    assert [state for num, state in states if num == 2] == \
+        [CONNECTING, BACKOFF] * 3 + [CONNECTING, CONNECTED, DISCONNECTED]
+    print("✓ 失敗したESPだけ再試行し、スキャンし直すことを確認\n")
+
+
+async def test_reconnect():
+    print("=== 切断時の自動再接続 ===")
+    esps = [FakeEsp(1, 0.05, 0.02), FakeEsp(2, 0.05, 0.02)]
+    manager = BleManager(esps, receive, CONFIG)
+    states = []
+    manager.on_state_change(lambda esp, state: states.append((esp.num, state)))
+    manager.start()
+    assert await manager.wait_connected(timeout=1.0)
+    start = time.perf_counter()
+    esps[0].drop()  # 切断の通知
+    await asyncio.sleep(0.005)
+    assert manager.state(1) != CONNECTED and manager.state(2) == CONNECTED
+    assert await manager.wait_connected(timeout=1.0)
+    recovery = time.perf_counter() - start
+    esps[1].connected = False  # 通知なしで切れた場合は接続状態の確認で気付く
+    await asyncio.sleep(CONFIG['check_interval'] * 1.5)
+    assert await manager.wait_connected(timeout=1.0)
+    await manager.stop()
+    stats = manager.stats()
+    print(stats)
+    print(f"切断から再接続まで: {recovery * 1000:.0f}ms（スキャンなし）")
+    assert stats[1]['reconnects'] == 1 and stats[2]['reconnects'] == 1
+    assert esps[0].scans == 1 and esps[1].scans == 1, "再接続ではキャッシュしたデバイスを使うべき"
+    assert recovery < 0.05, "再接続ではスキャンしないべき"
+    assert (1, DISCONNECTED) in states[:-2]
+    print("✓ 切れたESPだけが接続し直されることを確認\n")
+
+
+async def main():
+    await test_cold_start()
+    await test_backoff()
+    await test_reconnect()
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""
+ESPの準備（接続して通知を開始）を待ってセットアップコマンドを送るテスト
+- 接続要求から最初のサーボの値がESPに反映されるまでの時間を、固定の2秒待ちと比べる
+  （ESPはセットアップコマンドを受け取るまでサーボを動かさない）
+- 接続に2秒以上かかってもセットアップコマンドを取りこぼさないこと
+- 待っている間もPCからの受信ループが止まらないこと、準備できなければタイムアウトすること
+BLEの代わりに、接続に一定時間かかり書き込みを記録する疑似的なESPを使う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import time
+
+from tools.ble import Ble
+from tools.ble_mailbox import BleMailbox
+from tools.ble_manager import BleManager, CONNECTED
+from tools.data_manager import DataManager, DataType
+
+CONFIG = {'initial_delay': 0.05, 'max_delay': 0.1, 'factor': 2.0, 'jitter': 0.0,
+          'rescan_failures': 3, 'check_interval': 0.05}
+SETUP_DELAY = 2.0      # 変更前のRasp.py（call_later(2, send_config, 1)）
+SETUP_TIMEOUT = 10.0
+PC_INTERVAL = 0.02     # PCからサーボの値が届く間隔
+LIMIT = 3.0            # これ以上反映されなければ失敗とする
+
+servo = DataManager(0x12, 12, DataType.UINT8)
+
+
+class FakeEsp:
+    """接続にconnect_time秒かかり、セットアップコマンドを受け取ってからサーボを動かす疑似ESP"""
+
+    def __init__(self, num: int, connect_time: float):
+        self.num = num
+        self.connect_time = connect_time
+        self.connected = False
+        self.setup_at = None        # セットアップコマンドを受け取った時刻
+        self.first_servo_at = None  # セットアップ後に最初にサーボの値を受け取った時刻
+        self.rejected = 0           # 接続前で書き込めなかった回数
+
+    def __repr__(self):
+        return f"FakeEsp-{self.num}"
+
+    async def connect(self, receive_func):
+        await asyncio.sleep(self.connect_time)
+        self.connected = True
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def forget(self):
+        pass
+
+    def on_disconnect(self, listener):
+        pass
+
+    async def send(self, identifier: int, data: bytes, deadline: float = None):
+        await asyncio.sleep(0)
+        if not self.connected:
+            self.rejected += 1
+            raise ConnectionError(f"ESP32-{self.num} は接続されていません。")
+        now = time.monotonic()
+        if identifier == 0xFF and data[0] == 1:
+            self.setup_at = now
+        elif identifier == 0x01 and self.setup_at is not None and self.first_servo_at is None:
+            self.first_servo_at = now
+
+
+def receive(device_num, identifier, data):
+    pass
+
+
+async def setup_when_ready(manager: BleManager, esp: FakeEsp, mailbox: BleMailbox):
+    """Rasp.pyのHsetup_ESPと同じ"""
+    if await manager.wait_ready(esp.num, SETUP_TIMEOUT):
+        mailbox.send_command(0xFF, bytes([1]))
+
+
+async def connect_to_servo(connect_time: float, event_driven: bool):
+    """接続要求から最初のサーボの値が反映されるまでの時間と、PCからの受信ループの最大間隔"""
+    esp = FakeEsp(2, connect_time)
+    mailbox = BleMailbox(esp, keepalive=0, command_max_age=3.0, max_age=0.25)
+    manager = BleManager([esp], receive, CONFIG)
+    manager.on_state_change(lambda esp, state: mailbox.reset() if state == CONNECTED else None)
+    writer = asyncio.create_task(mailbox.run())
+    start = time.monotonic()
+    manager.start()
+    if event_driven:
+        setup = asyncio.create_task(setup_when_ready(manager, esp, mailbox))
+    else:
+        setup = asyncio.get_running_loop().call_later(SETUP_DELAY, mailbox.send_command, 0xFF, bytes([1]))
+
+    # PCからの受信ループ（一定間隔でサーボの値が届く）
+    max_gap = 0.0
+    last = time.monotonic()
+    value = 0
+    while esp.first_servo_at is None and time.monotonic() - start < LIMIT:
+        value = (value + 1) % 180
+        servo.update([value] * 12)
+        mailbox.put(0x01, servo)
+        await asyncio.sleep(PC_INTERVAL)
+        now = time.monotonic()
+        max_gap = max(max_gap, now - last)
+        last = now
+    setup.cancel()
+    writer.cancel()
+    await manager.stop()
+    latency = None if esp.first_servo_at is None else esp.first_servo_at - start
+    return latency, max_gap, esp
+
+
+def show(latency):
+    return "反映されない" if latency is None else f"{latency * 1000:.0f}ms"
+
+
+async def test_latency():
+    print("=== 接続要求から最初のサーボの値が反映されるまで ===")
+    results = {}
+    for connect_time in (0.3, 2.3):
+        for event_driven in (False, True):
+            latency, max_gap, esp = await connect_to_servo(connect_time, event_driven)
+            results[connect_time, event_driven] = latency
+            print(f"接続 {connect_time * 1000:.0f}ms, {'準備を待つ' if event_driven else '2秒待つ　'}: {show(latency)} "
+                  f"(受信ループの最大間隔 {max_gap * 1000:.0f}ms, 接続前の書き込み失敗 {esp.rejected}回)")
+            assert max_gap < PC_INTERVAL + 0.05, "準備を待つ間もPCからの受信ループは止まらないべき"
+    fast_old, fast_new = results[0.3, False], results[0.3, True]
+    assert fast_old >= SETUP_DELAY and fast_new < 0.3 + 0.1, "接続したらすぐにセットアップコマンドを送るべき"
+    assert results[2.3, False] is None, "固定の待ち時間より接続が遅いとセットアップコマンドが失われる"
+    assert results[2.3, True] < 2.3 + 0.1, "接続が遅くてもセットアップコマンドを送るべき"
+    print("✓ 準備できたESPにすぐセットアップコマンドを送ることを確認\n")
+
+
+async def test_timeout():
+    print("=== タイムアウトのテスト ===")
+    esp = FakeEsp(1, 10.0)
+    manager = BleManager([esp], receive, CONFIG)
+    manager.start()
+    start = time.perf_counter()
+    assert not await manager.wait_ready(1, 0.1), "接続できなければFalseを返すべき"
+    assert not await manager.wait_connected(0.05)
+    elapsed = time.perf_counter() - start
+    await manager.stop()
+    assert elapsed < 0.2
+
+    # Ble.ready は切断でクリアされる
+    ble = Ble(1, "00:00:00:00:00:01", "char", write_config={})
+    assert not await ble.wait_ready(0.01)
+    client = object()
+    ble.client = client
+    ble.ready.set()
+    assert await ble.wait_ready(0)
+    ble._disconnected(client)
+    assert not ble.ready.is_set()
+    print(f"✓ 準備できなければタイムアウトする ({elapsed * 1000:.0f}ms)\n")
+
+
+async def main():
+    await test_latency()
+    await test_timeout()
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,166 @@
+"""
+Ble.send（応答なしの書き込みの間隔・再試行・期限）のテスト
+- 書き込み間隔を守ることで、コントローラーのバッファが溢れて書き込みが失われないこと
+- 失敗したら待ち時間を伸ばしながら再試行し、再試行しても書き込めなければ例外になること
+- 期限を過ぎた値・コマンドは書き込まないこと
+BLEの代わりに、パケットのバッファが接続間隔ごとに1つずつ空く疑似的なクライアントを使う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import time
+
+from tools.ble import Ble
+from tools.ble_mailbox import BleMailbox
+from tools.data_manager import DataManager, DataType
+
+INTERVAL = 0.0075  # 接続間隔（1回の接続イベントで1パケット送れる）
+CAPACITY = 4       # コントローラーのバッファのパケット数
+WRITES = 100
+CONFIG = {'interval': INTERVAL, 'retries': 3, 'retry_delay': 0.005}
+
+servo = DataManager(0x12, 12, DataType.UINT8)
+
+
+class FakeClient:
+    """接続間隔ごとにバッファから1パケットずつ送る疑似BleakClient"""
+
+    def __init__(self, fails: int = 0):
+        self.is_connected = True
+        self.fails = fails  # この回数だけ書き込みに失敗する
+        self.written = []
+        self._level = 0.0
+        self._updated = time.monotonic()
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        await asyncio.sleep(0)
+        now = time.monotonic()
+        self._level = max(0.0, self._level - (now - self._updated) / INTERVAL)
+        self._updated = now
+        if self.fails > 0:
+            self.fails -= 1
+            raise Exception("Operation failed")
+        if self._level + 1 > CAPACITY:
+            raise Exception("No buffer space available")
+        self._level += 1
+        self.written.append(bytes(data))
+
+
+def make_ble(client: FakeClient, config: dict = CONFIG) -> Ble:
+    ble = Ble(1, "00:00:00:00:00:01", "char", write_config=config)
+    ble.client = client
+    return ble
+
+
+async def old_send(ble: Ble, identifier: int, data: bytes):
+    """変更前のBle.send（待たずに3回まで再試行し、失敗しても何も返さない）"""
+    for attempt in range(3):
+        try:
+            await ble.client.write_gatt_char(ble.char_uuid, bytes([identifier]) + data, response=False)
+            return
+        except Exception:
+            continue
+
+
+async def test_flow_control():
+    print("=== 書き込み間隔のテスト ===")
+    data = bytes(12)
+    client = FakeClient()
+    ble = make_ble(client)
+    start = time.perf_counter()
+    for _ in range(WRITES):
+        await old_send(ble, 0x12, data)
+    old_time = time.perf_counter() - start
+    old_written = len(client.written)
+
+    client = FakeClient()
+    ble = make_ble(client)
+    start = time.perf_counter()
+    for _ in range(WRITES):
+        await ble.send(0x12, data)
+    new_time = time.perf_counter() - start
+    stats = ble.stats()
+    print(f"変更前: {old_written}/{WRITES}回 書き込めた ({old_time * 1000:.0f}ms)")
+    print(f"変更後: {len(client.written)}/{WRITES}回 書き込めた ({new_time * 1000:.0f}ms)")
+    print(stats)
+    assert old_written < WRITES, "間隔を空けずに書き込むとバッファが溢れるはず"
+    assert len(client.written) == WRITES and stats['failures'] == 0, "書き込み間隔を守れば失われないべき"
+    assert stats['bytes'] == WRITES * 13
+    assert stats['writes_per_s'] < 1 / INTERVAL * 1.05
+    assert abs(stats['airtime'] - WRITES * (13 + 17) * 8e-6) < 1e-9
+    print("✓ バッファを溢れさせずに書き込めることを確認\n")
+
+
+async def test_retry():
+    print("=== 再試行のテスト ===")
+    ble = make_ble(FakeClient(fails=2))
+    start = time.perf_counter()
+    await ble.send(0x12, bytes(12))
+    elapsed = time.perf_counter() - start
+    assert ble.stats()['retried'] == 2 and ble.writes == 1
+    assert elapsed >= 0.005 + 0.01, "再試行の前に待つべき"
+    print(f"✓ 2回失敗した後に書き込めた ({elapsed * 1000:.1f}ms)")
+
+    ble = make_ble(FakeClient(fails=10))
+    try:
+        await ble.send(0x12, bytes(12))
+        assert False, "再試行しても書き込めなければ例外になるべき"
+    except Exception as e:
+        print(f"✓ 再試行しても書き込めない: {e}")
+    assert ble.stats()['failures'] == 1 and ble.stats()['retried'] == 3
+
+    ble = make_ble(FakeClient())
+    ble.client.is_connected = False
+    try:
+        await ble.send(0x12, bytes(12))
+        assert False
+    except ConnectionError as e:
+        print(f"✓ {e}\n")
+
+
+async def test_deadline():
+    print("=== 期限のテスト ===")
+    ble = make_ble(FakeClient(), {'interval': 0.05})
+    await ble.send(0x12, bytes(12))
+    try:
+        # 次に書き込めるのは50ms後なので、10ms後の期限には間に合わない
+        await ble.send(0x12, bytes(12), deadline=time.monotonic() + 0.01)
+        assert False, "期限に間に合わない書き込みはしないべき"
+    except TimeoutError:
+        pass
+    assert ble.stats()['expired'] == 1 and ble.writes == 1
+
+    # コマンドが書き込み待ちの間に、値の期限が切れる
+    client = FakeClient()
+    ble = make_ble(client, {'interval': 0.03})
+    mailbox = BleMailbox(ble, keepalive=0, max_age=0.05, command_max_age=0.07)
+    for value in range(5):
+        mailbox.send_command(0xFF, bytes([value]))
+    servo.update([7] * 12)
+    mailbox.put(0x01, servo)
+    task = asyncio.create_task(mailbox.run())
+    await asyncio.sleep(0.25)
+    stats = mailbox.stats()
+    print([data.hex() for data in client.written])
+    print(stats)
+    assert client.written == [bytes([0xFF, 0]), bytes([0xFF, 1]), bytes([0xFF, 2])], "期限内のコマンドだけを書き込むべき"
+    assert stats['expired'] == 3, "古いコマンド2つと値は書き込まないべき"
+    servo.update([8] * 12)
+    mailbox.put(0x01, servo)  # 新しい値は書き込まれる
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert client.written[-1] == bytes([0x01] + [8] * 12)
+    print("✓ 期限を過ぎたコマンド・値を書き込まないことを確認\n")
+
+
+async def main():
+    await test_flow_control()
+    await test_retry()
+    await test_deadline()
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,208 @@
+"""
+疑似ESP（tools/ble_sim.py）のテスト
+- 疑似ファームウェアがESP32のDataManager<T>と同じようにunpackし、不正なデータでは再起動（切断）すること
+- Ble・BleManager・BleMailbox・BleRelayを実機なしで動かし、PC→Rasp→ESPの中継の速さと遅延を測ること
+- 書き込みが失われる場合や、ESPからの通知がTelemetryで集計されること
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import time
+
+from tools.ble import Ble
+from tools.ble_mailbox import BleMailbox, BleRelay
+from tools.ble_manager import BleManager, CONNECTED
+from tools.ble_sim import SimBackend, SimFirmware
+from tools.data_manager import DataManager, BATCH_IDENTIFIER
+from tools.protocol import Protocol
+from tools.telemetry import Telemetry
+
+MANAGER_CONFIG = {'initial_delay': 0.05, 'max_delay': 0.1, 'factor': 2.0, 'jitter': 0.0,
+                  'rescan_failures': 3, 'check_interval': 0.05}
+WRITE_CONFIG = {'interval': 0.0075, 'retries': 3, 'retry_delay': 0.005}
+PC_RATE = 100     # PCからサーボ・BLDCの値が届く回数/秒
+DURATION = 2.0    # 中継を測る時間（秒）
+
+protocol = Protocol()
+messages = protocol.build()
+
+
+def test_firmware():
+    print("=== 疑似ファームウェアのテスト ===")
+    firmware = SimFirmware(protocol, 'ESP2')
+    print(firmware)
+    assert set(firmware.by_name) == {'servo_data', 'bldc_data', 'config_data'}, "ESPのソースと同じDataManagerを持つべき"
+    servo, bldc, config = (firmware.by_name[name] for name in ('servo_data', 'bldc_data', 'config_data'))
+
+    firmware.receive(bytes([0x01] + list(range(12))))
+    assert servo.get() == list(range(12))
+    firmware.receive(bytes([0x02, 0x81, 0x7F]))
+    assert bldc.get() == [-127, 127], "int8_tとして読むべき"
+    firmware.receive(bytes([0xFF, 1]))
+    assert firmware.setup, "config 1でセットアップするべき"
+
+    # まとめたフレーム（Pythonのpack_batchと同じ形式）
+    messages['legs_servo'].update([90] * 12)
+    messages['bldc'].update([-5, 5])
+    batch = DataManager.pack_batch([messages['legs_servo'], messages['bldc']], [0x01, 0x02])
+    firmware.receive(bytes([BATCH_IDENTIFIER]) + batch)
+    assert servo.get() == [90] * 12 and bldc.get() == [-5, 5]
+    assert servo.updates == 2 and bldc.updates == 2
+
+    for data in (bytes([0x01] * 5), bytes([0x40, 0]), bytes([BATCH_IDENTIFIER, 2, 0x01]),
+                 bytes([BATCH_IDENTIFIER]) + batch[:-1]):
+        try:
+            firmware.receive(data)
+            assert False, "ESP32ではabort()になるデータはValueErrorになるべき"
+        except ValueError as e:
+            print(f"✓ {data.hex()}: {e}")
+    assert servo.get() == [90] * 12, "長さが合わないまとめたフレームは途中まで書き込まないべき"
+    print("✓ DataManager<T>と同じunpackを確認\n")
+
+
+def make_chain(sim_config: dict):
+    """Rasp.pyと同じ組み合わせをSimBackendで作る"""
+    backend = SimBackend(protocol, sim_config)
+    esps = [Ble(num, f"00:00:00:00:00:0{num}", "char", write_config=WRITE_CONFIG, backend=backend) for num in (1, 2)]
+    batch_devices = protocol.batch_devices()
+    mailboxes = {esp.num: BleMailbox(esp, keepalive=1.0, batch=esp.num in batch_devices, max_age=0.25)
+                 for esp in esps}
+    relay = BleRelay(protocol, mailboxes)
+    return backend, esps, mailboxes, relay
+
+
+async def relay_for(relay: BleRelay, duration: float) -> int:
+    """PCからのフレームをPC_RATE回/秒でrelay.forwardに渡す（Tcpの受信コールバックと同じ）"""
+    sent = 0
+    start = time.monotonic()
+    next_at = start
+    while time.monotonic() - start < duration:
+        value = sent % 180
+        relay.forward(0x12, memoryview(bytes([value] * 12)))
+        relay.forward(0x02, memoryview(bytes([value % 100, 0])))
+        relay.forward(0x11, memoryview(bytes([value] * 4)))
+        sent += 1
+        next_at += 1 / PC_RATE
+        await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+    return sent
+
+
+async def bench_chain(sim_config: dict, label: str):
+    backend, esps, mailboxes, relay = make_chain(sim_config)
+    manager = BleManager(esps, lambda *args: None, MANAGER_CONFIG)
+    manager.on_state_change(lambda esp, state: mailboxes[esp.num].reset() if state == CONNECTED else None)
+    writers = [asyncio.create_task(mailbox.run()) for mailbox in mailboxes.values()]
+
+    # PCから受け取ってからESPのDataManagerに入るまで（値にPCで送った番号を入れて対応させる）
+    put_at = {}
+    latencies = []
+    firmware = backend.esps[2].firmware
+    firmware.on_update(lambda data, setup: latencies.append(time.monotonic() - put_at[data.data[0]])
+                       if data.name == 'servo_data' and data.data[0] in put_at else None)
+    original = relay.forward
+
+    def forward(identifier, payload):
+        if identifier == 0x12:
+            put_at[payload[0]] = time.monotonic()
+        original(identifier, payload)
+    relay.forward = forward
+
+    start = time.monotonic()
+    manager.start()
+    assert await manager.wait_connected(timeout=2.0)
+    connected = time.monotonic() - start
+    sent = await relay_for(relay, DURATION)
+    await asyncio.sleep(0.05)
+    for writer in writers:
+        writer.cancel()
+    await manager.stop()
+
+    stats = backend.stats()
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"{label}: 接続 {connected * 1000:.0f}ms, PCから {sent}回/ESP, ESP2が受け取った書き込み "
+          f"{stats[2]['writes']}回 ({stats[2]['writes'] / DURATION:.0f}回/秒), 失われた書き込み {stats[2]['dropped']}, "
+          f"遅延 p50 {p50:.1f}ms p99 {p99:.1f}ms")
+    print(f"   ESP2: {mailboxes[2]}")
+    return stats, mailboxes, p99
+
+
+async def test_chain():
+    print("=== PC→Rasp→ESPの中継（疑似ESP） ===")
+    stats, mailboxes, p99 = await bench_chain({'connect_time': 0.05, 'write_latency': 0.002, 'jitter': 0.001,
+                                               'seed': 1}, "損失なし")
+    assert stats[2]['aborts'] == 0 and stats[1]['aborts'] == 0, "中継したデータはESPのDataManagerで読めるべき"
+    assert stats[2]['writes'] > DURATION * PC_RATE * 0.8, "ESP2へはまとめたフレームで1回の書き込みにするべき"
+    assert p99 < 50, "最新の値はすぐにESPに届くべき"
+
+    stats, mailboxes, p99 = await bench_chain({'connect_time': 0.05, 'write_latency': 0.002, 'jitter': 0.004,
+                                               'drop_rate': 0.1, 'seed': 2}, "10%損失")
+    assert 0 < stats[2]['dropped'] < stats[2]['writes'] * 0.2
+    print("✓ 実機なしで中継を測れることを確認\n")
+
+
+async def test_notify():
+    print("=== ESPからの通知 ===")
+    import tempfile
+    import yaml
+    schema = {'links': {'ESP2': {'device': 2, 'firmware': 'ESP2.cpp'}},
+              'messages': {'current': {'identifier': 0x21, 'type': 'UINT16', 'length': 2, 'source': 'ESP2',
+                                       'destination': ['PC'], 'ble_identifier': 0x05, 'firmware': 'current_data'}}}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'protocol.yaml')
+        with open(path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump(schema, f)
+        notify_protocol = Protocol(path)
+    notify_protocol.build()
+    backend = SimBackend(notify_protocol, {'connect_time': 0.01,
+                                           'notify': {'ESP2': [{'firmware': 'current_data', 'rate': 200}]}})
+    sent = []
+
+    async def send(identifier, data):
+        sent.append(bytes(data))
+
+    telemetry = Telemetry(notify_protocol, send, interval=0.1)
+    esp = Ble(2, "00:00:00:00:00:02", "char", write_config=WRITE_CONFIG, backend=backend)
+    await esp.connect(telemetry.receive)
+    task = asyncio.create_task(telemetry.run())
+    await asyncio.sleep(0.35)
+    await esp.disconnect()
+    task.cancel()
+    notified = backend.esps[2].notified
+    samples = sum(Telemetry.unpack(notify_protocol, data)['current']['samples'] for data in sent)
+    print(f"通知 {notified}回 -> PCへ {len(sent)}フレーム ({samples}件) {telemetry.stats()}")
+    assert notified > 50 and telemetry.stats()['invalid'] == 0
+    assert samples <= notified and len(sent) >= 3
+    print("✓ 通知がTelemetryで集計されることを確認\n")
+
+
+async def test_abort():
+    print("=== 不正なデータでの再起動と再接続 ===")
+    backend, esps, mailboxes, relay = make_chain({'connect_time': 0.02, 'write_latency': 0.001, 'jitter': 0.0})
+    manager = BleManager(esps, lambda *args: None, MANAGER_CONFIG)
+    manager.start()
+    assert await manager.wait_connected(timeout=1.0)
+    await esps[1].send(0x01, bytes(5))  # 長さの違うサーボの値
+    await asyncio.sleep(0.01)
+    assert not esps[1].is_connected(), "ESPが再起動したら接続が切れるべき"
+    assert await manager.wait_connected(timeout=1.0)
+    await manager.stop()
+    stats = backend.stats()[2]
+    print(stats)
+    assert stats['aborts'] == 1 and stats['connects'] == 2 and manager.stats()[2]['reconnects'] == 1
+    print("✓ 再起動したESPに接続し直すことを確認\n")
+
+
+async def main():
+    test_firmware()
+    await test_chain()
+    await test_notify()
+    await test_abort()
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
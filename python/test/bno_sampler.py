@@ -0,0 +1,133 @@
+"""
+BNOSensorの読み取りスレッドのテスト
+- 設定した回数/秒で読み取り、最新のサンプルをロックを取らずに読めること
+- I2Cのエラーで接続し直し、エラーの回数が数えられること
+- メインループでeuler()を呼ぶ場合と比べた、イベントループが止まる時間と読み取り回数/秒
+BNO055の代わりに、読み取りにI2Cと同じくらいの時間がかかる疑似的なセンサーを使う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import time
+
+from tools.bno import BNOSensor
+
+READ_TIME = 0.004  # I2Cの読み取り時間（クロックストレッチを含む）
+RATE = 100.0
+MAIN_INTERVAL = 0.1
+DURATION = 1.0
+
+
+class FakeBno055:
+    """quaternionの読み取りにREAD_TIME秒かかる疑似BNO055（failsの回数だけ失敗する）"""
+
+    def __init__(self, fails: int = 0):
+        self.reads = 0
+        self.fails = fails
+
+    @property
+    def quaternion(self):
+        time.sleep(READ_TIME)  # I2Cの読み取り中はスレッドが止まる
+        self.reads += 1
+        if self.fails > 0 and self.reads % 10 == 0:
+            self.fails -= 1
+            raise OSError("[Errno 121] Remote I/O error")
+        return (1.0, 0.0, 0.0, 0.0)
+
+
+class FakeSensor(BNOSensor):
+    """connect()で疑似BNO055につなぐBNOSensor"""
+
+    def __init__(self, fails: int = 0, capacity: int = 64):
+        super().__init__(capacity=capacity)
+        self.fake = FakeBno055(fails)
+        self.connects = 0
+
+    def connect(self):
+        self.connects += 1
+        self.sensor = self.fake
+        self.connected = True
+        return True
+
+
+async def run_loop(sensor: BNOSensor, sampled: bool) -> float:
+    """メインループ（MAIN_INTERVALごとに角度を読む）をDURATION秒動かす
+    :return: 角度を読む間イベントループが止まっていた時間の合計（秒）
+    """
+    blocked = 0.0
+    start = time.monotonic()
+    while time.monotonic() - start < DURATION:
+        begin = time.perf_counter()
+        if sampled:
+            sensor.latest()
+        else:
+            sensor.euler()  # 変更前: イベントループでI2Cを読む
+        blocked += time.perf_counter() - begin
+        await asyncio.sleep(MAIN_INTERVAL)
+    return blocked
+
+
+async def test_blocking():
+    print("=== イベントループが止まる時間 ===")
+    sensor = FakeSensor()
+    sensor.connect()
+    old_blocked = await run_loop(sensor, sampled=False)
+    old_reads = sensor.fake.reads
+
+    sensor = FakeSensor()
+    sensor.start_sampler(RATE)
+    await asyncio.sleep(0.05)
+    new_blocked = await run_loop(sensor, sampled=True)
+    sensor.stop_sampler()
+    stats = sensor.stats()
+    print(f"メインループでeuler(): 読み取り {old_reads / DURATION:.0f}回/秒, "
+          f"イベントループが止まった時間 {old_blocked * 1000:.2f}ms/秒")
+    print(f"読み取りスレッド　　 : 読み取り {stats['achieved_rate']:.0f}回/秒, "
+          f"イベントループが止まった時間 {new_blocked * 1000:.2f}ms/秒 (latest())")
+    print(stats)
+    assert new_blocked < old_blocked / 10, "latest()はI2Cの読み取りを待たないべき"
+    assert stats['achieved_rate'] > RATE * 0.8, "設定した回数/秒で読み取るべき"
+    assert abs(stats['read_p50'] - READ_TIME) < 0.003
+    assert stats['i2c_errors'] == 0 and not sensor.is_sampling()
+    print("✓ イベントループを止めずに読み取れることを確認\n")
+
+
+async def test_errors():
+    print("=== I2Cエラーのテスト ===")
+    sensor = FakeSensor(fails=2, capacity=16)
+    assert sensor.latest() is None, "まだサンプルがない"
+    sensor.start_sampler(RATE, reconnect_delay=0.02)
+    await asyncio.sleep(0.5)
+    sensor.stop_sampler()
+    stats = sensor.stats()
+    print(stats)
+    assert stats['i2c_errors'] == 2 and sensor.connects == 3, "エラーのたびに接続し直すべき"
+    seq, sampled_at, angles = sensor.latest()
+    assert seq == stats['samples'] - 1 and angles == (0, 0, 0)
+    assert stats['samples'] > sensor.capacity, "リングバッファを一周しても最新のサンプルを読めるべき"
+    print("✓ エラーの後も読み取りを続けることを確認\n")
+
+
+def test_unavailable():
+    print("=== センサーがない場合 ===")
+    sensor = BNOSensor()
+    sensor.start_sampler(RATE, reconnect_delay=0.05)
+    time.sleep(0.12)
+    sensor.stop_sampler()
+    stats = sensor.stats()
+    print(stats)
+    assert stats['samples'] == 0 and stats['connect_failures'] >= 2 and sensor.latest() is None
+    print("✓ 接続できなくても止まらず再試行することを確認\n")
+
+
+async def main():
+    await test_blocking()
+    await test_errors()
+    test_unavailable()
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
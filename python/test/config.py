@@ -8,15 +8,18 @@ import os
 # testフォルダから親ディレクトリを参照するようにパスを調整
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from tools.tcp import _load_config, create_tcp
+from tools.config import load_config
+from tools.tcp import create_tcp
 
 def test_config_loading():
     """設定ファイル読み込みのテスト"""
     print("=== 設定ファイル読み込みテスト ===")
     
     # 設定を読み込み
-    config = _load_config()
+    config = load_config()
     print(f"読み込まれた設定: {config}")
+    assert load_config('tcp') == config.get('tcp', {}), "項目だけを取り出せるべき"
+    assert load_config('存在しない項目') == {}
     
     # TCP インスタンス作成テスト
     print("\n=== TCP インスタンス作成テスト ===")
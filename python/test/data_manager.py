@@ -0,0 +1,200 @@
+"""
+DataManagerのバージョンと ChangeTracker（変化時 + keepalive のみ送信）のテスト
+PC.main() と同じ100ms周期・3フレームの送信を、スティックがほぼ止まっている操作で再現し、
+毎周期送る場合とフレーム数（BLEの書き込み回数）を比較する
+pack_batch/unpack_batch（複数のDataManagerを1つのフレームにまとめる）のテスト
+受信時刻・番号と get_if_fresh（古い値を使わない）のテスト
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import time
+
+from tools.data_manager import DataManager, DataType, ChangeTracker, BATCH_IDENTIFIER, _BATCH_CACHE_SIZE
+
+MAIN_INTERVAL = 0.1
+KEEPALIVE = 1.0
+TICKS = 600            # 60秒分
+ACTIVE_TICKS = range(100, 130)  # スティックを動かしている区間
+HEADER_SIZE = 5        # TCPのフレームヘッダー（識別子1byte + サイズ4byte）
+BATCH_ITERATIONS = 100000
+
+
+def test_version():
+    """内容が変わったときだけバージョンが増えることを確認"""
+    print("=== バージョンのテスト ===")
+    servo = DataManager(0x12, 12, DataType.UINT8)
+    assert servo.version() == 0
+
+    # PC.pyと同じく、get()のリストを直接書き換えてからupdate()する
+    values = servo.get()
+    values[0] = 90
+    servo.update(values)
+    assert servo.version() == 1, "内容が変われば増えるべき"
+    servo.update(servo.get())
+    assert servo.version() == 1, "同じ内容では増えないべき"
+
+    DataManager.unpack(0x12, bytes([90] + [0] * 11))
+    assert servo.version() == 1, "同じ内容を受信しても増えないべき"
+    DataManager.unpack(0x12, bytes([91] + [0] * 11))
+    assert servo.version() == 2, "違う内容を受信したら増えるべき"
+    received = DataManager.unpack(0x12, bytes([92] + [0] * 11))
+    DataManager.unpack(0x12, bytes([93] + [0] * 11))
+    assert received[0] == 92, "unpackが返したリストは次の受信で書き換わらないべき"
+
+    # バージョンは確認したときの内容で比較する（間に戻った変更は数えない）
+    servo.update([1] * 12)
+    servo.update([93] + [0] * 11)
+    assert servo.version() == 3
+    print("✓ バージョンの確認OK\n")
+
+
+def test_change_tracker():
+    """変化時とkeepalive時だけ送ることを確認"""
+    print("=== ChangeTrackerのテスト ===")
+    batt = DataManager(0x11, 4, DataType.UINT8)
+    legs = DataManager._search(0x12)
+    bldc = DataManager(0x02, 2, DataType.INT8)
+    managers = [batt, legs, bldc]
+
+    tracker = ChangeTracker(KEEPALIVE)
+    assert len(tracker.frames(managers, now=0.0)) == 3, "最初はすべて送るべき"
+    assert tracker.frames(managers, now=0.1) == [], "変化がなければ送らないべき"
+    bldc.update([10, 10])
+    assert tracker.frames(managers, now=0.2) == [(0x02, bldc.pack())], "変化したものだけ送るべき"
+    assert [i for i, _ in tracker.frames(managers, now=1.05)] == [0x11, 0x12], "keepalive経過分は送り直すべき"
+    tracker.reset()
+    assert len(tracker.frames(managers, now=1.1)) == 3, "reset後はすべて送るべき"
+    print("✓ 変化時・keepalive時のみの送信を確認\n")
+
+    # 60秒間の操作を再現
+    print(f"=== 送信フレーム数（{TICKS * MAIN_INTERVAL:.0f}秒, 100ms周期） ===")
+    tracker = ChangeTracker(KEEPALIVE)
+    sent_bytes = 0
+    for tick in range(TICKS):
+        now = tick * MAIN_INTERVAL
+        values = legs.get()
+        if tick in ACTIVE_TICKS:
+            values[6] = 90 + (tick % 10) * 5
+            bldc.update([tick % 100, tick % 100])
+        legs.update(values)
+        for identifier, data in tracker.frames(managers, now):
+            sent_bytes += 5 + len(data)
+    baseline = TICKS * 3
+    baseline_bytes = TICKS * sum(5 + len(m.pack()) for m in managers)
+    print(f"毎周期送信      : {baseline:5d}フレーム {baseline_bytes:6d}バイト")
+    print(f"変化時+keepalive: {tracker.sent:5d}フレーム {sent_bytes:6d}バイト "
+          f"({(1 - tracker.sent / baseline) * 100:.0f}%削減)")
+    assert tracker.sent < baseline * 0.3, "アイドル時の送信がほとんど省かれるべき"
+    print()
+
+
+def test_batch():
+    """複数のDataManagerを1つのフレームにまとめて送れることを確認"""
+    print("=== pack_batch / unpack_batch のテスト ===")
+    batt = DataManager._search(0x11)
+    legs = DataManager._search(0x12)
+    bldc = DataManager._search(0x02)
+    batt.update([10, 20, 30, 40])
+    legs.update(list(range(80, 92)))
+    bldc.update([-100, 100])
+    managers = [batt, legs, bldc]
+    packed = DataManager.pack_batch(managers)
+    assert packed[:4] == bytes([3, 0x11, 0x12, 0x02]), "件数と識別子が先頭に並ぶべき"
+    assert packed[4:] == batt.pack() + legs.pack() + bldc.pack()
+
+    # 受信側: 別の値に書き換えてからまとめたフレームを読む
+    versions = [m.version() for m in managers]
+    batt.update([0] * 4)
+    legs.update([0] * 12)
+    bldc.update([0, 0])
+    assert [m.version() for m in managers] == [v + 1 for v in versions]
+    assert DataManager.unpack_batch(memoryview(packed)) == tuple(managers)
+    assert batt.get() == [10, 20, 30, 40] and legs.get() == list(range(80, 92)) and bldc.get() == [-100, 100]
+    assert [m.version() for m in managers] == [v + 2 for v in versions], "受信した内容でバージョンが増えるべき"
+
+    # ESP2に送るときは識別子を0x01/0x02に変換し、1回の書き込みにまとめる
+    ble = DataManager.pack_batch([legs, bldc], [0x01, 0x02])
+    assert ble == bytes([2, 0x01, 0x02]) + legs.pack() + bldc.pack()
+
+    for bad in (b'', bytes([2, 0x11]), packed[:-1], packed + b'\x00', bytes([1, 0x40, 0])):
+        try:
+            DataManager.unpack_batch(bad)
+            raise AssertionError(f"{bad.hex()} はValueErrorになるべき")
+        except ValueError:
+            pass
+    # 受信したヘッダーの形式は上限までしか覚えない（同じ識別子を並べたヘッダーはいくらでも作れる）
+    for count in range(1, 201):
+        DataManager.unpack_batch(bytes([count]) + bytes([0x11] * count) + batt.pack() * count)
+    assert len(DataManager._batch_unpack_layouts) == _BATCH_CACHE_SIZE
+    assert DataManager.unpack_batch(packed) == tuple(managers), "捨てた形式も計算し直して読めるべき"
+    try:
+        DataManager(BATCH_IDENTIFIER, 1, DataType.UINT8)
+        raise AssertionError("BATCH_IDENTIFIERはDataManagerに使えないべき")
+    except ValueError:
+        pass
+    print("✓ まとめたフレームの確認OK")
+
+    # 1周期あたりのフレーム数・バイト数（すべて変化した場合）
+    separate = sum(HEADER_SIZE + m.size() for m in managers)
+    batched = HEADER_SIZE + len(packed)
+    print(f"別々に送信: 3フレーム {separate}バイト（UDPでは3データグラム, ESP2へは2回の書き込み）")
+    print(f"まとめて送信: 1フレーム {batched}バイト（UDPでは1データグラム, ESP2へは1回の書き込み）")
+    assert batched < separate
+
+    # 受信側の処理時間（2回目以降は計算済みの位置を使う）
+    frames = [(m.identifier(), m.pack()) for m in managers]
+    start = time.perf_counter()
+    for _ in range(BATCH_ITERATIONS):
+        for identifier, data in frames:
+            DataManager.unpack(identifier, data)
+    separate_time = (time.perf_counter() - start) / BATCH_ITERATIONS
+    start = time.perf_counter()
+    for _ in range(BATCH_ITERATIONS):
+        DataManager.unpack_batch(packed)
+    batch_time = (time.perf_counter() - start) / BATCH_ITERATIONS
+    print(f"アンパック: 別々 {separate_time * 1e9:.0f} ns/周期, まとめて {batch_time * 1e9:.0f} ns/周期")
+    print()
+
+
+def test_freshness():
+    """受信時刻と番号が記録され、古い値はget_if_freshで返さないことを確認"""
+    print("=== 受信時刻とget_if_freshのテスト ===")
+    bno = DataManager(0x03, 3, DataType.INT8)
+    assert bno.timestamp() is None and bno.age() is None
+    assert bno.get_if_fresh(0.5) is None, "まだ受け取っていなければ返さないべき"
+
+    bno.unpack_from(bytes([10, 20, 30]), sender_time=123.0)
+    received = bno.timestamp()
+    assert bno.sequence() == 1 and bno.sender_time() == 123.0
+    assert bno.get_if_fresh(0.5, now=received + 0.1) == [10, 20, 30]
+    assert bno.get_if_fresh(0.5, now=received + 5.0) is None, "古い値は返さないべき"
+
+    # 同じ内容を受信してもバージョンは増えないが、番号と時刻は新しくなる
+    bno.unpack_from(bytes([10, 20, 30]))
+    assert bno.sequence() == 2 and bno.version() == 1 and bno.timestamp() >= received
+    assert bno.sender_time() is None
+    DataManager.unpack(0x03, bytes([11, 20, 30]))
+    assert bno.sequence() == 3 and bno.version() == 2
+
+    # まとめたフレームで受け取った場合も記録する
+    legs = DataManager._search(0x12)
+    before = legs.sequence()
+    DataManager.unpack_batch(DataManager.pack_batch([legs, bno]), sender_time=1.0)
+    assert legs.sequence() == before + 1 and legs.sender_time() == 1.0
+
+    stats = bno.stats(now=bno.timestamp() + 0.2)
+    print(f"0x03: {stats}")
+    assert stats['reads'] == 3 and stats['stale'] == 2 and abs(stats['age'] - 0.2) < 1e-9
+    assert abs(stats['mean_age'] - 0.1) < 1e-9 and abs(stats['max_age'] - 0.1) < 1e-9
+    assert 0x03 in DataManager.all_stats() and 0x12 in DataManager.all_stats()
+    print("✓ 受信時刻・番号・統計の確認OK")
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    test_version()
+    test_change_tracker()
+    test_batch()
+    test_freshness()
@@ -0,0 +1,172 @@
+"""
+ロギング（tools/log.py）のテスト
+- カテゴリごとの1秒あたりの件数制限と間引き、捨てた件数が次のメッセージに付くこと
+- 直近のイベントがリングバッファに残り、エラーのときにダンプファイルへ書き出されること
+- 捨てるレコードはメッセージにせず、同じエラーのダンプは間隔をあけること
+- 端末への出力を書き込みスレッドに任せた場合の、ログを出す側の1回あたりの時間
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import io
+import logging
+import tempfile
+import time
+
+from tools.log import LogService, EventRing, RateLimitFilter
+
+ITERATIONS = 20000
+
+
+class SlowStream(io.StringIO):
+    """SSH越しの端末のように書き込みに時間がかかる出力先"""
+
+    def write(self, text):
+        time.sleep(0.0002)
+        return super().write(text)
+
+
+def make_record(name: str, level: int, message: str, created: float) -> logging.LogRecord:
+    record = logging.LogRecord(name, level, __file__, 0, message, None, None)
+    record.created = created
+    return record
+
+
+def test_rate_limit():
+    print("=== 件数制限と間引きのテスト ===")
+    ring = EventRing(64, 64)
+    limit = RateLimitFilter(ring, {'relay': {'rate': 2}, 'servo': {'sample': 5}, 'tcp': {'rate': 0}})
+    # 0.1秒間に100件: 最初の2件のみ通し、1秒以上あとの1件に捨てた件数が付く
+    passed = [limit.filter(make_record('quadken.relay', logging.INFO, f"{i}", 100.0 + i * 0.001))
+              for i in range(100)]
+    assert sum(passed) == 2 and passed[:2] == [True, True], passed[:5]
+    record = make_record('quadken.relay', logging.INFO, "next", 101.5)
+    assert limit.filter(record) and record.suppressed == 98, "捨てた件数は次のメッセージに付くべき"
+
+    # 5件に1件
+    passed = [limit.filter(make_record('quadken.servo', logging.INFO, f"{i}", 0.0)) for i in range(20)]
+    assert passed == [i % 5 == 0 for i in range(20)]
+
+    # tcp.debugはtcpの設定（0件）に従い、エラーはいつも通す
+    assert not limit.filter(make_record('quadken.tcp.debug', logging.INFO, "x", 200.0))
+    error = make_record('quadken.tcp.debug', logging.ERROR, "error", 200.0)
+    assert limit.filter(error) and error.ring, "エラーは制限せず直近のイベントを添付するべき"
+    # 制限のないカテゴリはすべて通す
+    assert all(limit.filter(make_record('quadken.pc', logging.INFO, "x", 0.0)) for _ in range(10))
+    print(f"通した件数: {limit.passed}")
+    print(f"捨てた件数: {limit.suppressed}")
+    assert limit.suppressed == {'relay': 98, 'servo': 16, 'tcp.debug': 1}
+    print("✓ カテゴリごとの制限を確認\n")
+
+
+class Counted:
+    """文字列にした回数を数える引数"""
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "value"
+
+
+def test_dropped():
+    print("=== 捨てるレコードとダンプの間隔のテスト ===")
+    ring = EventRing(64, 64)
+    limit = RateLimitFilter(ring, {'relay': {'rate': 1}}, dump_interval=60.0)
+    argument = Counted()
+    for i in range(10):
+        record = logging.LogRecord('quadken.relay', logging.INFO, __file__, 0, "%s", (argument,), None)
+        record.created = 100.0 + i * 0.01
+        limit.filter(record)
+    assert argument.formatted == 1 and len(ring) == 1, "捨てるレコードはメッセージにせずリングにも残さないべき"
+
+    # 同じエラーが続いても直近のイベントを添付するのはdump_interval秒に1回
+    errors = [make_record('quadken.bno', logging.ERROR, "I2C", 200.0 + i) for i in range(30)]
+    errors.append(make_record('quadken.bno', logging.ERROR, "I2C", 261.0))
+    errors.append(make_record('quadken.bno', logging.ERROR, "別のエラー", 261.0))
+    assert all(limit.filter(error) for error in errors), "エラーは制限せず通すべき"
+    dumped = [hasattr(error, 'ring') for error in errors]
+    assert dumped == [True] + [False] * 29 + [True, True], dumped
+    assert limit.dumps_skipped == 29
+    print(f"✓ 捨てたレコードの整形 {argument.formatted}回, 添付 {sum(dumped)}/{len(errors)}件\n")
+
+
+def test_ring():
+    print("=== リングバッファのテスト ===")
+    ring = EventRing(4, 32)
+    for i in range(6):
+        ring.record(1000.0 + i, logging.INFO, 'bno' if i % 2 else 'relay', f"event {i} " + "x" * 40)
+    events = EventRing.parse(ring.snapshot())
+    assert len(ring) == 4 and [e[0] for e in events] == [1002.0, 1003.0, 1004.0, 1005.0], "古い順に直近4件が残るべき"
+    assert events[0][1:] == ('INFO', 'relay', "event 2 " + "x" * 12), "32バイトの枠に収まるよう切り詰めるべき"
+    assert events[1][2] == 'bno'
+    try:
+        EventRing.parse(bytes(16))
+        assert False, "形式の違うデータは読めないべき"
+    except ValueError:
+        pass
+    print(f"✓ {events}\n")
+
+
+def test_service():
+    print("=== LogServiceのテスト ===")
+    with tempfile.TemporaryDirectory() as directory:
+        stream = io.StringIO()
+        config = {'show_colors': False, 'dump_path': directory, 'categories': {'relay': {'rate': 1}}}
+        service = LogService(config, stream)
+        relay_log = logging.getLogger('quadken.relay')
+        values = [0] * 4
+        for i in range(50):
+            values[0] = i  # 使い回すリストでも記録した時点の値が出力される
+            relay_log.info("values=%s", values)
+        logging.getLogger('quadken.bno').debug("端末には表示しない")
+        logging.getLogger('quadken.bno').error("❌ BNO055センサーエラー: %s", "I2C")
+        service.stop()
+
+        lines = stream.getvalue().splitlines()
+        print('\n'.join(lines))
+        assert lines == ["values=[0, 0, 0, 0]", "❌ BNO055センサーエラー: I2C"], lines
+        stats = service.stats()
+        assert stats['suppressed'] == {'relay': 49} and len(stats['dumps']) == 1
+        with open(stats['dumps'][0], 'rb') as f:
+            events = EventRing.parse(f.read())
+        # ダンプには件数制限で通したものが、端末に表示しなかったものも含めて残る
+        assert len(events) == 3 and events[0][3] == "values=[0, 0, 0, 0]"
+        assert events[1][1:] == ('DEBUG', 'bno', "端末には表示しない")
+        assert events[-1][1] == 'ERROR'
+        print(f"✓ ダンプ {os.path.basename(stats['dumps'][0])}: {len(events)}件\n")
+
+
+def bench():
+    print("=== ログを出す側の時間 ===")
+    stream = SlowStream()
+    start = time.perf_counter()
+    for i in range(200):
+        print(f"θ: {i}° φ: {i}° twist: {i}°", file=stream)
+    print_time = (time.perf_counter() - start) / 200
+
+    service = LogService({'dump_path': tempfile.gettempdir(), 'categories': {'bno': {'rate': 2}}}, SlowStream())
+    bno_log = logging.getLogger('quadken.bno')
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        bno_log.info("θ: %s° φ: %s° twist: %s°", i, i, i)
+    log_time = (time.perf_counter() - start) / ITERATIONS
+    service.stop()
+    print(f"print（遅い端末）: {print_time * 1e6:7.1f} µs/回")
+    print(f"ロガー（件数制限）: {log_time * 1e6:7.1f} µs/回 ({service.stats()['suppressed']['bno']}件省略)")
+    assert log_time < print_time, "ログを出す側は端末への書き込みを待たないべき"
+
+
+def main():
+    test_rate_limit()
+    test_dropped()
+    test_ring()
+    test_service()
+    bench()
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+protocol.yaml（通信プロトコルのスキーマ）のテスト
+- ESP32のソース（src/batt/ESP1.cpp, src/legs/ESP2.cpp）のDataManager<T>の宣言がスキーマと一致すること
+  （どちらかだけを変更するとこのテストが失敗する）
+- config.yamlの操縦用の識別子がスキーマのPCから送るメッセージと一致すること
+- 中継表で識別子から中継先を引けること
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import time
+import yaml
+
+from tools.protocol import Protocol
+from tools.data_manager import BATCH_IDENTIFIER
+
+ITERATIONS = 100000
+
+
+def test_firmware(protocol: Protocol):
+    """ESP32のソースとのずれを確認"""
+    print("=== ESP32のソースとの比較 ===")
+    problems = []
+    for link in protocol.links:
+        found = protocol.check_firmware(link)
+        print(f"{'✓' if not found else '❌'} {link} ({protocol.firmware_path(link)})")
+        problems += found
+    for problem in problems:
+        print(f"\033[91m   {problem}\033[0m")
+    assert not problems, "ESP32のソースとprotocol.yamlがずれています（python -m tools.protocol で宣言を表示できます）"
+
+    # ずれを見つけられることを確認
+    with open(protocol.firmware_path('ESP2'), 'r', encoding='utf-8') as f:
+        source = f.read()
+    changed = source.replace("servo_data(1, 12)", "servo_data(1, 11)")
+    assert changed != source
+    assert len(protocol.check_firmware('ESP2', changed)) == 1, "長さの違いを見つけるべき"
+    assert protocol.check_firmware('ESP2', source + "\nDataManager<int16_t> extra_data(9, 1);\n"), \
+        "スキーマにない宣言を見つけるべき"
+    assert protocol.check_firmware('ESP2', source.replace("DataManager<int8_t> bldc_data", "// ")), \
+        "宣言がないことを見つけるべき"
+    print("✓ ずれの検出OK\n")
+
+
+def test_config(protocol: Protocol):
+    """config.yamlの操縦用の識別子と比較"""
+    print("=== config.yamlとの比較 ===")
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.yaml')
+    with open(path, 'r', encoding='utf-8') as f:
+        config_data = yaml.safe_load(f)
+    control = config_data['tcp']['server']['control_identifiers']
+    assert sorted(control) == sorted(protocol.identifiers('PC') + [BATCH_IDENTIFIER]), \
+        "tcp.server.control_identifiersはPCから送るメッセージの識別子（とまとめたフレーム）と一致するべき"
+    print(f"✓ 操縦用の識別子: {[f'0x{i:02X}' for i in control]}\n")
+
+
+def test_routes(protocol: Protocol):
+    """中継表の確認"""
+    print("=== 中継表のテスト ===")
+    data = protocol.build()
+    assert protocol.build() is data, "DataManagerは一度だけ作るべき"
+    assert protocol.route(0x11).targets == [(1, 0x01)]
+    assert protocol.route(0x12).targets == [(2, 0x01)]
+    assert protocol.route(0x02).targets == [(2, 0x02)]
+    assert protocol.route(0xFF).targets == [], "configはRaspが解釈するので中継しない"
+    assert protocol.route(0x03).targets == []
+    assert protocol.route(0x12).manager is data['legs_servo']
+    assert protocol.route(0x40) is None
+    assert protocol.batch_devices() == {2}, "ESP2だけがまとめたフレームを受け取れる"
+    assert protocol.validate(0x12, 12) and not protocol.validate(0x12, 11) and not protocol.validate(0x40, 1)
+    for identifier in range(256):
+        route = protocol.route(identifier)
+        if route:
+            print(f"0x{identifier:02X}: {route}")
+
+    # 従来のif/elifの分岐と、表を引く時間を比較
+    identifiers = [0x11, 0x12, 0x02] * (ITERATIONS // 3)
+    start = time.perf_counter()
+    for identifier in identifiers:
+        if identifier == 0x11:
+            target = (1, 0x01)
+        elif identifier == 0x12:
+            target = (2, 0x01)
+        elif identifier == 0x02:
+            target = (2, 0x02)
+    chain_time = (time.perf_counter() - start) / len(identifiers)
+    route = protocol.route
+    start = time.perf_counter()
+    for identifier in identifiers:
+        target = route(identifier).targets
+    table_time = (time.perf_counter() - start) / len(identifiers)
+    print(f"if/elif: {chain_time * 1e9:.0f} ns/回, 中継表: {table_time * 1e9:.0f} ns/回（メッセージが増えても一定）")
+    print("✓ 中継表の確認OK\n")
+
+
+def test_invalid():
+    """不正なスキーマを読み込み時に見つけることを確認"""
+    print("=== 不正なスキーマのテスト ===")
+    import tempfile
+    base = {'links': {'ESP1': {'device': 1, 'firmware': 'ESP1.cpp'}},
+            'messages': {'a': {'identifier': 0x11, 'type': 'UINT8', 'length': 1, 'source': 'PC',
+                               'destination': ['ESP1'], 'firmware': 'a_data'}}}
+    cases = {
+        "識別子の重複": {'b': {'identifier': 0x11, 'type': 'UINT8', 'length': 1, 'source': 'PC', 'destination': ['Rasp']}},
+        "予約済みの識別子": {'b': {'identifier': 0xFD, 'type': 'UINT8', 'length': 1, 'source': 'PC', 'destination': ['Rasp']}},
+        "BLEでの識別子の重複": {'b': {'identifier': 0x12, 'type': 'UINT8', 'length': 1, 'source': 'PC',
+                                    'destination': ['ESP1'], 'ble_identifier': 0x11, 'firmware': 'b_data'}},
+        "不明な型": {'b': {'identifier': 0x12, 'type': 'FLOAT', 'length': 1, 'source': 'PC', 'destination': ['Rasp']}},
+        "ESPからのfirmwareなし": {'b': {'identifier': 0x12, 'type': 'UINT8', 'length': 1, 'source': 'ESP1',
+                                      'destination': ['PC']}},
+        "不明な送信先": {'b': {'identifier': 0x12, 'type': 'UINT8', 'length': 1, 'source': 'PC', 'destination': ['ESP9']}},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'protocol.yaml')
+        for name, extra in cases.items():
+            schema = {'links': base['links'], 'messages': {**base['messages'], **extra}}
+            with open(path, 'w', encoding='utf-8') as f:
+                yaml.safe_dump(schema, f)
+            try:
+                Protocol(path)
+                raise AssertionError(f"{name} はValueErrorになるべき")
+            except ValueError as e:
+                print(f"✓ {name}: {e}")
+    print()
+
+
+if __name__ == "__main__":
+    protocol = Protocol()
+    print(f"{protocol}\n")
+    test_firmware(protocol)
+    test_config(protocol)
+    test_routes(protocol)
+    test_invalid()
+    print("テスト完了")
@@ -42,7 +42,18 @@ def main():
     # テストファイルのリスト
     test_files = [
         "debug.py",
-        "integration.py"
+        "integration.py",
+        "bench_send.py",
+        "bench_receive.py",
+        "bench_priority.py",
+        "latest_sender.py",
+        "bench_udp.py",
+        "udp_control.py",
+        "multi_client.py",
+        "reconnect.py",
+        "heartbeat.py",
+        "record_replay.py",
+        "bench_framing.py",
     ]
     
     results = []
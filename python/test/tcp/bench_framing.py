@@ -0,0 +1,242 @@
+"""
+フレーム形式v2（varintのサイズ + シーケンス番号）のテストとベンチマーク
+- 新しいTcp同士は接続直後の通知でv2に切り替わり、小さなフレームからチャンク分割した画像まで届くこと
+- v1しか知らない相手（旧実装）とはv1のまま送受信できること
+- シーケンス番号から欠落・入れ替わりが数えられること
+- 従来の5byteヘッダーとv2のヘッダーの作成・解析のスループットとバイト数の比較
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import struct
+import time
+from tools.tcp import Tcp, FrameProtocol, FRAMING_V1, FRAMING_V2
+
+HOST = '127.0.0.1'
+PORT = 50115
+
+HEADER = struct.Struct('>BI')
+# v1の相手から届く切り替えの通知（0xFFの1byteの値）
+SWITCH_V2 = HEADER.pack(0xFF, 1) + bytes([0xC0 | FRAMING_V2])
+
+# 1tickの制御・センサーフレーム（ESP1サーボ, ESP2サーボ, BLDC, BNO）
+CONTROL_FRAMES = [(0x11, bytes(4)), (0x12, bytes(12)), (0x02, bytes(2)), (0x03, bytes(3))]
+TICKS = 20000
+ITERATIONS = 200000
+SIZES = [0, 1, 127, 128, 16383, 16384, 100000]
+
+
+def feed(protocol: FrameProtocol, stream: bytes, step: int = 1 << 16):
+    """stepバイトずつプロトコルへデータを流し込む"""
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(stream):
+        buffer = protocol.get_buffer(-1)
+        n = min(len(buffer), step, len(stream) - offset)
+        buffer[:n] = view[offset:offset + n]
+        protocol.buffer_updated(n)
+        offset += n
+
+
+def build_v2(frames, seqs=None) -> bytes:
+    """v2のストリームを作る（seqsを指定した場合はそのシーケンス番号を付ける）"""
+    encoder = FrameProtocol(version=FRAMING_V2)
+    stream = bytearray()
+    for index, (identifier, data) in enumerate(frames):
+        if seqs is not None:
+            encoder._send_seq = seqs[index]
+        stream += encoder._v2_header(identifier, len(data)) + data
+    return bytes(stream)
+
+
+async def test_varint():
+    print("=== v2のヘッダーのテスト ===")
+    frames = [(0x40 + i, bytes(range(256)) * (size // 256) + bytes(size % 256)) for i, size in enumerate(SIZES)]
+    stream = build_v2(frames)
+    for step in (1, 7, 1 << 16):
+        protocol = FrameProtocol(version=FRAMING_V2)
+        feed(protocol, SWITCH_V2 + stream, step)
+        received = [await protocol.receive() for _ in frames]
+        assert received == [(i, len(d), d) for i, d in frames], f"{step}バイトずつ受信しても同じフレームになるべき"
+        assert protocol.receive_version == FRAMING_V2 and protocol.lost == 0
+    encoder = FrameProtocol(version=FRAMING_V2)
+    for size in SIZES:
+        print(f"サイズ {size:6d}: v1 {HEADER.size}byte, v2 {len(encoder._v2_header(0x00, size))}byte")
+    print("✓ 1byteずつ届いても解析できることを確認\n")
+
+
+async def test_sequence():
+    print("=== シーケンス番号のテスト ===")
+    # 1〜3が欠落したあと1が遅れて届き、その後は255から0に周回する
+    seqs = [0, 4, 1] + list(range(5, 256)) + [0, 1]
+    frames = [(0x11, bytes(4))] * len(seqs)
+    stream = build_v2(frames, seqs=seqs)
+    protocol = FrameProtocol(version=FRAMING_V2)
+    feed(protocol, SWITCH_V2 + stream)
+    stats = protocol.framing_stats()
+    print(stats)
+    assert stats['received'] == len(seqs)
+    assert stats['gaps'] == 1 and stats['lost'] == 3, "4で1〜3の欠落として数えられるべき"
+    assert stats['reordered'] == 1, "遅れて届いた1が入れ替わりとして数えられるべき"
+    assert len(protocol._frames) == len(seqs), "欠落・入れ替わりがあってもフレームは渡すべき"
+    print("✓ 欠落・入れ替わり・周回を確認\n")
+
+
+async def test_negotiation():
+    print("=== 新しいTcp同士のテスト ===")
+    frames = []
+    sessions = []
+    big = bytes(range(256)) * 400
+    scheduler_config = {'chunk_size': 8192}
+    heartbeat_config = {'interval': 0.02}
+    server_tcp = Tcp(HOST, PORT, scheduler_config=scheduler_config, heartbeat_config=heartbeat_config,
+                     framing_config={'version': FRAMING_V2})
+
+    async def handle_client(session):
+        sessions.append(session)
+        async for identifier, size, data in session.frames():
+            frames.append((identifier, data))
+
+    server, _ = await server_tcp.start_server(handle_client)
+    client = Tcp(HOST, PORT, scheduler_config=scheduler_config, heartbeat_config=heartbeat_config,
+                 framing_config={'version': FRAMING_V2})
+    await client.connect()
+    # 切り替え前に送ったフレームも順番通りに届く
+    sent = [(0x11, bytes([i, 0, 0, 0])) for i in range(5)] + [(0x00, big), (0x12, bytes(12)), (0xFF, bytes([2]))]
+    for identifier, data in sent:
+        await client.send(identifier, data)
+    await asyncio.sleep(0.1)
+    # 分割するフレームを含むまとめた送信でも、シーケンス番号は飛ばない
+    mixed = [(0x11, bytes([9, 0, 0, 0])), (0x00, big), (0x12, bytes([1] * 12))]
+    await client.send_many(mixed)
+    sent += mixed
+    await asyncio.sleep(0.2)
+    assert frames == sent, "切り替えの前後ですべてのフレームが順番通りに届くべき"
+    server_protocol = sessions[0].protocol
+    for protocol in (client.protocol, server_protocol):
+        stats = protocol.framing_stats()
+        print(stats)
+        assert stats['send_version'] == stats['receive_version'] == FRAMING_V2
+        assert stats['lost'] == stats['reordered'] == 0
+    assert client.heartbeat.stats()['received'] > 0, "ping/pongもv2で届くべき"
+    print("✓ v2に切り替わり、通知は受信キューに入らないことを確認")
+
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    await server_tcp.close()
+    print()
+
+
+async def test_old_peer():
+    print("=== v1しか知らない相手とのテスト ===")
+    received = []
+
+    async def old_server(reader, writer):
+        # 旧実装のサーバー（5byteヘッダーのみ）
+        for _ in range(2):
+            header = await reader.readexactly(HEADER.size)
+            identifier, size = HEADER.unpack(header)
+            received.append((identifier, await reader.readexactly(size)))
+        writer.write(HEADER.pack(0x03, 3) + bytes([1, 2, 3]))
+        await writer.drain()
+
+    server = await asyncio.start_server(old_server, HOST, PORT)
+    client = Tcp(HOST, PORT, scheduler_config={}, heartbeat_config={'enabled': False},
+                 framing_config={'version': FRAMING_V2})
+    await client.connect()
+    await client.send(0x11, bytes(4))
+    assert await client.receive() == (0x03, 3, bytes([1, 2, 3]))
+    assert received == [(0xFF, bytes([0x80 | FRAMING_V2])), (0x11, bytes(4))], \
+        "旧実装には1byteの設定値として通知が届き、その後もv1で届くべき"
+    assert client.protocol.send_version == FRAMING_V1 and client.protocol.peer_version is None
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    print("✓ 旧実装のサーバーとv1のまま送受信できることを確認")
+
+    # 旧実装のクライアント
+    frames = []
+    server_tcp = Tcp(HOST, PORT, scheduler_config={}, heartbeat_config={'enabled': False},
+                     framing_config={'version': FRAMING_V2})
+
+    async def handle_client(session):
+        async for identifier, size, data in session.frames():
+            frames.append((identifier, data))
+            await session.send(0x03, bytes([4, 5, 6]))
+
+    server, _ = await server_tcp.start_server(handle_client)
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    writer.write(HEADER.pack(0x12, 12) + bytes(12))
+    replies = []
+    for _ in range(2):
+        identifier, size = HEADER.unpack(await reader.readexactly(HEADER.size))
+        replies.append((identifier, await reader.readexactly(size)))
+    assert replies == [(0xFF, bytes([0x80 | FRAMING_V2])), (0x03, bytes([4, 5, 6]))]
+    assert frames == [(0x12, bytes(12))]
+    writer.close()
+    server.close()
+    await server.wait_closed()
+    await server_tcp.close()
+    print("✓ 旧実装のクライアントとv1のまま送受信できることを確認\n")
+
+
+def bench_encode():
+    print("--- ヘッダーの作成 ---")
+    encoder = FrameProtocol(version=FRAMING_V2)
+    for size in (4, 40 * 1024):
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            HEADER.pack(0x11, size)
+        v1_time = (time.perf_counter() - start) / ITERATIONS
+        v2_header = encoder._v2_header
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            v2_header(0x11, size)
+        v2_time = (time.perf_counter() - start) / ITERATIONS
+        print(f"{size:6d}byte: v1 {v1_time * 1e9:5.0f} ns/回, v2 {v2_time * 1e9:5.0f} ns/回")
+
+
+def bench_decode():
+    print("--- 解析（制御・センサーフレームのみ） ---")
+    frames = CONTROL_FRAMES * TICKS
+    v1_stream = b''.join(HEADER.pack(identifier, len(data)) + data for identifier, data in frames)
+    v2_stream = build_v2(frames)
+    count = [0]
+
+    def handler(identifier, data):
+        count[0] += 1
+
+    handlers = [handler] * 256
+    results = {}
+    for name, stream in (("v1", v1_stream), ("v2", SWITCH_V2 + v2_stream)):
+        protocol = FrameProtocol(handlers, version=FRAMING_V2)
+        count[0] = 0
+        start = time.perf_counter()
+        feed(protocol, stream)
+        rate = len(frames) / (time.perf_counter() - start)
+        assert count[0] == len(frames), f"フレーム数が一致しません: {count[0]} != {len(frames)}"
+        results[name] = len(stream) / len(frames)
+        print(f"{name}: {rate:10.0f} frames/s, {len(stream) / len(frames):5.2f} B/frame")
+    payload = sum(len(data) for _, data in CONTROL_FRAMES) / len(CONTROL_FRAMES)
+    print(f"1tickあたり: v1 {results['v1'] * 4:.0f}B -> v2 {results['v2'] * 4:.0f}B "
+          f"（データ {payload * 4:.0f}B, ヘッダーの割合 {(results['v1'] - payload) / payload:.0%} -> "
+          f"{(results['v2'] - payload) / payload:.0%}）")
+    assert results['v2'] < results['v1']
+
+
+async def main():
+    await test_varint()
+    await test_sequence()
+    await test_negotiation()
+    await test_old_peer()
+    print("=== ベンチマーク ===")
+    bench_encode()
+    bench_decode()
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
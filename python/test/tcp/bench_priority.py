@@ -0,0 +1,127 @@
+"""
+送信スケジューラーのベンチマーク
+カメラ画像を全力で送り続けている最中の制御フレーム(0x11)の遅延を計測する
+帯域制限プロキシ（Wi-Fi相当）を挟み、優先度・分割なしの場合と比較する
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import socket
+import struct
+import time
+from tools.tcp import Tcp
+
+HOST = '127.0.0.1'
+SERVER_PORT = 50103
+PROXY_PORT = 50104
+
+BANDWIDTH = 2 * 1024 * 1024  # 帯域制限（バイト/秒）
+PROXY_RCVBUF = 65536
+JPEG_SIZE = 60 * 1024
+CONTROL_INTERVAL = 0.02
+DURATION = 3.0
+
+FIFO_CONFIG = {}
+PRIORITY_CONFIG = {
+    'chunk_size': 8192,
+    'send_buffer': 32768,
+    'default_priority': 1,
+    'priority': {0x11: 0, 0x00: 2},
+}
+
+_TIMESTAMP = struct.Struct('<d')
+
+
+async def throttle_proxy(client_reader, client_writer):
+    """帯域を制限してサーバーへ転送するプロキシ"""
+    reader, writer = await asyncio.open_connection(HOST, SERVER_PORT)
+    loop = asyncio.get_running_loop()
+    release = loop.time()
+    try:
+        while True:
+            data = await client_reader.read(4096)
+            if not data:
+                break
+            # 転送可能になる時刻まで待つ（トークンバケット）
+            release = max(release, loop.time()) + len(data) / BANDWIDTH
+            delay = release - loop.time()
+            if delay > 0.002:
+                await asyncio.sleep(delay)
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+        client_writer.close()
+
+
+async def run(config: dict):
+    """1つの設定で計測する"""
+    latencies = []
+    images = [0]
+
+    server_tcp = Tcp(HOST, SERVER_PORT, scheduler_config={})
+    server_tcp.on(0x11, lambda i, d: latencies.append(time.perf_counter() - _TIMESTAMP.unpack(d)[0]))
+    server_tcp.on(0x00, lambda i, d: images.__setitem__(0, images[0] + 1))
+    closed = asyncio.Event()
+
+    async def handle_client(session):
+        await session.wait_closed()
+        closed.set()
+
+    server, _ = await server_tcp.start_server(handle_client)
+    # プロキシの受信バッファを小さくし、送信側に滞留が起きるようにする（Wi-Fiのボトルネック相当）
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, PROXY_RCVBUF)
+    sock.bind((HOST, PROXY_PORT))
+    proxy = await asyncio.start_server(throttle_proxy, sock=sock, limit=4096)
+
+    client = Tcp(HOST, PROXY_PORT, scheduler_config=config)
+    await client.connect()
+    jpeg = bytes(JPEG_SIZE)
+    end = time.perf_counter() + DURATION
+
+    async def camera():
+        while time.perf_counter() < end:
+            await client.send(0x00, jpeg)
+
+    async def control():
+        while time.perf_counter() < end:
+            await client.send(0x11, _TIMESTAMP.pack(time.perf_counter()))
+            await asyncio.sleep(CONTROL_INTERVAL)
+
+    await asyncio.gather(camera(), control())
+    await asyncio.sleep(1.0)  # 送信済みデータの到着を待つ
+    await client.close()
+    await asyncio.wait_for(closed.wait(), 5)
+
+    proxy.close()
+    server.close()
+    await asyncio.gather(proxy.wait_closed(), server.wait_closed())
+    return sorted(latencies), images[0]
+
+
+def report(label: str, latencies: list, images: int):
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print(f"{label}: 制御 {len(latencies):4d}件 p50 {percentile(0.5):7.1f}ms "
+          f"p99 {percentile(0.99):7.1f}ms max {latencies[-1] * 1000:7.1f}ms / 画像 {images}枚")
+
+
+async def main():
+    print(f"=== 制御フレーム遅延（カメラ全力送信中, 帯域 {BANDWIDTH // 1024}KB/s） ===\n")
+    fifo, fifo_images = await run(FIFO_CONFIG)
+    report("FIFO（従来）      ", fifo, fifo_images)
+    prio, prio_images = await run(PRIORITY_CONFIG)
+    report("優先度 + チャンク ", prio, prio_images)
+    assert prio_images > 0, "画像は分割されても組み立てられて届くべき"
+    assert prio[len(prio) // 2] < fifo[len(fifo) // 2], "優先度ありの方が遅延が小さいべき"
+    print("\nベンチマーク完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,184 @@
+"""
+Tcp 受信ベンチマーク
+旧実装（readexactly 2回/フレーム）と FrameProtocol（1回の受信で複数フレームを解析）を比較する
+PC側と同じく大きなJPEGフレームと小さなBNOフレーム(0x03)が混在するストリームを使う
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import struct
+import time
+import tracemalloc
+from tools.tcp import Tcp, FrameProtocol
+
+HOST = '127.0.0.1'
+PORT = 50102
+
+JPEG_SIZE = 40 * 1024
+BNO_PER_JPEG = 5
+TICKS = 300
+CHUNK = 1 << 16
+
+
+def build_stream() -> bytes:
+    """JPEG1枚とBNOフレーム数個を1tickとしたストリームを作る"""
+    tick = bytearray()
+    tick += struct.pack('>BI', 0x00, JPEG_SIZE) + bytes(JPEG_SIZE)
+    for _ in range(BNO_PER_JPEG):
+        tick += struct.pack('>BI', 0x03, 3) + bytes([1, 2, 3])
+    return bytes(tick) * TICKS
+
+
+FRAMES = TICKS * (1 + BNO_PER_JPEG)
+
+
+async def legacy_receive(reader: asyncio.StreamReader):
+    """変更前のTcp.receive"""
+    header_byte = await reader.readexactly(5)
+    identifier = struct.unpack('B', header_byte[0:1])[0]
+    size = struct.unpack('>I', header_byte[1:5])[0]
+    data = await reader.readexactly(size)
+    return identifier, size, data
+
+
+async def parse_legacy(stream: bytes):
+    """旧実装の解析のみを計測（フレームあたりの確保バイト数）"""
+    reader = asyncio.StreamReader(limit=1 << 24)
+    reader.feed_data(stream)
+    reader.feed_eof()
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        await legacy_receive(reader)
+    rate = FRAMES / (time.perf_counter() - start)
+
+    reader = asyncio.StreamReader(limit=1 << 24)
+    reader.feed_data(stream)
+    reader.feed_eof()
+    total = 0
+    tracemalloc.start()
+    for _ in range(FRAMES):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        await legacy_receive(reader)
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - base
+    tracemalloc.stop()
+    return rate, total / FRAMES
+
+
+def feed(protocol: FrameProtocol, stream: bytes, measure: bool = False) -> int:
+    """CHUNKごとにプロトコルへデータを流し込む"""
+    total = 0
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(stream):
+        buffer = protocol.get_buffer(-1)
+        n = min(len(buffer), CHUNK, len(stream) - offset)
+        buffer[:n] = view[offset:offset + n]
+        if measure:
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+        protocol.buffer_updated(n)
+        if measure:
+            _, peak = tracemalloc.get_traced_memory()
+            total += peak - base
+        offset += n
+    return total
+
+
+async def parse_protocol(stream: bytes):
+    """FrameProtocolの解析のみを計測"""
+    count = [0]
+
+    def handler(identifier, data):
+        count[0] += 1
+
+    handlers = [handler] * 256
+    protocol = FrameProtocol(handlers)
+    start = time.perf_counter()
+    feed(protocol, stream)
+    rate = FRAMES / (time.perf_counter() - start)
+    assert count[0] == FRAMES, f"フレーム数が一致しません: {count[0]} != {FRAMES}"
+
+    protocol = FrameProtocol(handlers)
+    tracemalloc.start()
+    total = feed(protocol, stream, measure=True)
+    tracemalloc.stop()
+    return rate, total / FRAMES
+
+
+async def loopback(stream: bytes):
+    """ループバック接続で frames/s を計測"""
+    async def send_stream(reader, writer):
+        writer.write(stream)
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(send_stream, HOST, PORT)
+
+    # 旧実装
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        await legacy_receive(reader)
+    legacy_rate = FRAMES / (time.perf_counter() - start)
+    writer.close()
+
+    # 新実装（ハンドラー）
+    tcp = Tcp(HOST, PORT)
+    count = [0]
+    for identifier in (0x00, 0x03):
+        tcp.on(identifier, lambda i, d: count.__setitem__(0, count[0] + 1))
+    start = time.perf_counter()
+    await tcp.connect()
+    await tcp.protocol.wait_closed()
+    new_rate = FRAMES / (time.perf_counter() - start)
+    assert count[0] == FRAMES, f"フレーム数が一致しません: {count[0]} != {FRAMES}"
+    await tcp.close()
+
+    server.close()
+    await server.wait_closed()
+    return legacy_rate, new_rate
+
+
+async def test_receive_queue():
+    """ハンドラー未登録のフレームがreceive()で取り出せることを確認"""
+    protocol = FrameProtocol()
+    stream = struct.pack('>BI', 0x11, 4) + bytes([1, 2, 3, 4]) + struct.pack('>BI', 0x02, 2)
+    feed(protocol, stream)
+    feed(protocol, bytes([5, 6]))  # フレームの途中で分割された場合
+    assert await protocol.receive() == (0x11, 4, bytes([1, 2, 3, 4]))
+    assert await protocol.receive() == (0x02, 2, bytes([5, 6]))
+    protocol.connection_lost(None)
+    try:
+        await protocol.receive()
+        assert False, "切断後はEOFErrorになるべき"
+    except EOFError:
+        pass
+    print("✓ 受信キュー・分割フレームの確認OK\n")
+
+
+async def main():
+    await test_receive_queue()
+
+    stream = build_stream()
+    print(f"=== 受信ベンチマーク ({FRAMES}フレーム, {len(stream) // 1024}KB) ===\n")
+
+    legacy_rate, legacy_alloc = await parse_legacy(stream)
+    new_rate, new_alloc = await parse_protocol(stream)
+    print("--- 解析のみ ---")
+    print(f"旧 readexactly: {legacy_rate:10.0f} frames/s, 確保 {legacy_alloc:8.0f} B/frame")
+    print(f"FrameProtocol : {new_rate:10.0f} frames/s, 確保 {new_alloc:8.0f} B/frame")
+    assert new_alloc < legacy_alloc, "FrameProtocolの方が確保量が少ないべき"
+
+    legacy_rate, new_rate = await loopback(stream)
+    print("\n--- ループバック ---")
+    print(f"旧 readexactly: {legacy_rate:10.0f} frames/s")
+    print(f"FrameProtocol : {new_rate:10.0f} frames/s")
+    print("\nベンチマーク完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""
+Tcp.send マイクロベンチマーク
+旧実装（header + data の連結）と新実装（ヘッダーとデータを1回で書き込む / send_many）を比較する
+3.11以前はどちらも連結のコピーがあるため、大きなデータの確保バイト数は同程度になる
+ループバック接続で msgs/s と 1メッセージあたりの確保バイト数（コピー量）を計測
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import struct
+import time
+import tracemalloc
+from tools.tcp import Tcp
+
+HOST = '127.0.0.1'
+PORT = 50101
+
+# (名前, ペイロード, 送信回数)
+CASES = [
+    ("サーボ (12B)", bytes(12), 20000),
+    ("カメラ (40KB)", bytes(40 * 1024), 2000),
+]
+
+
+async def legacy_send(tcp: Tcp, identifier: int, data: bytes):
+    """変更前のTcp.send"""
+    size = len(data)
+    header = struct.pack('B', identifier) + struct.pack('>I', size)
+    tcp.transport.write(header + data)
+    await tcp.protocol.drain()
+
+
+async def drain_server(reader, writer):
+    """受信側：読み捨てるだけ"""
+    while await reader.read(1 << 20):
+        pass
+    writer.close()
+
+
+async def measure_rate(send, count: int) -> float:
+    """msgs/sを計測する"""
+    start = time.perf_counter()
+    for _ in range(count):
+        await send()
+    return count / (time.perf_counter() - start)
+
+
+async def measure_copy(send, count: int = 200) -> float:
+    """1メッセージあたりの一時確保バイト数を計測する"""
+    total = 0
+    tracemalloc.start()
+    for _ in range(count):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        await send()
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - base
+    tracemalloc.stop()
+    return total / count
+
+
+async def main():
+    server = await asyncio.start_server(drain_server, HOST, PORT)
+    tcp = Tcp(HOST, PORT, scheduler_config={})  # 分割なしで送信パスのみを比較
+    await tcp.connect()
+
+    print("=== Tcp.send ベンチマーク ===\n")
+    for name, payload, count in CASES:
+        senders = {
+            "旧 send": lambda: legacy_send(tcp, 0x12, payload),
+            "新 send": lambda: tcp.send(0x12, payload),
+        }
+        print(f"--- {name} ---")
+        for label, send in senders.items():
+            rate = await measure_rate(send, count)
+            copied = await measure_copy(send)
+            print(f"{label}: {rate:10.0f} msgs/s, 確保 {copied:8.0f} B/msg")
+        print()
+
+    # 制御フレーム3個: gather(send×3) と send_many の比較
+    frames = [(0x11, bytes(4)), (0x12, bytes(12)), (0x02, bytes(2))]
+    print("--- 制御フレーム3個/tick ---")
+    gather_rate = await measure_rate(
+        lambda: asyncio.gather(*(legacy_send(tcp, i, d) for i, d in frames)), 5000)
+    many_rate = await measure_rate(lambda: tcp.send_many(frames), 5000)
+    print(f"gather×3 : {gather_rate * 3:10.0f} msgs/s")
+    print(f"send_many: {many_rate * 3:10.0f} msgs/s")
+
+    await tcp.close()
+    await asyncio.sleep(0.1)  # 受信側の終了を待つ
+    server.close()
+    await server.wait_closed()
+    print("\nベンチマーク完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
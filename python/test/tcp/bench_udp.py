@@ -0,0 +1,178 @@
+"""
+UDP制御チャネルのベンチマーク
+擬似的なパケットロス（netemを使わないローカルの損失注入プロキシ）の下で、
+制御フレームをTCPで送る場合とUDP（シーケンス番号 + 重複送信）で送る場合の遅延を比較する
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import random
+import struct
+import time
+from tools.tcp import Tcp, UdpTcp
+
+HOST = '127.0.0.1'
+SERVER_PORT = 50106
+SERVER_UDP_PORT = 50107
+PROXY_PORT = 50108
+PROXY_UDP_PORT = 50109
+
+LOSS = 0.05         # パケットロス率
+RTO = 0.2           # TCPの再送タイムアウト（Linuxの最小値相当）
+INTERVAL = 0.01     # 制御フレームの送信間隔
+DURATION = 3.0
+
+_TIMESTAMP = struct.Struct('<d')
+
+
+class LossInjector:
+    """損失注入器
+    UDPは確率的にデータグラムを捨て、TCPは確率的に再送待ち（RTO）を発生させて後続も待たせる
+    """
+
+    def __init__(self, loss: float, rto: float, seed: int = 1):
+        self.loss = loss
+        self.rto = rto
+        self.random = random.Random(seed)
+        self.dropped = 0
+
+    def drop(self) -> bool:
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    async def tcp_proxy(self, client_reader, client_writer):
+        """TCP: 失われたセグメントは再送されるまで後続も含めて届かない"""
+        reader, writer = await asyncio.open_connection(HOST, SERVER_PORT)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def forward():
+            while True:
+                release, data = await queue.get()
+                if data is None:
+                    break
+                delay = release - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+
+        forward_task = asyncio.create_task(forward())
+        release = loop.time()
+        while True:
+            data = await client_reader.read(4096)
+            if not data:
+                break
+            release = max(release, loop.time() + (self.rto if self.drop() else 0))
+            queue.put_nowait((release, data))
+        queue.put_nowait((0, None))
+        await forward_task
+        writer.close()
+        client_writer.close()
+
+    def udp_proxy(self, target):
+        """UDP: 失われたデータグラムはそのまま届かない"""
+        injector = self
+
+        class Relay(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, addr):
+                if not injector.drop():
+                    self.transport.sendto(data, target)
+
+        return Relay()
+
+
+async def run(use_udp: bool):
+    """1つの方式で計測する"""
+    latencies = []
+    latest = [None]
+
+    def handler(identifier, data):
+        sent = _TIMESTAMP.unpack(data)[0]
+        latencies.append(time.perf_counter() - sent)
+        latest[0] = sent
+
+    if use_udp:
+        server_tcp = UdpTcp(HOST, SERVER_PORT, udp_config={'port': SERVER_UDP_PORT, 'identifiers': [0x11]},
+                            scheduler_config={})
+    else:
+        server_tcp = Tcp(HOST, SERVER_PORT, scheduler_config={})
+    server_tcp.on(0x11, handler)
+
+    async def handle_client(session):
+        await session.wait_closed()
+
+    server, _ = await server_tcp.start_server(handle_client)
+    injector = LossInjector(LOSS, RTO)
+    proxy = await asyncio.start_server(injector.tcp_proxy, HOST, PROXY_PORT)
+    loop = asyncio.get_running_loop()
+    udp_proxy, _ = await loop.create_datagram_endpoint(
+        lambda: injector.udp_proxy((HOST, SERVER_UDP_PORT)), local_addr=(HOST, PROXY_UDP_PORT))
+
+    if use_udp:
+        client = UdpTcp(HOST, PROXY_PORT, udp_config={'port': PROXY_UDP_PORT, 'identifiers': [0x11]},
+                        scheduler_config={})
+    else:
+        client = Tcp(HOST, PROXY_PORT, scheduler_config={})
+    await client.connect()
+
+    # 受信側で一定間隔ごとに「最新値の古さ」を記録する
+    ages = []
+
+    async def sample():
+        while True:
+            await asyncio.sleep(INTERVAL)
+            if latest[0] is not None:
+                ages.append(time.perf_counter() - latest[0])
+
+    sample_task = asyncio.create_task(sample())
+    end = time.perf_counter() + DURATION
+    count = 0
+    while time.perf_counter() < end:
+        await client.send(0x11, _TIMESTAMP.pack(time.perf_counter()))
+        count += 1
+        await asyncio.sleep(INTERVAL)
+    sample_task.cancel()
+    await asyncio.sleep(RTO * 3)  # 再送待ちのフレームの到着を待つ
+
+    stats = server_tcp.udp.stats() if use_udp else None
+    await client.close()
+    proxy.close()
+    udp_proxy.close()
+    server.close()
+    await asyncio.gather(proxy.wait_closed(), server.wait_closed())
+    if use_udp:
+        server_tcp._udp_transport.close()
+    return count, sorted(latencies), sorted(ages), stats
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def report(label: str, count: int, latencies: list, ages: list):
+    print(f"{label}: 到着 {len(latencies)}/{count}  遅延 p50 {percentile(latencies, 0.5):6.1f}ms "
+          f"p99 {percentile(latencies, 0.99):6.1f}ms max {latencies[-1] * 1000:6.1f}ms  "
+          f"最新値の古さ p99 {percentile(ages, 0.99):6.1f}ms")
+
+
+async def main():
+    print(f"=== 制御フレーム遅延（ロス率 {LOSS * 100:.0f}%, RTO {RTO * 1000:.0f}ms） ===\n")
+    count, tcp_latencies, tcp_ages, _ = await run(use_udp=False)
+    report("TCP ", count, tcp_latencies, tcp_ages)
+    count, udp_latencies, udp_ages, stats = await run(use_udp=True)
+    report("UDP ", count, udp_latencies, udp_ages)
+    print(f"UDP受信統計: {stats}")
+    assert stats['recovered'] > 0, "重複送信で失われたレコードが回復されるべき"
+    assert percentile(udp_latencies, 0.99) < percentile(tcp_latencies, 0.99), "UDPの方が裾の遅延が小さいべき"
+    print("\nベンチマーク完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
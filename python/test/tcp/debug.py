@@ -8,7 +8,8 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 import asyncio
 import struct
-from tools.tcp import DebugTcp, create_tcp
+import tools.tcp
+from tools.tcp import DebugTcp, Reconnector, Tcp, create_tcp
 
 async def test_debug_output():
     """デバッグ出力機能のテスト"""
@@ -75,6 +76,48 @@ async def test_create_tcp_function():
     tcp_instance = create_tcp("localhost", 8080)
     print(f"デフォルトモード: {type(tcp_instance).__name__}")
     print(f"インスタンス: {tcp_instance}")
+
+    # debug_mode: on でも、サーバー側（Rasp.py）は待ち受けられるTcpになる
+    original = tools.tcp.load_config
+    tools.tcp.load_config = lambda section: {'debug_mode': 'on'}
+    try:
+        client = create_tcp("localhost", 8080)
+        server = create_tcp("0.0.0.0", 8080, server=True)
+    finally:
+        tools.tcp.load_config = original
+    print(f"debug_mode: on -> クライアント: {type(client).__name__}, サーバー: {type(server).__name__}")
+    assert type(client) is DebugTcp and type(server) is Tcp
+    print()
+
+
+async def test_reconnector():
+    """PC.pyと同じようにReconnector経由で接続できることのテスト（debug_mode: on）"""
+    print("=== Reconnector経由の接続テスト ===\n")
+    debug_tcp = DebugTcp("localhost", 8080)
+    link = Reconnector(debug_tcp)
+    host, port = await link.connect()
+    print(f"🔗 接続: {host}:{port} ({debug_tcp.address})")
+    assert debug_tcp.connected and debug_tcp.address is None
+    await debug_tcp.close()
+    print()
+
+
+async def test_rate_limited_preview():
+    """件数制限で捨てる送信ではデータのプレビューを作らないことのテスト（config.yamlのlog.categories.tcp.debug）"""
+    print("=== 件数制限と送信のプレビュー ===\n")
+    formatted = []
+    original = tools.tcp._SendPreview.__str__
+    tools.tcp._SendPreview.__str__ = lambda self: formatted.append(self.identifier) or original(self)
+    try:
+        debug_tcp = DebugTcp("localhost", 8080)
+        await debug_tcp.connect()
+        for i in range(1000):
+            await debug_tcp.send(0x12, bytes([i % 256] * 12))
+        await debug_tcp.close()
+    finally:
+        tools.tcp._SendPreview.__str__ = original
+    print(f"1000回の送信のうちプレビューを作った回数: {len(formatted)}")
+    assert 0 < len(formatted) < 1000, "捨てる送信ではプレビューを作らないべき"
     print()
 
 
@@ -108,6 +151,10 @@ async def main():
     print("\n" + "="*50 + "\n")
     await test_create_tcp_function()
     print("\n" + "="*50 + "\n")
+    await test_reconnector()
+    print("\n" + "="*50 + "\n")
+    await test_rate_limited_preview()
+    print("\n" + "="*50 + "\n")
     await test_error_handling()
 
 
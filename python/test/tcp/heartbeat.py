@@ -0,0 +1,84 @@
+"""
+死活監視（ping/pong, 識別子0xFD）のテスト
+- 両側でRTT（指数移動平均, p50/p99）が計測できること
+- ping/pongが受信キューやハンドラーに渡らないこと
+- 相手が応答しなくなったら通信劣化、応答が戻ったら回復のイベントが発生すること
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import time
+from tools.tcp import Tcp
+
+HOST = '127.0.0.1'
+PORT = 50112
+
+HEARTBEAT_CONFIG = {'interval': 0.05, 'miss_limit': 3}
+STALL = 0.5  # 受信側が読み込みを止める時間（秒）
+
+
+def ms(value: float) -> str:
+    return f"{value * 1000:.2f}ms"
+
+
+async def test_heartbeat():
+    print("=== 死活監視テスト ===\n")
+    frames = []
+    sessions = []
+
+    server_tcp = Tcp(HOST, PORT, scheduler_config={}, heartbeat_config=HEARTBEAT_CONFIG)
+
+    async def handle_client(session):
+        sessions.append(session)
+        async for identifier, size, data in session.frames():
+            frames.append(identifier)
+
+    server, _ = await server_tcp.start_server(handle_client)
+
+    events = []
+    client = Tcp(HOST, PORT, scheduler_config={}, heartbeat_config=HEARTBEAT_CONFIG)
+    client.on_link_change(lambda session, degraded: events.append((time.perf_counter(), degraded)))
+    await client.connect()
+    for _ in range(10):
+        await client.send(0x11, bytes(4))
+        await asyncio.sleep(0.05)
+
+    client_stats = client.heartbeat.stats()
+    server_stats = sessions[0].heartbeat.stats()
+    print(f"クライアント: 平均 {ms(client_stats['srtt'])} p50 {ms(client_stats['p50'])} "
+          f"p99 {ms(client_stats['p99'])} ({client_stats['received']}/{client_stats['sent']})")
+    print(f"サーバー    : 平均 {ms(server_stats['srtt'])} p50 {ms(server_stats['p50'])} "
+          f"p99 {ms(server_stats['p99'])} ({server_stats['received']}/{server_stats['sent']})")
+    for stats in (client_stats, server_stats):
+        assert stats['received'] > 0 and stats['srtt'] > 0, "両側でRTTが計測されるべき"
+        assert stats['p50'] <= stats['p99']
+    assert frames == [0x11] * 10, "ping/pongは受信キューに入らないべき"
+    assert not events
+    print("✓ 両側でRTTが計測されることを確認")
+
+    # サーバーが読み込みを止める（応答しない相手を再現）
+    stalled_at = time.perf_counter()
+    sessions[0].transport.pause_reading()
+    await asyncio.sleep(STALL)
+    sessions[0].transport.resume_reading()
+    await asyncio.sleep(HEARTBEAT_CONFIG['interval'] * 3)
+
+    assert [degraded for _, degraded in events] == [True, False], f"劣化→回復の順にイベントが発生するべき: {events}"
+    detected = events[0][0] - stalled_at
+    recovered = events[1][0] - stalled_at
+    limit = HEARTBEAT_CONFIG['interval'] * (HEARTBEAT_CONFIG['miss_limit'] + 2)
+    print(f"✓ 通信劣化を {ms(detected)} で検出、{ms(recovered)} で回復（停止 {ms(STALL)}）")
+    assert detected < limit, "miss_limit回分の間隔程度で劣化を検出するべき"
+    assert client.heartbeat.stats()['p99'] >= STALL * 0.5, "停止中のRTTがp99に反映されるべき"
+
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    await server_tcp.close()
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(test_heartbeat())
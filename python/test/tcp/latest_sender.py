@@ -0,0 +1,86 @@
+"""
+LatestSender のテスト
+受信側が読み込みを止めている間（回線混雑）に古いフレームが捨てられ、
+混雑解消後に最新フレームが届くこと、その間も制御フレームの送信が止まらないことを確認する
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import struct
+import time
+from tools.tcp import Tcp, LatestSender
+
+HOST = '127.0.0.1'
+PORT = 50105
+
+FRAME_SIZE = 50 * 1024
+STALL = 1.0           # 受信側が読み込みを止める時間（秒）
+CAPTURE_INTERVAL = 0.01
+
+
+async def test_latest_sender():
+    print("=== LatestSender テスト ===\n")
+    received = []
+    control = []
+
+    server_tcp = Tcp(HOST, PORT, scheduler_config={})
+    server_tcp.on(0x00, lambda i, d: received.append(struct.unpack_from('>I', d)[0]))
+    server_tcp.on(0x11, lambda i, d: control.append(time.perf_counter()))
+
+    async def handle_client(session):
+        # 読み込みを止めて回線混雑を再現する
+        session.transport.pause_reading()
+        await asyncio.sleep(STALL)
+        session.transport.resume_reading()
+        await session.wait_closed()
+
+    server, _ = await server_tcp.start_server(handle_client)
+
+    client = Tcp(HOST, PORT, scheduler_config={'send_buffer': 32768, 'priority': {0x11: 0, 0x00: 2}})
+    await client.connect()
+    sender = LatestSender(client, 0x00, high_water=128 * 1024, low_water=32 * 1024)
+    sender_task = asyncio.create_task(sender.run())
+
+    # 制御フレームは送信キューを待たずに書き込まれる（最優先レーン）
+    async def send_control():
+        for _ in range(int(STALL / 0.05)):
+            start = time.perf_counter()
+            await client.send(0x11, bytes(4))
+            assert time.perf_counter() - start < 0.05, "制御フレームの送信がカメラに待たされている"
+            await asyncio.sleep(0.05)
+
+    control_task = asyncio.create_task(send_control())
+
+    frame = bytearray(FRAME_SIZE)
+    count = int(STALL / CAPTURE_INTERVAL)
+    for number in range(1, count + 1):
+        struct.pack_into('>I', frame, 0, number)
+        sender.put(bytes(frame))
+        await asyncio.sleep(CAPTURE_INTERVAL)
+    await control_task
+
+    # 混雑解消後に最新フレームが届くまで待つ
+    for _ in range(200):
+        if received and received[-1] == count:
+            break
+        await asyncio.sleep(0.01)
+
+    stats = sender.stats()
+    print(f"統計: {stats}, 受信: {len(received)}枚, 制御: {len(control)}件")
+    assert stats['captured'] == count
+    assert stats['dropped'] > 0, "混雑中は古いフレームが捨てられるべき"
+    assert stats['sent'] + stats['dropped'] == stats['captured']
+    assert received[-1] == count, "最後に取得したフレームが届くべき"
+    assert received == sorted(received), "フレームの順序が入れ替わってはいけない"
+    print("✓ 混雑中のフレーム破棄と最新フレームの送信を確認")
+
+    sender_task.cancel()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(test_latest_sender())
@@ -0,0 +1,136 @@
+"""
+複数接続（操縦用PC + 閲覧用PC）のテスト
+- 角度・カメラ画像が全接続に配信されること
+- 制御フレームは操縦権（リース）を持つ接続からのみ受け付けること
+- 操縦者が切断しても猶予期間中は同じホストのために操縦権が空けられ、その後は別の接続が取得できること
+操縦用PCはIPv6(::1)、閲覧用PCはIPv4(127.0.0.1)で接続し、別のホストとして扱う
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import struct
+from tools.tcp import Tcp, LatestSender
+
+PORT = 50110
+DRIVER_HOST = '::1'
+VIEWER_HOST = '127.0.0.1'
+
+LEASE_GRACE = 0.5
+VIEWER_INTERVAL = 0.2
+CAPTURE_INTERVAL = 0.02
+CAPTURE_DURATION = 1.0
+
+SERVER_CONFIG = {
+    'control_identifiers': [0x11, 0x12, 0x02, 0xFF],
+    'lease_grace': LEASE_GRACE,
+    'viewer_frame_interval': VIEWER_INTERVAL,
+}
+
+
+class Client:
+    """受信したフレームを記録するテスト用クライアント"""
+
+    def __init__(self, host: str):
+        self.tcp = Tcp(host, PORT, scheduler_config={})
+        self.bno = []
+        self.images = []
+        self.tcp.on(0x03, lambda i, d: self.bno.append(bytes(d)))
+        self.tcp.on(0x00, lambda i, d: self.images.append(struct.unpack_from('>I', d)[0]))
+
+
+async def wait_until(condition: callable, timeout: float = 2.0):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+
+async def test_multi_client():
+    print("=== 複数接続テスト ===\n")
+    control = []  # (接続元ホスト, 識別子)
+
+    server_tcp = Tcp(None, PORT, scheduler_config={}, server_config=SERVER_CONFIG)
+
+    async def handle_client(session):
+        async for identifier, size, data in session.frames():
+            control.append((session.addr[0], identifier))
+
+    server, _ = await server_tcp.start_server(handle_client)
+
+    driver = Client(DRIVER_HOST)
+    await driver.tcp.connect()
+    await wait_until(lambda: len(server_tcp.sessions) == 1)
+    viewer = Client(VIEWER_HOST)
+    await viewer.tcp.connect()
+    await wait_until(lambda: len(server_tcp.sessions) == 2)
+    assert server_tcp.lease is server_tcp.sessions[0], "最初の接続が操縦権を持つべき"
+    print(f"接続: {server_tcp.sessions}")
+
+    # 配信
+    await server_tcp.send(0x03, bytes([1, 2, 3]))
+    await wait_until(lambda: driver.bno and viewer.bno)
+    assert driver.bno == viewer.bno == [bytes([1, 2, 3])], "角度は全接続に届くべき"
+    print("✓ 角度の配信を確認")
+
+    sender = LatestSender(server_tcp, 0x00)
+    sender_task = asyncio.create_task(sender.run())
+    frame = bytearray(8 * 1024)
+    count = int(CAPTURE_DURATION / CAPTURE_INTERVAL)
+    for number in range(1, count + 1):
+        struct.pack_into('>I', frame, 0, number)
+        sender.put(bytes(frame))
+        await asyncio.sleep(CAPTURE_INTERVAL)
+    await wait_until(lambda: driver.images and driver.images[-1] == count)
+    print(f"カメラ: 操縦用 {len(driver.images)}枚, 閲覧用 {len(viewer.images)}枚, 統計 {sender.stats()}")
+    assert driver.images[-1] == count, "操縦用PCには最新フレームまで届くべき"
+    assert len(driver.images) > count * 0.8, "操縦用PCにはほぼ全フレームが届くべき"
+    assert 0 < len(viewer.images) <= CAPTURE_DURATION / VIEWER_INTERVAL + 1, "閲覧用PCは間引かれるべき"
+    sender_task.cancel()
+    print("✓ カメラ画像の配信と閲覧用PCの間引きを確認")
+
+    # 操縦権
+    await driver.tcp.send(0x11, bytes(4))
+    await viewer.tcp.send(0x11, bytes(4))
+    await viewer.tcp.send(0xFF, bytes([0]))
+    await wait_until(lambda: len(control) >= 1)
+    await asyncio.sleep(0.1)
+    viewer_session = server_tcp.sessions[1]
+    assert control == [(DRIVER_HOST, 0x11)], f"操縦者の制御フレームのみ受け付けるべき: {control}"
+    assert viewer_session.protocol.rejected == 2
+    print("✓ 閲覧用PCの制御フレームが捨てられることを確認")
+
+    # 操縦者の切断 → 猶予期間中は別ホストに渡さない
+    await driver.tcp.close()
+    await wait_until(lambda: len(server_tcp.sessions) == 1)
+    await viewer.tcp.send(0x11, bytes(4))
+    await asyncio.sleep(0.1)
+    assert server_tcp.lease is None and viewer_session.protocol.rejected == 3, "猶予期間中は操縦権を渡さない"
+
+    # 同じホストからの再接続は猶予期間中に操縦権を取り戻す
+    driver = Client(DRIVER_HOST)
+    await driver.tcp.connect()
+    await wait_until(lambda: len(server_tcp.sessions) == 2)
+    assert server_tcp.lease is server_tcp.sessions[1], "再接続した操縦者が操縦権を取り戻すべき"
+    print("✓ 猶予期間中の再接続で操縦権が戻ることを確認")
+
+    # 猶予期間後は、最初に制御フレームを送った接続が操縦権を得る
+    await driver.tcp.close()
+    await wait_until(lambda: len(server_tcp.sessions) == 1)
+    await asyncio.sleep(LEASE_GRACE + 0.1)
+    await viewer.tcp.send(0x11, bytes(4))
+    await wait_until(lambda: server_tcp.lease is viewer_session)
+    assert server_tcp.lease is viewer_session, "猶予期間後は別の接続が操縦権を得るべき"
+    assert control[-1] == (VIEWER_HOST, 0x11)
+    print("✓ 猶予期間後に閲覧用PCが操縦権を得ることを確認")
+
+    await viewer.tcp.close()
+    server.close()
+    await server.wait_closed()
+    await server_tcp.close()
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(test_multi_client())
@@ -0,0 +1,141 @@
+"""
+Reconnector のテスト
+ソケットを強制的に切断し、再接続とスナップショット再送までの時間（復旧時間）を計測する
+- 接続中のソケットをサーバー側で破棄した場合
+- サーバー自体が停止し、しばらくして再起動した場合（接続拒否の間はバックオフで再試行）
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import time
+from tools.tcp import Tcp, Reconnector
+
+HOST = 'localhost'
+PORT = 50111
+
+RESTART_DELAY = 0.5  # サーバー停止から再起動までの時間（秒）
+RECONNECT_CONFIG = {
+    'initial_delay': 0.02,
+    'max_delay': 0.2,
+    'factor': 2.0,
+    'jitter': 0.5,
+    'resolve_failures': 3,
+}
+SNAPSHOT = [(0x11, bytes([10, 20, 30, 40])), (0x02, bytes([5, 5]))]
+
+
+class Server:
+    """受信した制御フレームを接続ごとに記録するサーバー"""
+
+    def __init__(self):
+        self.tcp = Tcp(HOST, PORT, scheduler_config={}, server_config={'lease_grace': 0.0})
+        self.server = None
+        self.received = []  # (受信時刻, Session, 識別子, データ)
+
+    async def handle_client(self, session):
+        async for identifier, size, data in session.frames():
+            self.received.append((time.perf_counter(), session, identifier, data))
+
+    async def start(self):
+        self.server, _ = await self.tcp.start_server(self.handle_client)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.tcp.close()
+
+
+async def client_loop(link: Reconnector, tcp: Tcp, stop: asyncio.Event):
+    """PC.tcp_client と同じく、切断されたら再接続して送信を続ける"""
+    while not stop.is_set():
+        await link.connect()
+        try:
+            while not stop.is_set():
+                await tcp.send(0x12, bytes(12))
+                await asyncio.sleep(0.01)
+        except ConnectionError:
+            pass
+
+
+def first_frames_after(server: Server, killed_at: float, old_session):
+    return [r for r in server.received if r[0] > killed_at and r[1] is not old_session]
+
+
+async def wait_for(condition: callable, timeout: float = 5.0):
+    for _ in range(int(timeout / 0.005)):
+        if condition():
+            return
+        await asyncio.sleep(0.005)
+    raise AssertionError("タイムアウトしました")
+
+
+async def test_reconnect():
+    print("=== 再接続テスト ===\n")
+    server = Server()
+    await server.start()
+
+    tcp = Tcp(HOST, PORT, scheduler_config={})
+    link = Reconnector(tcp, snapshot=lambda: SNAPSHOT, reconnect_config=RECONNECT_CONFIG)
+    stop = asyncio.Event()
+    task = asyncio.create_task(client_loop(link, tcp, stop))
+    await wait_for(lambda: server.received)
+    address = tcp.address
+    print(f"接続: {HOST} -> {address}")
+
+    # 1. 接続中のソケットを破棄する
+    old_session = server.received[-1][1]
+    killed_at = time.perf_counter()
+    old_session.transport.abort()
+    await wait_for(lambda: len(first_frames_after(server, killed_at, old_session)) >= len(SNAPSHOT))
+    frames = first_frames_after(server, killed_at, old_session)
+    recovery = frames[0][0] - killed_at
+    assert [(f[2], f[3]) for f in frames[:len(SNAPSHOT)]] == SNAPSHOT, "再接続後に最初にスナップショットが届くべき"
+    assert tcp.address == address, "解決済みのアドレスを使い回すべき"
+    print(f"✓ ソケット破棄からの復旧: {recovery * 1000:.1f}ms (Reconnector計測 {link.recovery_times[-1] * 1000:.1f}ms)")
+
+    # 2. サーバーを停止して再起動する
+    old_session = server.received[-1][1]
+    attempts = link.attempts
+    killed_at = time.perf_counter()
+    await server.stop()
+    await asyncio.sleep(RESTART_DELAY)
+    server = Server()
+    await server.start()
+    await wait_for(lambda: len(first_frames_after(server, killed_at, old_session)) >= len(SNAPSHOT))
+    frames = first_frames_after(server, killed_at, old_session)
+    recovery = frames[0][0] - killed_at
+    retries = link.attempts - attempts
+    assert [(f[2], f[3]) for f in frames[:len(SNAPSHOT)]] == SNAPSHOT
+    assert retries > 1, "停止中は接続拒否され、再試行されるべき"
+    # バックオフの上限（max_delay）を超えて待たされないこと
+    assert recovery < RESTART_DELAY + RECONNECT_CONFIG['max_delay'] + 0.1, f"復旧が遅すぎます: {recovery:.3f}s"
+    print(f"✓ サーバー再起動からの復旧: {recovery * 1000:.1f}ms（停止 {RESTART_DELAY * 1000:.0f}ms, 試行 {retries}回）")
+
+    # バックオフの待ち時間は上限以下で、ランダムに揺らされている
+    delays = [link.delay(10) for _ in range(100)]
+    assert max(delays) <= RECONNECT_CONFIG['max_delay']
+    assert min(delays) >= RECONNECT_CONFIG['max_delay'] * (1 - RECONNECT_CONFIG['jitter'])
+    assert len(set(delays)) > 1, "待ち時間はランダムに揺らされるべき"
+    print(f"✓ バックオフ: {link.stats()}")
+
+    stop.set()
+    await task
+
+    # 3. 古い接続が残ったまま（Wi-Fi切断で切断に気づいていない）同じホストから再接続した場合
+    stale = server.tcp.lease
+    other = Tcp(HOST, PORT, scheduler_config={})
+    await other.connect()
+    await wait_for(lambda: stale.is_closed() and server.tcp.lease is not None)
+    assert server.tcp.lease is not stale, "同じホストからの再接続が操縦権を引き継ぐべき"
+    print("✓ 古い接続を閉じて操縦権を引き継ぐことを確認")
+    await other.close()
+
+    await tcp.close()
+    await server.stop()
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(test_reconnect())
@@ -0,0 +1,150 @@
+"""
+フレームの記録と再生のテスト
+- 送受信したフレームが方向・時刻付きでログに記録されること
+- FrameLog（メモリマップ + 識別子ごとの索引）で読めること、大きなログでも索引作成・シークが速いこと
+- ReplayServer がRasp.pyの代わりにログを倍速で再生できること
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+import struct
+import tempfile
+import time
+from tools.tcp import Tcp, ReplayServer
+from tools.frame_log import FrameRecorder, FrameLog, RECEIVED, SENT
+
+HOST = '127.0.0.1'
+PORT = 50113
+REPLAY_PORT = 50114
+
+FRAMES = 20
+INTERVAL = 0.02
+SPEED = 4.0
+JPEG_SIZE = 30 * 1024
+BIG_LOG_FRAMES = 360000  # 1時間分（100Hzの制御フレーム相当）
+
+
+async def record(path: str):
+    """Rasp役のサーバーがBNOとカメラ画像を送り、PC役がサーボを送る様子を記録する"""
+    server_tcp = Tcp(HOST, PORT, scheduler_config={}, record_config={'enabled': True, 'path': path})
+    done = asyncio.Event()
+
+    async def handle_client(session):
+        async for identifier, size, data in session.frames():
+            if identifier == 0xFF:
+                done.set()
+
+    server, _ = await server_tcp.start_server(handle_client)
+    client = Tcp(HOST, PORT, scheduler_config={}, record_config={})
+    await client.connect()
+    for number in range(FRAMES):
+        await server_tcp.send(0x03, bytes([number, 0, 0]))
+        if number % 5 == 0:
+            await server_tcp.send(0x00, struct.pack('>I', number) + bytes(JPEG_SIZE))
+        await client.send(0x11, bytes([number] * 4))
+        await asyncio.sleep(INTERVAL)
+    await client.send(0xFF, bytes([9]))
+    await done.wait()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    await server_tcp.close()
+    server_tcp.recorder.close()
+    return server_tcp.recorder
+
+
+def check_log(path: str):
+    log = FrameLog(path)
+    print(f"{log}")
+    assert not log.truncated
+    assert log.count(0x03) == FRAMES and log.count(0x00) == FRAMES // 5
+    assert log.count(0x11) == FRAMES and log.count(0xFF) == 1
+    assert log.count(0xFD) == 0, "ping/pongは記録しないべき"
+    sent = [r for r in log.frames(direction=SENT)]
+    received = [r for r in log.frames(direction=RECEIVED)]
+    assert {r[2] for r in sent} == {0x03, 0x00}
+    assert {r[2] for r in received} == {0x11, 0xFF}
+    bno = [bytes(r[3]) for r in log.frames(identifier=0x03)]
+    assert bno == [bytes([n, 0, 0]) for n in range(FRAMES)], "データが記録順に読めるべき"
+    times = [r[0] for r in log.frames()]
+    assert times == sorted(times), "時刻順に並ぶべき"
+    # シーク: 半分の時刻以降の最初のBNOフレーム
+    middle = log.at(0x03, FRAMES // 2)[0]
+    assert log.seek(0x03, middle) == FRAMES // 2
+    assert next(log.frames(start=middle))[0] >= middle
+    print("✓ 記録内容と索引の確認OK")
+    return log
+
+
+async def replay(log: FrameLog):
+    replay = ReplayServer(log, HOST, REPLAY_PORT, speed=SPEED)
+    server, _ = await replay.start_server()
+    received = []
+    client = Tcp(HOST, REPLAY_PORT, scheduler_config={}, record_config={})
+    client.on(0x03, lambda i, d: received.append((time.perf_counter(), bytes(d))))
+    client.on(0x00, lambda i, d: None)
+    start = time.perf_counter()
+    await client.connect()
+    for _ in range(500):
+        if len(received) == FRAMES:
+            break
+        await asyncio.sleep(0.01)
+    elapsed = received[-1][0] - received[0][0]
+    recorded = log.at(0x03, FRAMES - 1)[0] - log.at(0x03, 0)[0]
+    print(f"再生: {len(received)}フレーム {elapsed * 1000:.0f}ms（記録 {recorded * 1000:.0f}ms, {SPEED}倍速）")
+    assert [d for _, d in received] == [bytes([n, 0, 0]) for n in range(FRAMES)]
+    assert recorded / SPEED * 0.7 < elapsed < recorded / SPEED * 1.5, "再生速度に合わせた間隔で送られるべき"
+    print("✓ 倍速再生の確認OK")
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    await replay.tcp.close()
+
+
+def bench_index(directory: str):
+    """大きなログの索引作成とシークの時間を計測する"""
+    path = os.path.join(directory, 'big.qkl')
+    recorder = FrameRecorder(path)
+    payload = bytes(12)
+    start = time.perf_counter()
+    for _ in range(BIG_LOG_FRAMES):
+        recorder.record(SENT, 0x12, payload)
+    record_time = time.perf_counter() - start
+    recorder.close()
+    size = os.path.getsize(path)
+
+    start = time.perf_counter()
+    log = FrameLog(path)
+    index_time = time.perf_counter() - start
+    last = log.at(0x12, BIG_LOG_FRAMES - 1)[0]
+    start = time.perf_counter()
+    for i in range(1000):
+        index = log.seek(0x12, last * i / 1000)
+        log.at(0x12, index)
+    seek_time = (time.perf_counter() - start) / 1000
+    print(f"\n=== 大きなログ ({BIG_LOG_FRAMES}フレーム, {size // 1024}KB) ===")
+    print(f"記録（record呼び出し）: {record_time / BIG_LOG_FRAMES * 1e6:.2f}µs/フレーム, 破棄 {recorder.dropped}")
+    print(f"索引作成: {index_time * 1000:.0f}ms")
+    print(f"シーク  : {seek_time * 1e6:.1f}µs")
+    assert len(log) == BIG_LOG_FRAMES
+    assert seek_time < 0.001
+    log.close()
+
+
+async def main():
+    print("=== 記録・再生テスト ===\n")
+    with tempfile.TemporaryDirectory() as directory:
+        recorder = await record(directory)
+        print(f"記録: {recorder}")
+        assert recorder.dropped == 0
+        log = check_log(recorder.path)
+        await replay(log)
+        log.close()
+        bench_index(directory)
+    print("\nテスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+"""
+UDP制御チャネル（UdpTcp）のテスト
+- UDPのエンドポイントを作成し、制御フレームがUDPで届くこと
+- プロトコルのコールバック（connection_made・datagram_receivedなど）で例外が起きないこと
+  （コールバックの例外はイベントループが表示するだけで終了コードに出ないため、例外ハンドラーで集めて確認する）
+"""
+import sys
+import os
+# test/tcpフォルダから2つ上の親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+import asyncio
+from tools.tcp import UdpTcp
+
+HOST = '127.0.0.1'
+SERVER_PORT = 50116
+SERVER_UDP_PORT = 50117
+FRAMES = 20
+
+
+async def main():
+    errors = []
+    loop = asyncio.get_running_loop()
+    loop.set_exception_handler(lambda loop, context: errors.append(context))
+
+    received = []
+    server_tcp = UdpTcp(HOST, SERVER_PORT, udp_config={'port': SERVER_UDP_PORT, 'identifiers': [0x11]},
+                        scheduler_config={})
+    server_tcp.on(0x11, lambda identifier, data: received.append(bytes(data)))
+
+    async def handle_client(session):
+        await session.wait_closed()
+
+    server, _ = await server_tcp.start_server(handle_client)
+    client = UdpTcp(HOST, SERVER_PORT, udp_config={'port': SERVER_UDP_PORT, 'identifiers': [0x11]},
+                    scheduler_config={})
+    await client.connect()
+    for i in range(FRAMES):
+        await client.send(0x11, bytes([i, 0, 0, 0]))
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.05)
+
+    stats = server_tcp.udp.stats()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    server_tcp._udp_transport.close()
+    await asyncio.sleep(0)
+
+    print(f"受信: {len(received)}/{FRAMES} {stats}")
+    for context in errors:
+        print(f"\033[91m   {context.get('message')}: {context.get('exception')!r}\033[0m")
+    assert not errors, "UDPのコールバックで例外が起きてはいけない"
+    assert len(received) == FRAMES and received[-1] == bytes([FRAMES - 1, 0, 0, 0]), "制御フレームがUDPで届くべき"
+    assert stats['accepted'] == FRAMES
+    print("✓ UDP制御チャネルの確認OK")
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+"""
+Telemetry（ESPからの通知の集計とPCへの転送）のテスト
+- 通知ごとに最新・最小・最大・平均が集計され、PC側でフレームから同じ値を読めること
+- リングバッファが溢れたら古い通知から上書きし、スキーマにない通知は数えて捨てること
+- 通知ごとにタスクを作ってPCに送る場合と比べた、コールバックの時間とPCに送るバイト数
+ESPから送るメッセージはまだないため、一時的なスキーマ（ESP2からの電流・IMU）を使う
+"""
+import sys
+import os
+# testフォルダから親ディレクトリを参照するようにパスを調整
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asyncio
+import tempfile
+import time
+import yaml
+
+from tools.protocol import Protocol
+from tools.telemetry import Telemetry, TELEMETRY_IDENTIFIER
+
+NOTIFICATIONS = 5000  # 1秒間に届く通知の数（ESP2の2つのメッセージを交互に）
+
+SCHEMA = {
+    'links': {'ESP2': {'device': 2, 'firmware': 'ESP2.cpp'}},
+    'messages': {
+        'current': {'identifier': 0x21, 'type': 'UINT16', 'length': 2, 'source': 'ESP2',
+                    'destination': ['PC'], 'ble_identifier': 0x05, 'firmware': 'current_data'},
+        'imu': {'identifier': 0x22, 'type': 'INT16', 'length': 3, 'source': 'ESP2',
+                'destination': ['PC'], 'ble_identifier': 0x06, 'firmware': 'imu_data'},
+        'servo': {'identifier': 0x12, 'type': 'UINT8', 'length': 12, 'source': 'PC',
+                  'destination': ['ESP2'], 'ble_identifier': 0x01, 'firmware': 'servo_data'},
+    },
+}
+
+
+def load_protocol(directory: str) -> Protocol:
+    path = os.path.join(directory, 'protocol.yaml')
+    with open(path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(SCHEMA, f)
+    protocol = Protocol(path)
+    protocol.build()
+    return protocol
+
+
+class FakeTcp:
+    """送ったフレームを記録する疑似Tcp"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, identifier: int, data: bytes):
+        await asyncio.sleep(0)
+        self.sent.append((identifier, bytes(data)))
+
+
+def test_aggregate(protocol: Protocol):
+    print("=== 集計のテスト ===")
+    assert protocol.telemetry_route(2, 0x05).message.name == 'current'
+    assert protocol.telemetry_route(2, 0x01) is None, "PCから送るメッセージは通知ではない"
+    telemetry = Telemetry(protocol, None)
+    for value in (10, 30, 20):
+        telemetry.receive(2, 0x05, memoryview(bytes([0x05]) + (value).to_bytes(2, 'little') + (1000 - value).to_bytes(2, 'little'))[1:])
+    telemetry.receive(2, 0x06, (-5).to_bytes(2, 'little', signed=True) + bytes(4))
+    assert telemetry.drain() == 4
+    frame = telemetry.flush()
+    assert frame[0] == 2 and len(frame) == 1 + (3 + 4 * 4) + (3 + 6 * 4)
+    assert telemetry.flush() is None, "集計した通知がなければ送らない"
+
+    values = Telemetry.unpack(protocol, frame)
+    print(values)
+    assert values['current'] == {'samples': 3, 'latest': [20, 980], 'min': [10, 970], 'max': [30, 990], 'mean': [20, 980]}
+    assert values['imu'] == {'samples': 1, 'latest': [-5, 0, 0], 'min': [-5, 0, 0], 'max': [-5, 0, 0], 'mean': [-5, 0, 0]}
+    assert protocol.route(0x21).manager.get() == [20, 980], "最新の値はDataManagerにも入るべき"
+    for broken in (b'', frame[:-1], frame + b'\x00', bytes([1, 0x40, 1, 0])):
+        try:
+            Telemetry.unpack(protocol, broken)
+            assert False, "不正なフレームはValueErrorになるべき"
+        except ValueError as e:
+            print(f"✓ {e}")
+    print("✓ 最新・最小・最大・平均を確認\n")
+
+
+def test_overflow(protocol: Protocol):
+    print("=== リングバッファのテスト ===")
+    telemetry = Telemetry(protocol, None, capacity=8)
+    for value in range(20):
+        telemetry.receive(2, 0x05, value.to_bytes(2, 'little') + bytes(2))
+    telemetry.receive(2, 0x40, bytes(2))    # スキーマにない識別子
+    telemetry.receive(2, 0x06, bytes(2))    # 長さが違う
+    telemetry.receive(2, 0x05, bytes(100))  # どのメッセージよりも長い
+    assert telemetry.drain() == 6
+    stats = telemetry.stats()
+    print(stats)
+    assert stats['overwritten'] == 14 and stats['invalid'] == 3 and stats['max_depth'] == 8
+    values = Telemetry.unpack(protocol, telemetry.flush())
+    assert values['current']['min'] == [14, 0] and values['current']['latest'] == [19, 0], "直近の通知が残るべき"
+    print("✓ 古い通知から上書きすることを確認\n")
+
+
+async def test_run(protocol: Protocol):
+    print("=== 送信ループのテスト ===")
+    tcp = FakeTcp()
+    telemetry = Telemetry(protocol, tcp.send, interval=0.02)
+    task = asyncio.create_task(telemetry.run())
+    for value in range(5):
+        telemetry.receive(2, 0x05, value.to_bytes(2, 'little') + bytes(2))
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.05)
+    task.cancel()
+    assert all(identifier == TELEMETRY_IDENTIFIER for identifier, _ in tcp.sent)
+    samples = sum(Telemetry.unpack(protocol, data)['current']['samples'] for _, data in tcp.sent)
+    assert samples == 5 and len(tcp.sent) == telemetry.frames <= 3, "通知がない間は送らないべき"
+    print(f"✓ {telemetry.frames}フレームで{samples}件の通知を送った {telemetry.stats()}\n")
+
+
+async def bench(protocol: Protocol):
+    print("=== 通知ごとにタスクを作る場合との比較 ===")
+    notifications = []
+    for i in range(NOTIFICATIONS):
+        if i % 2:
+            notifications.append((0x05, memoryview(bytes([0x05]) + i.to_bytes(2, 'little') + bytes(2))[1:]))
+        else:
+            notifications.append((0x06, memoryview(bytes([0x06]) + bytes(6))[1:]))
+
+    # 変更前: 通知ごとにデコードしてPCに送るタスクを作る
+    tcp = FakeTcp()
+    before = len(asyncio.all_tasks())
+    start = time.perf_counter()
+    for identifier, data in notifications:
+        route = protocol.telemetry_route(2, identifier)
+        route.manager.unpack_from(data)
+        asyncio.create_task(tcp.send(route.message.identifier, bytes(data)))
+    callback_old = (time.perf_counter() - start) / NOTIFICATIONS
+    tasks = len(asyncio.all_tasks()) - before
+    await asyncio.sleep(0.01)
+    old_bytes = sum(len(data) + 5 for _, data in tcp.sent)  # TCPのヘッダー（識別子1byte + 長さ4byte）
+
+    # 変更後: リングバッファにコピーし、0.5秒ごとに集計して送る
+    tcp = FakeTcp()
+    telemetry = Telemetry(protocol, tcp.send, interval=0.5, capacity=NOTIFICATIONS)
+    start = time.perf_counter()
+    for identifier, data in notifications:
+        telemetry.receive(2, identifier, data)
+    callback_new = (time.perf_counter() - start) / NOTIFICATIONS
+    start = time.perf_counter()
+    telemetry.drain()
+    frame = telemetry.flush()
+    drain_time = time.perf_counter() - start
+    new_bytes = (len(frame) + 5) * 2  # 1秒に2フレーム
+    print(f"通知ごとにタスク: コールバック {callback_old * 1e6:.1f} µs/回, タスク {tasks}個, PCへ {old_bytes}バイト/秒")
+    print(f"リングバッファ　: コールバック {callback_new * 1e6:.1f} µs/回, タスク 0個, PCへ {new_bytes}バイト/秒 "
+          f"(集計 {drain_time * 1000:.1f}ms/{NOTIFICATIONS // 2}件)")
+    assert callback_new < callback_old, "通知のコールバックはタスクを作るより速いべき"
+    assert new_bytes * 100 < old_bytes
+    print()
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as directory:
+        protocol = load_protocol(directory)
+        test_aggregate(protocol)
+        test_overflow(protocol)
+        await test_run(protocol)
+        await bench(protocol)
+    print("テスト完了")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+import numpy as np
+from tools.data_manager import DataManager, DataType
+
+
+class ArrayDataManager(DataManager):
+    """NumPy配列でデータを管理するDataManager
+    配列のdtypeはDataTypeから作り、ESP32のDataManager<T>がmemcpyするのと同じリトルエンディアンに固定する。
+    配列はpack_into/unpack_fromのバッファと同じメモリなので、送信時にパックする必要がない。
+    get()/update()はリストのままでも使えるので、DataManagerとそのまま置き換えられる。
+    """
+
+    def __init__(self, identifier:int, length:int, data_type:DataType):
+        """コンストラクタ
+        :param identifier: 1byteの識別子 (1〜255)
+        :param length: データの長さ
+        :param data_type: データの型 (DataType Enum)
+        """
+        super().__init__(identifier, length, data_type)
+        self._dtype = np.dtype('<' + data_type.value)
+        self._limits = np.iinfo(self._dtype)
+        self._array = np.frombuffer(self._buffer, dtype=self._dtype)  # バッファと同じメモリを使う
+        self._committed = bytearray(self._buffer)  # 最後に更新された内容（バイト列で比較する）
+        self._data = None  # リストは持たない（get()で作る）
+
+    def update(self, new_data, mask=None):
+        """データを更新する
+        内容が前回の更新から変わった場合のみバージョンを増やす
+        :param new_data: 更新するデータ（リスト・配列・スカラー。小数は切り捨て）
+        :param mask: 指定した場合はTrueの要素だけを更新する（boolのリスト・配列）
+        :raises ValueError: 長さが合わない、または型の範囲外の値がある場合
+        """
+        if np.isscalar(new_data):
+            # スカラーはNumPyの集計を使わずに範囲を確認する
+            low = high = new_data
+            values = new_data
+        else:
+            values = np.asarray(new_data)
+            checked = values if mask is None else values[np.asarray(mask, dtype=bool)]
+            low, high = (checked.min(), checked.max()) if checked.size else (0, 0)
+        if low < self._limits.min or high > self._limits.max:
+            raise ValueError(f"データのパックに失敗しました: {self._dtype}の範囲外の値があります")
+        if mask is None:
+            np.copyto(self._array, values, casting='unsafe')
+        else:
+            np.copyto(self._array, values, casting='unsafe', where=np.asarray(mask, dtype=bool))
+        self._commit()
+        self._touch()
+
+    def _commit(self):
+        if self._buffer != self._committed:
+            self._committed[:] = self._buffer
+            self._version += 1
+
+    def commit(self):
+        """array()を直接書き換えたあとに呼び、内容が変わっていればバージョンを増やす"""
+        self._commit()
+
+    def array(self):
+        """データの配列を取得する（送信バッファと同じメモリ。書き換えたらcommit()を呼ぶ）
+        :return: リトルエンディアンのNumPy配列
+        """
+        return self._array
+
+    def get(self):
+        """現在のデータを取得する
+        :return: 現在のデータのリスト（新しいリスト。書き換えたらupdate()に渡す）
+        """
+        return self._array.tolist()
+
+    def pack(self):
+        """データをバイト列に変換する
+        送信キューに入れたまま次の更新が来てもよいように、新しいbytesを返す
+        :return: パックされたバイト列
+        """
+        return self._array.tobytes()
+
+    def pack_into(self, buffer=None, offset:int=0):
+        """データを新しいbytesを作らずにパックする
+        :param buffer: 書き込み先（省略時はパックせずに配列のメモリをそのまま返す）
+        :param offset: 書き込み先の位置
+        :return: 省略時は配列のメモリのmemoryview（次の更新で書き換わる）
+        """
+        if buffer is None:
+            return self._view
+        buffer[offset:offset + self._struct.size] = self._view
+        return None
+
+    def unpack_from(self, data, offset:int=0, sender_time:float=None):
+        """バイト列を配列にコピーする
+        内容が変わった場合のみバージョンを増やす
+        :param data: 受信したバイト列（memoryviewでもよい）
+        :param offset: 読み出す位置
+        :param sender_time: 送信元が付けた時刻（分かる場合）
+        :return: データの配列（次のunpack_fromで上書きされる）
+        :raises ValueError: データの長さが足りない場合
+        """
+        size = self._struct.size
+        source = memoryview(data)[offset:offset + size]
+        if len(source) != size:
+            raise ValueError(f"データの長さが不正です。期待される長さ: {size}, 実際の長さ: {len(source)}")
+        if self._buffer != source:
+            self._view[:] = source
+            self._commit()
+        self._touch(sender_time)
+        return self._array
+
+    def _assign(self, values, sender_time:float=None):
+        """アンパックした値を入れる"""
+        self._array[:] = values
+        self._commit()
+        self._touch(sender_time)
+
+    def _unpack(self, data, sender_time:float=None):
+        if len(data) != self._struct.size:
+            raise ValueError(f"データのアンパックに失敗しました: 期待される長さ: {self._struct.size}, 実際の長さ: {len(data)}")
+        self.unpack_from(data, sender_time=sender_time)
+        return self.get()
@@ -1,18 +1,111 @@
 import asyncio
 import struct
-from bleak import BleakClient
-from bleak.exc import BleakDBusError
+import time
+from collections import deque
+from typing import Dict, Any
+
+try:
+    from bleak import BleakClient, BleakScanner
+except ImportError:  # bleakのないPCでも書き込みの処理や接続の管理は使えるようにする
+    BleakClient = BleakScanner = None
+
+from tools.config import load_config
+from tools.log import get_logger
+from tools.stats import percentile
+
+# LE 1M PHYで1パケットを送る時間（µs/byte）と、データ以外のバイト数
+# （プリアンブル1 + アクセスアドレス4 + ヘッダー2 + L2CAP4 + ATT3 + CRC3）
+_AIRTIME_PER_BYTE = 8e-6
+_PACKET_OVERHEAD = 17
+
+
+async def _wait_event(event: asyncio.Event, timeout: float = None) -> bool:
+    """Eventがセットされるまで待つ（タイムアウトしても例外にしない）
+    wait_forは同時にキャンセルされるとキャンセルを握りつぶすことがあるためwaitを使う
+    :return: セットされたか
+    """
+    if event.is_set():
+        return True
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait([waiter], timeout=timeout)
+    finally:
+        waiter.cancel()
+    return event.is_set()
+
+
+class BleakBackend:
+    """bleakで実機のESP32に接続するバックエンド（Bleの既定）
+    同じ2つのメソッドを持つクラスに差し替えると、実機なしでBleを動かせる（tools/ble_sim.pyのSimBackend）
+    """
+
+    def __repr__(self):
+        return "bleak"
+
+    async def find_device(self, esp):
+        """ESPのBLEDeviceを探す（見つからなければNone）"""
+        if BleakScanner is None:
+            raise ImportError("bleakがインストールされていません。")
+        return await BleakScanner.find_device_by_address(esp.address, timeout=esp.scan_timeout)
+
+    def client(self, device, disconnected_callback: callable):
+        """BLEDeviceに接続するクライアント（BleakClientと同じメソッドを持つもの）を作る"""
+        return BleakClient(device, disconnected_callback=disconnected_callback)
+
+
+def create_backend(protocol):
+    """設定（config.yamlのble.backend）に基づいてBleのバックエンドを作成する
+    :param protocol: スキーマを読み込んだProtocol（疑似ESPのDataManager<T>を作るのに使う）
+    :return: BleakBackend（実機）またはSimBackend（疑似ESP）
+    """
+    config = load_config('ble')
+    if config.get('backend', 'bleak') == 'sim':
+        from tools.ble_sim import SimBackend
+        backend = SimBackend(protocol, config.get('sim', {}))
+        get_logger('ble').warning("[BLE] 疑似ESPに接続します: %s", backend)
+        return backend
+    return BleakBackend()
+
 
 class Ble:
     """
     BLE通信を管理するクラス
+    書き込みは応答なし（write without response）で行い、コントローラーのバッファを溢れさせないよう
+    write_interval（接続間隔程度）より短い間隔では書き込まない。失敗したら短い待ち時間を伸ばしながら再試行し、
+    期限（deadline）を過ぎた書き込みは古いデータとして送らない。
     """
     
-    def __init__(self, device_num , mac_address, char_uuid):
+    def __init__(self, device_num , mac_address, char_uuid, scan_timeout: float = 5.0,
+                 write_config: Dict[str, Any] = None, backend=None):
+        """コンストラクタ
+        :param scan_timeout: デバイスを探す時間（秒）
+        :param write_config: 書き込みの設定（省略時はconfig.yamlのble.write）
+        :param backend: デバイスを探して接続するバックエンド（省略時はbleakで実機に接続する）
+        """
+        if write_config is None:
+            write_config = load_config('ble').get('write', {})
         self.num = device_num
         self.address = mac_address
         self.char_uuid = char_uuid
+        self.scan_timeout = scan_timeout  # デバイスを探す時間（秒）
+        self.backend = backend if backend is not None else BleakBackend()
         self.client = None
+        self.device = None  # 見つけたBLEDevice（再接続のときはスキャンを省く）
+        self.ready = asyncio.Event()  # 接続して通知を開始している間セットされる
+        self._disconnect_listeners = []
+
+        self.retries = write_config.get('retries', 3)
+        self.retry_delay = write_config.get('retry_delay', 0.005)
+        self.write_interval = write_config.get('interval', 0.0075)
+        self._next_write = 0.0  # 次に書き込める時刻
+        self._write_times = deque(maxlen=write_config.get('window', 256))  # 書き込みにかかった時間（秒）
+        self._write_stamps = deque(maxlen=write_config.get('window', 256))  # 書き込み終わった時刻
+        self.bytes_sent = 0    # 書き込んだバイト数（識別子を含む）
+        self.writes = 0        # 書き込んだ回数
+        self.retried = 0       # 再試行した回数
+        self.failures = 0      # 再試行しても書き込めなかった回数
+        self.expired = 0       # 期限を過ぎて書き込まなかった回数
+        self.airtime = 0.0     # 書き込みに使った電波の時間の見積もり（秒）
 
     def __repr__(self):
         return f"ESP32-{self.num} ({self.address})"
@@ -25,46 +118,131 @@ class Ble:
         :param Hreceive_ESP: データ受信時のコールバック関数
         :return: 接続したクライアントのリスト
         """
-        if self.client and self.client.is_connected:
-            print(f"ESP32-{self.num} ({self.address}) はすでに接続されています。")
+        if self.is_connected():
+            get_logger('ble').info("ESP32-%s (%s) はすでに接続されています。", self.num, self.address)
             return
+        client = None
         try:
-            client = BleakClient(self.address)
+            if self.device is None:
+                self.device = await self.backend.find_device(self)
+                if self.device is None:
+                    raise ConnectionError(f"ESP32-{self.num} ({self.address}) が見つかりません。")
+            client = self.backend.client(self.device, self._disconnected)
             connection = await client.connect()
             if not connection:
                 raise ConnectionError(f"ESP32-{self.num} ({self.address}) への接続に失敗しました。")
             
             self.client = client
             await client.start_notify(self.char_uuid, self._receive(receive_func))
+            self.ready.set()
         except Exception as e:
+            self.client = None
+            self.ready.clear()
+            if client is not None and client.is_connected:
+                await client.disconnect()  # 通知を開始できなかった接続は残さない
             raise Exception(f"ESP32-{self.num} ({self.address}) - {e}") 
         
     async def disconnect(self):
         """
-        ESP32デバイスから切断する
+        ESP32デバイスから切断する（切断時の関数は呼び出さない）
         """
-        if self.client and self.client.is_connected:
-            await self.client.disconnect()
-            self.client = None
+        client = self.client
+        self.client = None
+        self.ready.clear()
+        if client and client.is_connected:
+            await client.disconnect()
+
+    def is_connected(self) -> bool:
+        """接続中かどうか"""
+        return self.client is not None and self.client.is_connected
+
+    async def wait_ready(self, timeout: float = None) -> bool:
+        """接続して通知を開始するまで待つ
+        :param timeout: 待つ時間の上限（秒, Noneで無制限）
+        :return: 接続して通知を開始したか
+        """
+        return await _wait_event(self.ready, timeout)
+
+    def forget(self):
+        """キャッシュしたBLEDeviceを捨て、次の接続でスキャンし直す"""
+        self.device = None
+
+    def on_disconnect(self, listener: callable):
+        """接続が切れたときに呼び出す関数を登録する
+        :param listener: Bleを引数に呼び出される関数
+        """
+        self._disconnect_listeners.append(listener)
+
+    def _disconnected(self, client):
+        if client is not self.client:
+            return  # disconnect()で切断した、または古い接続
+        self.client = None
+        self.ready.clear()
+        for listener in self._disconnect_listeners:
+            listener(self)
 
     def _receive(self , receive_func: callable):        
         def handler(sender, received_data):
-            identifier_byte = received_data[0:1]
-            identifier: int = identifier_byte[0]
-            data: bytes = received_data[1:]  # sizeを省略して受信データ全体を取得
+            # 通知はコピーせずmemoryviewで渡す（受け取る側はコールバック内でコピー・デコードする）
+            view = memoryview(received_data)
+            identifier: int = view[0]
+            data = view[1:]  # sizeを省略して受信データ全体を取得
             receive_func(self.num , identifier, data)
 
         return handler
 
-    async def send(self , identifier: int, data: bytes):
+    async def send(self , identifier: int, data: bytes, deadline: float = None):
+        """
+        識別子を付けて書き込む（前回の書き込みからwrite_interval秒たつまで待つ）
+        :param deadline: この時刻（time.monotonic()）を過ぎたら書き込まない（Noneで期限なし）
+        :raises ConnectionError: 接続されていない場合
+        :raises TimeoutError: 期限までに書き込めなかった場合
+        :raises Exception: 再試行しても書き込めなかった場合（最後のエラー）
+        """
         # size = len(data)
-        header = struct.pack('B', identifier) # + struct.pack('>I', size)
+        packet = struct.pack('B', identifier) + data # + struct.pack('>I', size)
         if not self.client or not self.client.is_connected:
             raise ConnectionError(f"ESP32-{self.num} ({self.address}) は接続されていません。")
-        for attempt in range(3):  # 最大3回再試行
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            now = time.monotonic()
+            wait = max(self._next_write - now, 0.0)
+            if deadline is not None and now + wait > deadline:
+                self.expired += 1
+                raise TimeoutError(f"ESP32-{self.num} ({self.address}) 期限までに書き込めませんでした。")
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not self.client or not self.client.is_connected:
+                raise ConnectionError(f"ESP32-{self.num} ({self.address}) は接続されていません。")
+            begin = time.monotonic()
             try:
-                await self.client.write_gatt_char(self.char_uuid, header + data, response=False)
-                return
-            except BleakDBusError as e:
-                print("⚠️ BLE通信エラー:", e)
+                await self.client.write_gatt_char(self.char_uuid, packet, response=False)
+            except Exception as e:  # BleakDBusErrorなど（コントローラーが混雑している）
+                error = e
+                self._next_write = time.monotonic() + delay
+                delay *= 2
+                if attempt < self.retries:
+                    self.retried += 1
                 continue
+            end = time.monotonic()
+            # sleepの遅れで書き込み回数が減らないよう、予定時刻から間隔を空ける（しばらく書き込んでいなければ今から）
+            slot = self._next_write if begin - self._next_write < self.write_interval else begin
+            self._next_write = slot + self.write_interval
+            self._write_times.append(end - begin)
+            self._write_stamps.append(end)
+            self.bytes_sent += len(packet)
+            self.writes += 1
+            self.airtime += (len(packet) + _PACKET_OVERHEAD) * _AIRTIME_PER_BYTE
+            return
+        self.failures += 1
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        """書き込みの回数・バイト数・失敗した回数と、直近の1秒あたりの書き込み回数・書き込み時間（秒）"""
+        stamps = self._write_stamps
+        rate = (len(stamps) - 1) / (stamps[-1] - stamps[0]) if len(stamps) > 1 and stamps[-1] > stamps[0] else 0.0
+        return {'writes': self.writes, 'bytes': self.bytes_sent, 'writes_per_s': rate,
+                'retried': self.retried, 'failures': self.failures, 'expired': self.expired,
+                'airtime': self.airtime,
+                'write_p50': percentile(self._write_times, 0.5),
+                'write_p99': percentile(self._write_times, 0.99)}
@@ -0,0 +1,224 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Any
+from tools.data_manager import DataManager, ChangeTracker, BATCH_IDENTIFIER
+from tools.log import get_logger
+from tools.stats import percentile
+
+
+class BleMailbox:
+    """1つのESPへの書き込みを受け持つ、識別子ごとの最新値の郵便受け
+    put()は待たずに識別子ごとの枠にDataManagerを入れ、書き込みタスクがBLEの実際の速さで取り出して書き込む。
+    書き込み中に同じ識別子の値が届いた場合は枠が上書きされ、古い値は送らずに最新の値だけを送る（まとめ）。
+    設定コマンドのように1つずつ意味があるものは send_command() で順番通りに送る。
+    値は最後に入れてからmax_age秒、コマンドはcommand_max_age秒を過ぎたら古いものとして書き込まない。
+    """
+
+    def __init__(self, esp, keepalive: float = 1.0, batch: bool = False, window: int = 256,
+                 max_age: float = None, command_max_age: float = None):
+        """コンストラクタ
+        :param esp: 書き込み先（send(識別子, データ, 期限)を持つBle）
+        :param keepalive: 前回書き込んだ内容と同じ値を送り直す間隔（秒）
+        :param batch: まとめたフレーム（BATCH_IDENTIFIER）で1回の書き込みにするか
+        :param window: パーセンタイルの計算に使う直近の書き込みの数
+        :param max_age: 値を書き込む期限（最後に入れてからの秒数, Noneで期限なし）
+        :param command_max_age: コマンドを書き込む期限（入れてからの秒数, Noneで期限なし）
+        """
+        self.esp = esp
+        self.batch = batch
+        self.max_age = max_age
+        self.command_max_age = command_max_age
+        self.tracker = ChangeTracker(keepalive)  # 前回書き込んだ内容と同じ値は書き込まない
+        self._slots = {}           # 識別子 -> [BLEでの識別子, DataManager, 最初に入れた時刻, 最後に入れた時刻]
+        self._commands = deque()   # (BLEでの識別子, データ, 入れた時刻)
+        self._ready = asyncio.Event()
+        self._latencies = deque(maxlen=window)  # 入れてから書き込み終わるまで（秒）
+        self._writes = deque(maxlen=window)     # BLEへの書き込みにかかった時間（秒）
+        self._failing = False
+        self._log = get_logger('esp')
+        self.put_count = 0   # 入れた値・コマンドの数
+        self.written = 0     # 書き込んだ値・コマンドの数
+        self.coalesced = 0   # 書き込む前に新しい値で上書きされた数
+        self.unchanged = 0   # 前回書き込んだ内容と同じで書き込まなかった数
+        self.errors = 0      # 書き込みに失敗した回数
+        self.expired = 0     # 期限を過ぎて書き込まなかった値・コマンドの数
+        self.max_depth = 0   # 書き込み待ちの数の最大値
+
+    def __repr__(self):
+        return f"BleMailbox {self.esp} {self.stats()}"
+
+    def put(self, ble_identifier: int, manager: DataManager):
+        """最新の値を書き込み待ちにする（書き込みを待たない）
+        書き込むときにDataManagerをパックするので、それまでに届いた値は最新のものだけが送られる
+        :param ble_identifier: ESPに送るときの識別子
+        :param manager: 送るDataManager
+        """
+        self.put_count += 1
+        now = time.monotonic()
+        slot = self._slots.get(ble_identifier)
+        if slot is not None:
+            self.coalesced += 1
+            slot[1] = manager
+            slot[3] = now
+        else:
+            self._slots[ble_identifier] = [ble_identifier, manager, now, now]
+            self._wake()
+
+    def send_command(self, ble_identifier: int, data: bytes):
+        """上書きせずに順番通りに送るコマンドを書き込み待ちにする（値の枠より先に書き込む）"""
+        self.put_count += 1
+        self._commands.append((ble_identifier, bytes(data), time.monotonic()))
+        self._wake()
+
+    def depth(self) -> int:
+        """書き込み待ちの数"""
+        return len(self._slots) + len(self._commands)
+
+    def reset(self):
+        """書き込みの記録を消し、次の値は内容が同じでも必ず送る（再接続時など）"""
+        self.tracker.reset()
+
+    def _wake(self):
+        depth = self.depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        self._ready.set()
+
+    async def _write(self, identifier: int, data: bytes, started: list, deadline: float = None) -> bool:
+        """1回書き込み、書き込み時間と入れてからの時間を記録する
+        :param started: 書き込んだ値・コマンドを入れた時刻のリスト
+        :param deadline: これを過ぎたら書き込まない時刻（Noneで期限なし）
+        """
+        begin = time.monotonic()
+        if deadline is not None and begin > deadline:
+            self.expired += len(started)
+            return False
+        try:
+            await self.esp.send(identifier, data, deadline)
+        except TimeoutError:  # 再試行や書き込み間隔を待つうちに期限を過ぎた
+            self.expired += len(started)
+            return False
+        except Exception as e:  # 未接続（ConnectionError）やBLEのエラーでも書き込みタスクは止めない
+            self.errors += 1
+            if not self._failing:
+                self._log.warning("⚠️ %s", e)
+            self._failing = True
+            return False
+        now = time.monotonic()
+        self._failing = False
+        self._writes.append(now - begin)
+        for put_at in started:
+            self._latencies.append(now - put_at)
+        self.written += len(started)
+        return True
+
+    async def run(self):
+        """書き込みループ（ESPごとにタスクとして起動する）"""
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self._commands:
+                identifier, data, put_at = self._commands.popleft()
+                deadline = None if self.command_max_age is None else put_at + self.command_max_age
+                await self._write(identifier, data, [put_at], deadline)
+
+            slots = list(self._slots.values())
+            self._slots.clear()
+            now = time.monotonic()
+            records = [slot for slot in slots if self.tracker.is_dirty(slot[1], now)]
+            self.unchanged += len(slots) - len(records)
+            if self.max_age is not None:
+                fresh = [slot for slot in records if now <= slot[3] + self.max_age]
+                self.expired += len(records) - len(fresh)
+                records = fresh
+            if not records:
+                continue
+            # 書き込みを待つ間に新しい値が届いても送ったことにしないよう、パックした時点のバージョンを覚える
+            if self.batch and len(records) > 1:
+                managers = [manager for _, manager, _, _ in records]
+                versions = [manager.version() for manager in managers]
+                data = DataManager.pack_batch(managers, [identifier for identifier, _, _, _ in records])
+                deadline = self._deadline(min(last_put for _, _, _, last_put in records))
+                if await self._write(BATCH_IDENTIFIER, data, [put_at for _, _, put_at, _ in records], deadline):
+                    for manager, version in zip(managers, versions):
+                        self.tracker.mark_sent(manager, version=version)
+                continue
+            for identifier, manager, put_at, last_put in records:
+                version = manager.version()
+                if await self._write(identifier, manager.pack(), [put_at], self._deadline(last_put)):
+                    self.tracker.mark_sent(manager, version=version)
+
+    def _deadline(self, last_put: float) -> float:
+        return None if self.max_age is None else last_put + self.max_age
+
+    def stats(self) -> Dict[str, Any]:
+        """書き込み待ちの数・まとめた数と、書き込みの時間（秒）の統計
+        latencyは値を入れてから書き込み終わるまで、writeはBLEへの書き込みそのものにかかった時間
+        """
+        return {'depth': self.depth(), 'max_depth': self.max_depth, 'put': self.put_count,
+                'written': self.written, 'coalesced': self.coalesced,
+                'unchanged': self.unchanged, 'errors': self.errors, 'expired': self.expired,
+                'latency_p50': percentile(self._latencies, 0.5),
+                'latency_p99': percentile(self._latencies, 0.99),
+                'write_p50': percentile(self._writes, 0.5),
+                'write_p99': percentile(self._writes, 0.99)}
+
+
+class BleRelay:
+    """PCから届いたフレームを中継先のESPの書き込み待ちに入れる
+    Tcpの受信ハンドラーとしてmemoryviewのまま呼び出し、中継表で長さだけを確認して
+    DataManagerのバッファにコピーする。ESPへは受け取ったバイト列をそのまま識別子だけ変えて送り、
+    リストへのデコードはRasp側でget()が呼ばれたときだけ行う。
+    """
+
+    def __init__(self, protocol, mailboxes: dict):
+        """コンストラクタ
+        :param protocol: 中継表を作ったProtocol（build()のあと）
+        :param mailboxes: ESPのdevice番号 -> BleMailbox
+        """
+        self._route = protocol.route
+        self._mailboxes = mailboxes
+        # 中継先があり、受信ハンドラーとして登録する識別子
+        self.identifiers = []
+        for identifier in range(256):
+            route = protocol.route(identifier)
+            if route is not None and route.targets:
+                self.identifiers.append(identifier)
+        self.forwarded = 0  # 中継したフレーム数
+        self.invalid = 0    # 長さが合わずに捨てたフレーム数
+        self._log = get_logger('relay')
+
+    def __repr__(self):
+        return f"BleRelay {self.stats()}"
+
+    def forward(self, identifier: int, payload: memoryview):
+        """1つのフレームを中継する（受信ハンドラー）"""
+        route = self._route(identifier)
+        if route is None or route.size != len(payload):
+            self.invalid += 1
+            self._log.warning("⚠️ 不明なフレーム: 識別子 0x%02X, %dバイト", identifier, len(payload))
+            return
+        manager = route.manager
+        manager.unpack_from(payload)  # バイト列のコピーのみ
+        for device, ble_identifier in route.targets:
+            self._mailboxes[device].put(ble_identifier, manager)
+        self.forwarded += 1
+
+    def forward_batch(self, identifier: int, payload: memoryview):
+        """まとめたフレーム（BATCH_IDENTIFIER）を中継する（受信ハンドラー）"""
+        try:
+            managers = DataManager.unpack_batch(payload)
+        except ValueError as e:
+            self.invalid += 1
+            self._log.warning("⚠️ 不正なまとめたフレーム: %s", e)
+            return
+        for manager in managers:
+            route = self._route(manager.identifier())
+            for device, ble_identifier in route.targets:
+                self._mailboxes[device].put(ble_identifier, manager)
+        self.forwarded += len(managers)
+
+    def stats(self) -> Dict[str, int]:
+        """中継した・捨てたフレーム数"""
+        return {'forwarded': self.forwarded, 'invalid': self.invalid}
@@ -0,0 +1,183 @@
+import asyncio
+import random
+import time
+from typing import Dict, Any
+
+from tools.ble import _wait_event
+from tools.config import load_config
+from tools.log import get_logger
+
+# 接続状態
+DISCONNECTED = 'disconnected'  # 切断（接続が切れた・停止した）
+CONNECTING = 'connecting'      # 接続中（スキャン・接続・通知の開始）
+CONNECTED = 'connected'        # 接続済み（通知を受け取れる）
+BACKOFF = 'backoff'            # 接続に失敗して再試行を待っている
+
+
+class BleManager:
+    """複数のESPへの接続をESPごとの監視タスクで保つ
+    すべてのESPに同時に接続を始め、失敗したESPだけが待ち時間を伸ばしながら（ランダムに揺らして）再試行する。
+    接続が切れたら自動で接続し直し、接続状態が変わるたびに登録した関数を呼び出す。
+    見つけたBLEDeviceはBle側にキャッシュされ、続けて失敗した場合のみスキャンし直す。
+    """
+
+    def __init__(self, esps: list, receive_func: callable, ble_config: Dict[str, Any] = None):
+        """コンストラクタ
+        :param esps: 接続するBleのリスト
+        :param receive_func: 通知を受け取ったときのコールバック (device番号, 識別子, データ)
+        :param ble_config: 再接続の設定（省略時はconfig.yamlのble）
+        """
+        if ble_config is None:
+            ble_config = load_config('ble')
+        self.esps = list(esps)
+        self._receive_func = receive_func
+        self.initial_delay = ble_config.get('initial_delay', 0.5)
+        self.max_delay = ble_config.get('max_delay', 10.0)
+        self.factor = ble_config.get('factor', 2.0)
+        self.jitter = ble_config.get('jitter', 0.5)
+        self.rescan_failures = ble_config.get('rescan_failures', 3)
+        self.check_interval = ble_config.get('check_interval', 1.0)
+        self._random = random.Random()
+        self._log = get_logger('ble')
+        self._tasks = {}       # device番号 -> 監視タスク
+        self._lost = {}        # device番号 -> 接続が切れたことを知らせるEvent
+        self._states = {esp.num: DISCONNECTED for esp in self.esps}
+        self._ready = {esp.num: asyncio.Event() for esp in self.esps}  # 接続済み（通知を受け取れる）の間セットされる
+        self._state_listeners = []
+        self._started_at = None
+        self.ready_time = {}   # device番号 -> start()から最初に接続できるまでの時間（秒）
+        self.attempts = {esp.num: 0 for esp in self.esps}    # 接続を試みた回数
+        self.failures = {esp.num: 0 for esp in self.esps}    # 接続に失敗した回数
+        self.reconnects = {esp.num: 0 for esp in self.esps}  # 接続が切れた後に接続し直した回数
+        for esp in self.esps:
+            esp.on_disconnect(self._on_disconnect)
+
+    def __repr__(self):
+        return f"BleManager {self._states}"
+
+    def on_state_change(self, listener: callable):
+        """接続状態が変わったときに呼び出す関数を登録する
+        :param listener: (Ble, 状態) を引数に呼び出される関数
+        """
+        self._state_listeners.append(listener)
+
+    def state(self, num: int) -> str:
+        """ESPの接続状態"""
+        return self._states[num]
+
+    def is_running(self) -> bool:
+        """監視タスクが動いているか"""
+        return bool(self._tasks)
+
+    def delay(self, failures: int) -> float:
+        """failures回続けて失敗した後の待ち時間"""
+        delay = min(self.max_delay, self.initial_delay * self.factor ** (failures - 1))
+        return delay * (1 - self.jitter * self._random.random())
+
+    def start(self):
+        """すべてのESPの監視タスクを起動する（すでに動いている場合は何もしない）"""
+        if self._tasks:
+            return
+        self._started_at = time.monotonic()
+        self.ready_time.clear()
+        for esp in self.esps:
+            self._lost[esp.num] = asyncio.Event()
+            self._tasks[esp.num] = asyncio.create_task(self._supervise(esp))
+
+    async def stop(self):
+        """監視タスクを止め、すべてのESPから切断する"""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def wait_ready(self, num: int, timeout: float = None) -> bool:
+        """ESPが接続して通知を開始するまで待つ（すでに接続済みならすぐに返る）
+        :param num: ESPのdevice番号
+        :param timeout: 待つ時間の上限（秒, Noneで無制限）
+        :return: 接続済みになったか
+        """
+        return await _wait_event(self._ready[num], timeout)
+
+    async def wait_connected(self, timeout: float = None) -> bool:
+        """すべてのESPが接続済みになるまで待つ
+        :param timeout: 待つ時間の上限（秒, Noneで無制限）
+        :return: すべて接続済みになったか
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not all(ready.is_set() for ready in self._ready.values()):
+            for num, ready in self._ready.items():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                await _wait_event(ready, remaining)
+        return True
+
+    def _set_state(self, esp, state: str):
+        if self._states[esp.num] == state:
+            return
+        self._states[esp.num] = state
+        for listener in self._state_listeners:
+            listener(esp, state)
+        # 待っているタスクが動くのは登録した関数（書き込み待ちのリセットなど）の後
+        if state == CONNECTED:
+            self._ready[esp.num].set()
+        else:
+            self._ready[esp.num].clear()
+
+    def _on_disconnect(self, esp):
+        lost = self._lost.get(esp.num)
+        if lost is not None:
+            lost.set()
+
+    async def _supervise(self, esp):
+        """1つのESPに接続し、切れたら接続し直す"""
+        lost = self._lost[esp.num]
+        failures = 0
+        connected_once = False
+        try:
+            while True:
+                self._set_state(esp, CONNECTING)
+                self.attempts[esp.num] += 1
+                lost.clear()
+                try:
+                    await esp.connect(self._receive_func)
+                except Exception as e:  # 見つからない・BLEのエラーなど
+                    failures += 1
+                    self.failures[esp.num] += 1
+                    if failures % self.rescan_failures == 0:
+                        esp.forget()  # アドレスの広告が変わった可能性があるのでスキャンし直す
+                    delay = self.delay(failures)
+                    self._log.warning("⚠️ %s 接続失敗 (%d回目): %s - %.2f秒後に再試行", esp, failures, e, delay)
+                    self._set_state(esp, BACKOFF)
+                    await asyncio.sleep(delay)
+                    continue
+
+                failures = 0
+                if connected_once:
+                    self.reconnects[esp.num] += 1
+                elif esp.num not in self.ready_time:
+                    self.ready_time[esp.num] = time.monotonic() - self._started_at
+                connected_once = True
+                self._set_state(esp, CONNECTED)
+
+                # 切断の通知を待つ（通知が来ない場合に備えて一定間隔で接続状態も確認する）
+                # wait_forは通知と同時にキャンセルされるとキャンセルを握りつぶすことがあるためwaitを使う
+                waiter = asyncio.ensure_future(lost.wait())
+                try:
+                    while not lost.is_set() and esp.is_connected():
+                        await asyncio.wait([waiter], timeout=self.check_interval)
+                finally:
+                    waiter.cancel()
+                self._set_state(esp, DISCONNECTED)
+        finally:
+            await esp.disconnect()
+            self._set_state(esp, DISCONNECTED)
+
+    def stats(self) -> Dict[str, Any]:
+        """ESPごとの状態・接続の試行・失敗・再接続の回数と、最初に接続できるまでの時間（秒）"""
+        return {esp.num: {'state': self._states[esp.num], 'attempts': self.attempts[esp.num],
+                          'failures': self.failures[esp.num], 'reconnects': self.reconnects[esp.num],
+                          'ready_time': self.ready_time.get(esp.num)}
+                for esp in self.esps}
@@ -0,0 +1,306 @@
+import asyncio
+import random
+import struct
+import time
+from collections import deque
+from typing import Dict, Any
+
+from tools.data_manager import BATCH_IDENTIFIER
+from tools.protocol import CPP_TYPES
+from tools.stats import percentile
+
+# ESP32のDataManager<T>の型 -> structの形式
+_CPP_FORMATS = {ctype: data_type.value for data_type, ctype in CPP_TYPES.items()}
+
+
+class SimDataManager:
+    """ESP32のDataManager<T>（lib/DataManager/QuadKenDataManager.h）の疑似
+    受け取ったバイト列を型を見ずにそのままコピーする（memcpyと同じ）。
+    """
+    __slots__ = ('name', 'identifier', 'length', 'format', 'data', 'updates', 'updated_at')
+
+    def __init__(self, name: str, ctype: str, identifier: int, length: int):
+        """コンストラクタ
+        :param name: ESPのソースでの変数名
+        :param ctype: DataManager<T>のT（uint8_t など）
+        """
+        self.name = name
+        self.identifier = identifier
+        self.length = length
+        self.format = struct.Struct('<' + _CPP_FORMATS[ctype] * length)
+        self.data = bytearray(self.format.size)
+        self.updates = 0         # 受け取った回数
+        self.updated_at = None   # 最後に受け取った時刻（time.monotonic）
+
+    def __repr__(self):
+        return f"DataManager {self.name}({self.identifier}, {self.length}) : {self.get()}"
+
+    def size(self) -> int:
+        """getExpectedSize()"""
+        return self.format.size
+
+    def get(self) -> list:
+        return list(self.format.unpack(self.data))
+
+    def pack(self) -> bytes:
+        return bytes(self.data)
+
+    def unpack_from(self, data, offset: int = 0):
+        """unpackFrom()（長さは確認済み）"""
+        self.data[:] = data[offset:offset + len(self.data)]
+
+
+class SimFirmware:
+    """ESP32のファームウェアの受信処理（receiveCallback・applyData）の疑似
+    DataManagerBase::unpackAny・unpackBatchと同じ確認を行う。ESP32ではabort()になる不正なデータを
+    受け取った場合はValueErrorにし、SimEsp側で再起動（切断してすべての値を0に戻す）として扱う。
+    """
+
+    def __init__(self, protocol, link: str):
+        """コンストラクタ
+        :param protocol: スキーマを読み込んだProtocol
+        :param link: protocol.yamlのlinksの名前（ESP1, ESP2）
+        """
+        self.link = link
+        self.managers = {}  # 識別子 -> SimDataManager
+        for ctype, name, identifier, length in protocol.firmware_declarations(link):
+            self.managers[identifier] = SimDataManager(name, ctype, identifier, length)
+        self.by_name = {manager.name: manager for manager in self.managers.values()}
+        self.setup = False  # config 1でサーボ・BLDCをattachし、3・0・切断でdetachする
+        self._listeners = []
+
+    def __repr__(self):
+        return f"SimFirmware {self.link} {list(self.by_name)}"
+
+    def on_update(self, listener: callable):
+        """値を受け取ったときに呼び出す関数を登録する（ベンチマーク用）
+        :param listener: (SimDataManager, セットアップ済みか) を引数に呼び出される関数
+        """
+        self._listeners.append(listener)
+
+    def receive(self, data, now: float = None):
+        """書き込まれたデータ（[識別子][データ...]）を受け取る
+        :raises ValueError: ESP32ではabort()になるデータの場合
+        """
+        if now is None:
+            now = time.monotonic()
+        if len(data) < 1:
+            raise ValueError("Empty write")
+        identifier = data[0]
+        if identifier == BATCH_IDENTIFIER:
+            for manager in self._unpack_batch(data, 1):
+                self._apply(manager, now)
+            return
+        manager = self.managers.get(identifier)
+        if manager is None:
+            raise ValueError("No instance found for identifier")
+        if len(data) - 1 != manager.size():
+            raise ValueError("Buffer size mismatch for identifier")
+        manager.unpack_from(data, 1)
+        self._apply(manager, now)
+
+    def _unpack_batch(self, data, offset: int) -> list:
+        """DataManagerBase::unpackBatch（全体の長さを確認してから書き込む）"""
+        if len(data) <= offset or len(data) < offset + 1 + data[offset]:
+            raise ValueError("Batch header too short")
+        count = data[offset]
+        managers = []
+        total = offset + 1 + count
+        for identifier in data[offset + 1:offset + 1 + count]:
+            manager = self.managers.get(identifier)
+            if manager is None:
+                raise ValueError("No instance found for identifier in batch")
+            managers.append(manager)
+            total += manager.size()
+        if len(data) != total:
+            raise ValueError("Batch size mismatch")
+        position = offset + 1 + count
+        for manager in managers:
+            manager.unpack_from(data, position)
+            position += manager.size()
+        return managers
+
+    def _apply(self, manager: SimDataManager, now: float):
+        manager.updates += 1
+        manager.updated_at = now
+        if manager.name == 'config_data':
+            command = manager.data[0]
+            if command == 1:
+                self.setup = True
+            elif command in (0, 3):
+                self.setup = False
+        for listener in self._listeners:
+            listener(manager, self.setup)
+
+    def reset(self):
+        """再起動（すべての値を0に戻す）"""
+        for manager in self.managers.values():
+            manager.data[:] = bytes(len(manager.data))
+        self.setup = False
+
+
+class SimEsp:
+    """BLEで接続する疑似ESP32（接続時間・書き込みの遅延とばらつき・書き込みが失われる割合・通知を設定できる）"""
+
+    def __init__(self, num: int, firmware: SimFirmware, sim_config: Dict[str, Any] = None, seed: int = None):
+        """コンストラクタ
+        :param num: device番号
+        :param firmware: 受信処理
+        :param sim_config: config.yamlのble.simと同じ形式の設定
+        :param seed: 乱数の種（省略時は毎回変わる）
+        """
+        sim_config = sim_config or {}
+        self.num = num
+        self.firmware = firmware
+        self.connect_time = sim_config.get('connect_time', 0.3)
+        self.write_latency = sim_config.get('write_latency', 0.002)
+        self.jitter = sim_config.get('jitter', 0.001)
+        self.drop_rate = sim_config.get('drop_rate', 0.0)
+        self.notify = list((sim_config.get('notify') or {}).get(firmware.link, []))
+        self._random = random.Random(seed)
+        self.client = None       # 接続中のSimClient
+        self._tasks = []         # 通知タスク
+        self._latencies = deque(maxlen=sim_config.get('window', 256))  # 書き込みにかかった時間（秒）
+        self.connects = 0        # 接続した回数
+        self.writes = 0          # 受け取った書き込みの数
+        self.dropped = 0         # 失われた書き込みの数
+        self.aborts = 0          # 不正なデータで再起動した回数
+        self.notified = 0        # 送った通知の数
+
+    def __repr__(self):
+        return f"SimEsp-{self.num} ({self.firmware.link})"
+
+    async def _connect(self, client):
+        await asyncio.sleep(self.connect_time)
+        if self.client is not None and self.client is not client:
+            self._drop()  # 古い接続は切れたことにする
+        self.client = client
+        self.connects += 1
+
+    def _start_notify(self, callback: callable):
+        for stream in self.notify:
+            manager = self.firmware.by_name[stream['firmware']]
+            self._tasks.append(asyncio.create_task(self._notify(manager, stream.get('rate', 10.0), callback)))
+
+    async def _notify(self, manager: SimDataManager, rate: float, callback: callable):
+        """rate回/秒で値を通知する（値は通知ごとに1ずつ増える）"""
+        interval = 1.0 / rate
+        next_at = time.monotonic()
+        tick = 0
+        while True:
+            next_at += interval
+            await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+            tick += 1
+            values = [(tick + i) % 100 for i in range(manager.length)]
+            manager.format.pack_into(manager.data, 0, *values)
+            callback(None, bytearray([manager.identifier]) + manager.data)
+            self.notified += 1
+
+    async def _write(self, client, data):
+        begin = time.monotonic()
+        await asyncio.sleep(self.write_latency + self.jitter * self._random.random())
+        if client is not self.client:
+            raise ConnectionError(f"ESP32-{self.num} は接続されていません。")
+        self._latencies.append(time.monotonic() - begin)
+        if self._random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        self.writes += 1
+        try:
+            self.firmware.receive(data)
+        except ValueError:  # ESP32ではabort()で再起動し、接続が切れる
+            self.aborts += 1
+            self.firmware.reset()
+            self._drop()
+
+    def _drop(self):
+        """ESP側から接続が切れる（切断時の関数を呼び出す）"""
+        client = self.client
+        self._disconnect()
+        if client is not None:
+            client._lost()
+
+    def _disconnect(self):
+        self.client = None
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self.firmware.setup = False  # onBLEDisconnected()でdetachAll()
+
+    def drop(self):
+        """接続が切れたことにする（再接続のテスト用）"""
+        self._drop()
+
+    def stats(self) -> Dict[str, Any]:
+        """受け取った・失われた書き込みの数と、書き込みにかかった時間（秒）"""
+        return {'connects': self.connects, 'writes': self.writes, 'dropped': self.dropped,
+                'aborts': self.aborts, 'notified': self.notified, 'write_p99': percentile(self._latencies, 0.99),
+                'setup': self.firmware.setup}
+
+
+class SimClient:
+    """BleakClientの代わりにSimEspに接続するクライアント（Bleが使うメソッドだけを持つ）"""
+
+    def __init__(self, esp: SimEsp, disconnected_callback: callable = None):
+        self.esp = esp
+        self._disconnected_callback = disconnected_callback
+
+    @property
+    def is_connected(self) -> bool:
+        return self.esp.client is self
+
+    async def connect(self) -> bool:
+        await self.esp._connect(self)
+        return True
+
+    async def disconnect(self) -> bool:
+        if self.is_connected:
+            self.esp._disconnect()
+            self._lost()
+        return True
+
+    async def start_notify(self, char_uuid, callback: callable):
+        if not self.is_connected:
+            raise ConnectionError(f"ESP32-{self.esp.num} は接続されていません。")
+        self.esp._start_notify(callback)
+
+    async def write_gatt_char(self, char_uuid, data, response: bool = False):
+        if not self.is_connected:
+            raise ConnectionError(f"ESP32-{self.esp.num} は接続されていません。")
+        await self.esp._write(self, bytes(data))
+
+    def _lost(self):
+        if self._disconnected_callback is not None:
+            self._disconnected_callback(self)
+
+
+class SimBackend:
+    """実機の代わりにプロセス内の疑似ESPに接続するBleのバックエンド
+    protocol.yamlのlinksのdevice番号でESPを決め、そのESPのソースにあるDataManager<T>を持つ疑似ESPを作る。
+    """
+
+    def __init__(self, protocol, sim_config: Dict[str, Any] = None):
+        """コンストラクタ
+        :param protocol: スキーマを読み込んだProtocol
+        :param sim_config: config.yamlのble.simと同じ形式の設定
+        """
+        self.sim_config = sim_config or {}
+        seed = self.sim_config.get('seed')
+        self.esps = {}  # device番号 -> SimEsp
+        for index, (link, spec) in enumerate(protocol.links.items()):
+            self.esps[spec['device']] = SimEsp(spec['device'], SimFirmware(protocol, link), self.sim_config,
+                                               None if seed is None else seed + index)
+
+    def __repr__(self):
+        return f"sim {list(self.esps.values())}"
+
+    async def find_device(self, esp):
+        """ESPを探す（protocol.yamlにないdevice番号はNone）"""
+        await asyncio.sleep(0)
+        return self.esps.get(esp.num)
+
+    def client(self, device: SimEsp, disconnected_callback: callable) -> SimClient:
+        return SimClient(device, disconnected_callback)
+
+    def stats(self) -> Dict[int, Dict[str, Any]]:
+        return {num: esp.stats() for num, esp in self.esps.items()}
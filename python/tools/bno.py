@@ -1,18 +1,53 @@
-import board
-import busio
-import adafruit_bno055
+try:
+    import board
+    import busio
+    import adafruit_bno055
+except ImportError:  # BNO055のない環境（ble.backend: sim で動かす場合など）ではconnect()が失敗する
+    board = busio = adafruit_bno055 = None
 import numpy as np
 import math
+import threading
+import time
+
+from tools.log import get_logger
+from tools.stats import percentile
+
+# サンプルのリングバッファの列（1行が1サンプル）
+_SEQ, _TIME, _YAW, _PITCH, _ROLL = range(5)
 
 
 class BNOSensor:
-    """BNO055センサーを制御するクラス"""
+    """BNO055センサーを制御するクラス
+
+    start_sampler()でバックグラウンドのスレッドが一定の間隔でI2Cから角度を読み、
+    時刻付きでリングバッファに書き込む。非同期のコードはlatest()でロックを取らずに最新のサンプルを読める
+    （書き込みスレッドは行を書き終えてから番号を公開し、読む側は行の番号で書き換え中でないことを確かめる）。
+    """
     
-    def __init__(self):
-        """BNOSensorインスタンスを初期化"""
+    def __init__(self, capacity=256, window=256):
+        """BNOSensorインスタンスを初期化
+
+        Args:
+            capacity (int): サンプルのリングバッファの行数
+            window (int): 達成したサンプリングレートとI2Cの読み取り時間の計算に使う直近のサンプルの数
+        """
         self.i2c = None
         self.sensor = None
         self.connected = False
+
+        self.capacity = capacity
+        self._ring = np.zeros((capacity, 5))  # [番号, 時刻（time.monotonic）, yaw, pitch, roll]
+        self._ring[:, _SEQ] = -1
+        self._published = -1  # 最後に書き終えたサンプルの番号
+        self._read_times = np.zeros(window)  # I2Cの読み取りにかかった時間（秒）
+        self._thread = None
+        self._stop = threading.Event()
+        self._log = get_logger('bno')
+        self.rate = None
+        self.i2c_errors = 0        # 読み取りに失敗した回数
+        self.connect_failures = 0  # 接続に失敗した回数
+        self.empty = 0             # センサーが値を返さなかった回数
+        self.overruns = 0          # 読み取りが間隔に間に合わず、次の読み取りを遅らせた回数
     
     def connect(self):
         """BNO055センサーに接続する
@@ -24,6 +59,8 @@ class BNOSensor:
             Exception: I2C接続またはセンサー初期化に失敗した場合
         """
         try:
+            if board is None:
+                raise ImportError("adafruit_bno055（board, busio）がインストールされていません")
             # I2C接続を初期化
             self.i2c = busio.I2C(board.SCL, board.SDA)
             
@@ -98,5 +135,124 @@ class BNOSensor:
         """センサーとの接続を切断する"""
         if self.i2c:
             self.i2c.deinit()
+            self.i2c = None
         self.sensor = None
-        self.connected = False
\ No newline at end of file
+        self.connected = False
+
+    def start_sampler(self, rate=100.0, reconnect_delay=1.0):
+        """バックグラウンドで角度を読み続けるスレッドを起動する（すでに動いている場合は何もしない）
+
+        接続していなければスレッドが接続し、読み取りに失敗したらreconnect_delay秒後に接続し直す。
+
+        Args:
+            rate (float): 1秒あたりの読み取り回数
+            reconnect_delay (float): 接続・読み取りに失敗してから接続し直すまでの時間（秒）
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.rate = rate
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, args=(1.0 / rate, reconnect_delay),
+                                        name="BNOSampler", daemon=True)
+        self._thread.start()
+
+    def stop_sampler(self, timeout=1.0):
+        """読み取りスレッドを止める（I2Cの読み取りが終わるまで待つ）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_sampling(self):
+        """読み取りスレッドが動いているか"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def _sample(self, interval, reconnect_delay):
+        """読み取りスレッドの本体"""
+        seq = self._published
+        next_at = time.monotonic()
+        while not self._stop.is_set():
+            if not self.connected:
+                try:
+                    self.connect()
+                    self._log.info("✅ BNO055センサー接続成功")
+                except Exception as e:
+                    self.connect_failures += 1
+                    self._log.warning("⚠️ BNO055センサー接続失敗: %s", e)
+                    self._stop.wait(reconnect_delay)
+                    next_at = time.monotonic()
+                    continue
+
+            begin = time.monotonic()
+            try:
+                angles = self.euler()
+            except Exception as e:  # I2Cのエラー（euler()は接続を切れたことにする）
+                self.i2c_errors += 1
+                self._log.warning("⚠️ BNO055センサーエラー: %s", e)
+                self.disconnect()  # I2Cを解放してから接続し直す
+                self._stop.wait(reconnect_delay)
+                next_at = time.monotonic()
+                continue
+            now = time.monotonic()
+            if angles is None:
+                self.empty += 1
+            else:
+                seq += 1
+                row = self._ring[seq % self.capacity]
+                row[_SEQ] = -1  # 書き換え中
+                row[_TIME] = now
+                row[_YAW], row[_PITCH], row[_ROLL] = angles
+                row[_SEQ] = seq
+                self._read_times[seq % len(self._read_times)] = now - begin
+                self._published = seq  # 書き終えてから公開する
+
+            next_at += interval
+            delay = next_at - time.monotonic()
+            if delay < 0:
+                self.overruns += 1
+                next_at = time.monotonic()  # 遅れを取り戻そうとまとめて読まない
+            else:
+                self._stop.wait(delay)
+
+    def latest(self):
+        """最新のサンプルを読む（ロックを取らず、I2Cの読み取りを待たない）
+
+        Returns:
+            tuple: (番号, 時刻（time.monotonic）, (yaw, pitch, roll)) 。まだサンプルがなければNone
+        """
+        while True:
+            seq = self._published
+            if seq < 0:
+                return None
+            row = self._ring[seq % self.capacity].copy()
+            if row[_SEQ] == seq:
+                return seq, float(row[_TIME]), (int(row[_YAW]), int(row[_PITCH]), int(row[_ROLL]))
+            # 読んでいる間に一周して書き換えられた（めったに起きない）ので読み直す
+
+    def stats(self):
+        """読み取りスレッドの統計
+
+        Returns:
+            dict: サンプル数・達成したサンプリングレート（回/秒）・I2Cの読み取り時間（秒）・エラーの回数・最新のサンプルの古さ（秒）
+        """
+        seq = self._published
+        count = seq + 1
+        window = min(count, self.capacity, len(self._read_times))
+        achieved = None
+        read_p50 = read_p99 = None
+        if window >= 2:
+            rows = self._ring[[(seq - i) % self.capacity for i in range(window)]]
+            rows = rows[rows[:, _SEQ] >= 0]
+            span = rows[:, _TIME].max() - rows[:, _TIME].min()
+            if span > 0:
+                achieved = float((len(rows) - 1) / span)
+        if window >= 1:
+            read_times = self._read_times[[(seq - i) % len(self._read_times) for i in range(window)]]
+            read_p50 = float(percentile(read_times, 0.5))
+            read_p99 = float(percentile(read_times, 0.99))
+        latest = self.latest()
+        return {'samples': count, 'rate': self.rate, 'achieved_rate': achieved,
+                'read_p50': read_p50, 'read_p99': read_p99,
+                'i2c_errors': self.i2c_errors, 'connect_failures': self.connect_failures,
+                'empty': self.empty, 'overruns': self.overruns,
+                'age': None if latest is None else time.monotonic() - float(latest[1])}
\ No newline at end of file
@@ -1,5 +1,8 @@
-from picamera2 import Picamera2 # type: ignore
-import cv2
+try:
+    from picamera2 import Picamera2 # type: ignore
+    import cv2
+except ImportError:  # カメラのない環境（ble.backend: sim で動かす場合など）ではstart()が失敗する
+    Picamera2 = cv2 = None
 import asyncio
 import numpy as np
 
@@ -12,6 +15,8 @@ class Picam:
         return "Picamera2"
 
     def start(self):
+        if Picamera2 is None:
+            raise ImportError("picamera2がインストールされていません。")
         self.picam = Picamera2()
         self.picam.configure(self.picam.create_video_configuration(main={"format": 'RGB888', "size": (720, 480)}))
         self.picam.start()
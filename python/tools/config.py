@@ -0,0 +1,34 @@
+import os
+from typing import Dict, Any
+
+import yaml
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
+
+
+def read_config(section: str = None) -> Dict[str, Any]:
+    """config.yamlを読み込む（存在しない場合は空の辞書を返す）
+    :param section: 取り出す項目（tcp, ble, log など。省略時は全体）
+    :return: 設定の辞書
+    :raises Exception: ファイルが読めない、またはYAMLとして正しくない場合
+    """
+    if not os.path.exists(CONFIG_PATH):
+        return {}
+    with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f) or {}
+    if section is None:
+        return config
+    return config.get(section) or {}
+
+
+def load_config(section: str = None) -> Dict[str, Any]:
+    """config.yamlを読み込む（読めない場合はエラーをログに出して空の辞書を返す）
+    :param section: 取り出す項目（tcp, ble, log など。省略時は全体）
+    :return: 設定の辞書
+    """
+    try:
+        return read_config(section)
+    except Exception as e:
+        from tools.log import get_logger  # tools.logもこのモジュールで設定を読むため、ここで読み込む
+        get_logger('config').error("[設定エラー] %s", e)
+        return {}
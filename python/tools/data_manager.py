@@ -1,6 +1,14 @@
 import struct
+import time
+from collections import OrderedDict
 from enum import Enum
 
+# 複数のDataManagerをまとめたフレームの識別子（[件数][識別子...][データ...]）
+BATCH_IDENTIFIER = 0xFC
+_monotonic = time.monotonic
+# 受信したまとめたフレームの形式を覚えておく数（ヘッダーは受信データなので、古いものから捨てる）
+_BATCH_CACHE_SIZE = 64
+
 class DataType(Enum):
     UINT8 = "B"
     UINT16 = "H"
@@ -13,8 +21,13 @@ class DataManager:
     """データ管理クラス
     1byteの識別子を持ち、指定された長さとデータ型でデータを管理する。
     データをはコンストラクタで指定して、パックとアンパックが可能。
+    パック形式はコンストラクタでコンパイルし（ESP32と同じリトルエンディアン）、
+    pack_into/unpack_fromは毎回同じバッファを使い回す。
     """
     _instances = {}
+    # まとめたフレームの形式ごとに計算したデータの位置（同じ組み合わせは計算し直さない）
+    _batch_pack_layouts = {}    # (DataManager, 識別子) -> (ヘッダー,) + _batch_layout()
+    _batch_unpack_layouts = OrderedDict()  # ヘッダー -> _batch_layout()（最近使った順、_BATCH_CACHE_SIZE個まで）
 
     def __init__(self, identifier:int, length:int, data_type:DataType):
         """コンストラクタ
@@ -24,6 +37,8 @@ class DataManager:
         """
         if not 1 <= identifier <= 255:
             raise ValueError("識別子は1〜255の範囲でなければなりません。")
+        if identifier == BATCH_IDENTIFIER:
+            raise ValueError(f"識別子 {identifier} はまとめたフレーム用に予約されています。")
         if identifier in DataManager._instances:
             raise ValueError(f"識別子 {identifier} はすでに使用されています。")
         if length <= 0:
@@ -33,41 +48,198 @@ class DataManager:
         self._identifier:int = identifier
         self._data_type:int = data_type
         self._data = [0] * length  # uint8_t 8個のデータを格納するリスト
-        self._pack_mode = data_type.value * length
+        self._version = 0  # 内容が変わるたびに増えるバージョン
+        self._struct = struct.Struct('<' + data_type.value * length)
+        # 最後にバージョンを増やしたときの内容（パックしたバイト列。get()のリストが直接書き換えられても比較できるように）
+        self._committed = self._struct.pack(*self._data)
+        self._dirty = False  # 最後にバージョンを確認してから値を受け取った（更新した）か
+        self._buffer = bytearray(self._struct.size)  # pack_into/unpack_fromで使い回すバッファ
+        self._view = memoryview(self._buffer)
+        # バッファを要素の型で読むビュー（cast はネイティブのバイト順。Raspberry Pi・PC・ESP32はいずれもリトルエンディアン）
+        self._values = self._view.cast(data_type.value)
+        self._stale = False  # unpack_fromでバッファだけが新しくなり、リストが古いか
+        self._sequence = 0         # 値を受け取る（更新する）たびに増える番号（内容が同じでも増える）
+        self._timestamp = None     # 最後に値を受け取った時刻（time.monotonic）
+        self._sender_time = None   # 送信元が付けた時刻（分かる場合のみ）
+        self._max_gap = 0.0        # 値を受け取る間隔の最大値
+        self._reads = 0            # get_if_freshの呼び出し回数
+        self._stale_reads = 0      # そのうち古すぎて値を返さなかった回数
+        self._age_sum = 0.0
+        self._age_max = 0.0
         DataManager._instances[identifier] = self
 
     def __repr__(self):
-        return f"データ{self._data_type} : {self._data})"
+        return f"データ{self._data_type} : {self.get()})"
     
     def update(self, new_data):
         """データを更新する
+        内容が前回の更新から変わった場合のみバージョンを増やす（比較はversion()を呼んだときに行う）
         :param new_data: 更新するデータのリスト
         """
-        self._data = new_data[:]
+        self._data[:] = new_data  # 新しいリストを作らずに中身だけ入れ替える
+        self._stale = False
+        self._dirty = True
+        self._touch()
+
+    def _touch(self, sender_time: float = None):
+        """値を受け取った時刻と番号を記録する"""
+        now = _monotonic()
+        last = self._timestamp
+        if last is not None and now - last > self._max_gap:
+            self._max_gap = now - last
+        self._timestamp = now
+        self._sender_time = sender_time
+        self._sequence += 1
+
+    def version(self):
+        """データのバージョンを取得する
+        受け取る・更新するたびには比較せず、ここで前回のバージョンの内容とバイト列で比較する
+        :return: 内容が変わるたびに増える整数
+        """
+        if self._dirty:
+            self._dirty = False
+            current = bytes(self._view) if self._stale else self._struct.pack(*self._data)
+            if current != self._committed:
+                self._committed = current
+                self._version += 1
+        return self._version
+
+    def sequence(self):
+        """値を受け取った（更新した）回数を取得する（内容が同じでも増える）"""
+        return self._sequence
+
+    def timestamp(self):
+        """最後に値を受け取った時刻（time.monotonic, まだ受け取っていなければNone）"""
+        return self._timestamp
+
+    def sender_time(self):
+        """最後に受け取った値に送信元が付けた時刻（分からなければNone）"""
+        return self._sender_time
+
+    def age(self, now: float = None):
+        """最後に値を受け取ってからの経過時間（秒, まだ受け取っていなければNone）"""
+        if self._timestamp is None:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return now - self._timestamp
+
+    def get_if_fresh(self, max_age: float, now: float = None):
+        """max_age秒以内に受け取った値の場合だけ取得する
+        古い値で制御しないように使い、Noneのときは制御を止めるなどの代わりの動作をする
+        :param max_age: 許容する経過時間（秒）
+        :return: 現在のデータのリスト（古い、またはまだ受け取っていなければNone）
+        """
+        age = self.age(now)
+        self._reads += 1
+        if age is None or age > max_age:
+            self._stale_reads += 1
+            return None
+        self._age_sum += age
+        if age > self._age_max:
+            self._age_max = age
+        return self.get()
+
+    def stats(self, now: float = None):
+        """値の新しさの統計
+        :return: 受け取った回数・現在の経過時間・受け取る間隔の最大値と、
+                 get_if_freshで読んだ回数・古すぎた回数・読んだ値の経過時間の平均と最大
+        """
+        fresh = self._reads - self._stale_reads
+        return {
+            'sequence': self._sequence,
+            'age': self.age(now),
+            'max_gap': self._max_gap,
+            'reads': self._reads,
+            'stale': self._stale_reads,
+            'mean_age': self._age_sum / fresh if fresh else None,
+            'max_age': self._age_max,
+        }
+
+    @classmethod
+    def all_stats(cls, now: float = None):
+        """すべてのDataManagerの値の新しさの統計
+        :return: 識別子 -> stats()
+        """
+        if now is None:
+            now = time.monotonic()
+        return {identifier: instance.stats(now) for identifier, instance in cls._instances.items()}
 
     def get(self):
         """現在のデータを取得する
         :return: 現在のデータのリスト
         """
+        if self._stale:
+            self._data[:] = self._values
+            self._stale = False
         return self._data
 
     def pack(self):
         """データをパックしてバイト列に変換する
+        送信キューに入れたまま次の更新が来てもよいように、新しいbytesを返す
         :return: パックされたバイト列
         """
-        # uint8_t 8個のデータを送る（例: 0〜7）
+        if self._stale:
+            return bytes(self._view)
         try:
-            packed_data = struct.pack(self._pack_mode, *self._data)
+            packed_data = self._struct.pack(*self._data)
         except struct.error as e:
             raise ValueError(f"データのパックに失敗しました: {e}")
         return packed_data
-    
+
+    def pack_into(self, buffer=None, offset:int=0):
+        """データを新しいbytesを作らずにパックする
+        :param buffer: 書き込み先（省略時は自身のバッファ）
+        :param offset: 書き込み先の位置
+        :return: 自身のバッファに書いた場合はそのmemoryview（次のpack_intoで上書きされる）
+        """
+        if buffer is None:
+            if not self._stale:
+                try:
+                    self._struct.pack_into(self._buffer, 0, *self._data)
+                except struct.error as e:
+                    raise ValueError(f"データのパックに失敗しました: {e}")
+            return self._view
+        if self._stale:
+            buffer[offset:offset + self._struct.size] = self._view
+            return None
+        try:
+            self._struct.pack_into(buffer, offset, *self._data)
+        except struct.error as e:
+            raise ValueError(f"データのパックに失敗しました: {e}")
+        return None
+
+    def unpack_from(self, data, offset:int=0, sender_time:float=None):
+        """バイト列を自身のバッファにコピーし、要素の型で読むビューを返す（リストを作らない）
+        内容が変わった場合のみバージョンを増やす（比較はversion()を呼んだときに行う）。
+        get()は次に呼ばれたときにリストを更新する
+        :param data: 受信したバイト列（memoryviewでもよい）
+        :param offset: 読み出す位置
+        :param sender_time: 送信元が付けた時刻（分かる場合）
+        :return: 要素の型のmemoryview（次のunpack_fromで上書きされる）
+        :raises ValueError: データの長さが足りない場合
+        """
+        size = self._struct.size
+        try:
+            # 長さが違う場合はmemoryviewへの代入がValueErrorになる
+            self._view[:] = data[offset:offset + size]
+        except ValueError:
+            raise ValueError(f"データの長さが不正です。期待される長さ: {size}, 実際の長さ: {len(data[offset:offset + size])}") from None
+        self._stale = True
+        self._dirty = True
+        self._touch(sender_time)
+        return self._values
+
     def identifier(self):
         """識別子を取得する
         :return: 1byteの識別子 (1〜255)
         """
         return self._identifier
 
+    def size(self):
+        """パックしたデータのバイト数を取得する"""
+        return self._struct.size
+
     # def _data_check(self):
     #     """データの型と長さをチェックする
     #     :raises ValueError: データの型や長さが不正な場合
@@ -86,20 +258,187 @@ class DataManager:
         :return: DataManagerインスタンス
         :raises ValueError: 指定された識別子のインスタンスが存在し
         """
-        if identifier not in cls._instances:
-            raise ValueError(f"識別子 {identifier} のDataManagerインスタンスが存在しません。")
-        instance = cls._instances[identifier]
-        return instance
+        try:
+            return cls._instances[identifier]
+        except KeyError:
+            raise ValueError(f"識別子 {identifier} のDataManagerインスタンスが存在しません。") from None
     
     @classmethod
-    def unpack(cls, identifier:int, data:bytes):
+    def unpack(cls, identifier:int, data:bytes, sender_time:float=None):
         """指定された識別子のDataManagerインスタンスを検索し、データをアンパックする
         :param identifier: 1byteの識別子 (1〜255)
         :param data: アンパックするバイト列
-        :return: アンパックされたデータのリスト
+        :param sender_time: 送信元が付けた時刻（分かる場合）
+        :return: アンパックされたデータのリスト（受信ごとに新しいリスト。次の受信では書き換わらない）
         :raises ValueError: 指定された識別子のインスタンスが存在しない場合
         """
-        instance = cls._search(identifier)
-        instance._data = list(struct.unpack(instance._pack_mode, data))
-        return instance._data
+        try:
+            instance = cls._instances[identifier]
+        except KeyError:
+            raise ValueError(f"識別子 {identifier} のDataManagerインスタンスが存在しません。") from None
+        return instance._unpack(data, sender_time)
+
+    @staticmethod
+    def _batch_layout(header: bytes, managers):
+        """まとめたフレームの各データの位置と全体の長さを計算する
+        :return: (DataManager, データの位置, 全体の長さ, 全体を1回で読むStruct, 読んだ値の範囲)
+        """
+        offsets = []
+        ranges = []
+        offset = len(header)
+        index = 0
+        for manager in managers:
+            offsets.append(offset)
+            offset += manager.size()
+            length = len(manager._struct.format) - 1  # '<'を除いた要素数
+            ranges.append((index, index + length))
+            index += length
+        # ヘッダー部分は読み飛ばし、データ部分を1つのStructで読む
+        whole = struct.Struct('<' + 'x' * len(header) + ''.join(m._struct.format[1:] for m in managers))
+        return tuple(managers), tuple(offsets), offset, whole, tuple(ranges)
+
+    @classmethod
+    def pack_batch(cls, managers, identifiers=None):
+        """複数のDataManagerを1つのフレームにまとめる（BATCH_IDENTIFIERで送る）
+        形式: [件数 1byte][識別子 × 件数][データ × 件数]（データの長さは識別子から決まる）
+        :param managers: まとめるDataManagerのリスト（255個まで）
+        :param identifiers: フレームに書く識別子（省略時は各DataManagerの識別子。ESPに送るときの変換用）
+        :return: まとめたバイト列
+        """
+        key = (tuple(managers), None if identifiers is None else tuple(identifiers))
+        layout = cls._batch_pack_layouts.get(key)
+        if layout is None:
+            if identifiers is None:
+                identifiers = [manager.identifier() for manager in managers]
+            if len(managers) != len(identifiers) or not 0 < len(managers) <= 255:
+                raise ValueError("まとめるデータの数が不正です。")
+            header = bytes([len(managers)]) + bytes(identifiers)
+            layout = (header,) + cls._batch_layout(header, managers)
+            cls._batch_pack_layouts[key] = layout
+        header, managers, offsets, total, _, _ = layout
+        buffer = bytearray(total)
+        buffer[:len(header)] = header
+        for manager, offset in zip(managers, offsets):
+            manager.pack_into(buffer, offset)
+        return bytes(buffer)
+
+    @classmethod
+    def unpack_batch(cls, data, sender_time:float=None):
+        """まとめたフレームを1回でアンパックする
+        同じ組み合わせの識別子は2回目以降、計算済みのStructで全体を1回で読む
+        :param data: BATCH_IDENTIFIERで受信したバイト列（memoryviewでもよい）
+        :param sender_time: 送信元が付けた時刻（分かる場合）
+        :return: アンパックしたDataManagerのリスト
+        :raises ValueError: 識別子が存在しない、または長さが合わない場合
+        """
+        if len(data) < 1 or len(data) < data[0] + 1:
+            raise ValueError("まとめたフレームのヘッダーが不完全です。")
+        header = bytes(data[:data[0] + 1])
+        layouts = cls._batch_unpack_layouts
+        layout = layouts.get(header)
+        if layout is None:
+            # 存在しない識別子はここでValueErrorになり、覚えない
+            layout = cls._batch_layout(header, [cls._search(identifier) for identifier in header[1:]])
+            layouts[header] = layout
+            if len(layouts) > _BATCH_CACHE_SIZE:
+                layouts.popitem(last=False)
+        else:
+            layouts.move_to_end(header)
+        managers, _, total, whole, ranges = layout
+        if len(data) != total:
+            raise ValueError(f"まとめたフレームの長さが不正です。期待される長さ: {total}, 実際の長さ: {len(data)}")
+        values = whole.unpack_from(data)
+        for manager, (start, end) in zip(managers, ranges):
+            manager._assign(values[start:end], sender_time)
+        return managers
+
+    def _unpack(self, data, sender_time:float=None):
+        try:
+            values = self._struct.unpack(data)
+        except struct.error as e:
+            raise ValueError(f"データのアンパックに失敗しました: {e}")
+        self._data = data = list(values)  # _assignと同じ（呼び出しを1回減らす）
+        self._stale = False
+        self._dirty = True
+        self._touch(sender_time)
+        return data
+
+    def _assign(self, values, sender_time:float=None):
+        """アンパックした値を入れる
+        受け取るたびに新しいリストにし、前にunpackやget()で返したリストは次の受信で書き換わらないようにする
+        """
+        self._data = list(values)
+        self._stale = False
+        self._dirty = True
+        self._touch(sender_time)
+
+
+class ChangeTracker:
+    """変更があったデータだけを送るための送信記録
+    送信先ごとに作り、DataManagerのバージョンを送信時に覚えておく。
+    前回送ってから内容が変わったもの（dirty）と、keepalive秒以上送っていないものだけを送る。
+    """
+
+    def __init__(self, keepalive: float = 1.0):
+        """コンストラクタ
+        :param keepalive: 変更がなくても送り直す間隔（秒, 0以下なら送り直さない）
+        """
+        self.keepalive = keepalive
+        self._sent = {}  # 識別子 -> (送ったバージョン, 送った時刻)
+        self.sent = 0     # 送ったフレーム数
+        self.skipped = 0  # 変更がなく送らなかったフレーム数
+
+    def __repr__(self):
+        return f"ChangeTracker {self.stats()}"
+
+    def is_dirty(self, manager: DataManager, now: float = None) -> bool:
+        """送る必要があるか（変更があった、またはkeepalive秒送っていない）"""
+        record = self._sent.get(manager.identifier())
+        if record is None or record[0] != manager.version():
+            return True
+        if self.keepalive <= 0:
+            return False
+        if now is None:
+            now = time.monotonic()
+        return now - record[1] >= self.keepalive
+
+    def mark_sent(self, manager: DataManager, now: float = None, version: int = None):
+        """送ったことを記録する
+        :param version: 送ったときのバージョン（省略時は現在のバージョン。送信を待つ間に更新される場合に指定する）
+        """
+        if now is None:
+            now = time.monotonic()
+        if version is None:
+            version = manager.version()
+        self._sent[manager.identifier()] = (version, now)
+        self.sent += 1
+
+    def frames(self, managers: list, now: float = None) -> list:
+        """送る必要があるデータを (識別子, パックしたデータ) のリストで返し、送ったものとして記録する
+        :param managers: 対象のDataManagerのリスト
+        """
+        return [(manager.identifier(), manager.pack()) for manager in self.due(managers, now)]
+
+    def due(self, managers: list, now: float = None) -> list:
+        """送る必要があるDataManagerのリストを返し、送ったものとして記録する
+        （pack_batchでまとめて送る場合に使う）
+        :param managers: 対象のDataManagerのリスト
+        """
+        if now is None:
+            now = time.monotonic()
+        due = []
+        for manager in managers:
+            if self.is_dirty(manager, now):
+                due.append(manager)
+                self.mark_sent(manager, now)
+            else:
+                self.skipped += 1
+        return due
+
+    def reset(self):
+        """記録を消し、次回はすべて送るようにする（再接続時など）"""
+        self._sent.clear()
 
+    def stats(self):
+        """送った・送らなかったフレーム数"""
+        return {'sent': self.sent, 'skipped': self.skipped}
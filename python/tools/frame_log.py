@@ -0,0 +1,233 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, Any
+
+# ファイルヘッダー: マジック, バージョン, 記録開始時刻（UNIX時間）
+_FILE_HEADER = struct.Struct('>4sB3xd')
+_MAGIC = b'QKFL'
+_VERSION = 1
+# レコードヘッダー: 記録開始からの経過時間（単調増加時刻）, 方向, 識別子, サイズ
+_RECORD = struct.Struct('>dBBI')
+
+RECEIVED = 0
+SENT = 1
+
+
+class FrameRecorder:
+    """送受信したフレームをバイナリログに記録するクラス
+    record()はヘッダーとデータをキューに入れるだけで、ファイルへの書き込みは
+    バックグラウンドのスレッドが行う（イベントループがディスクを待たない）。
+    """
+
+    def __init__(self, path: str, max_queue_bytes: int = 64 * 1024 * 1024):
+        """コンストラクタ
+        :param path: ログファイルのパス（ディレクトリの場合は日時からファイル名を作る）
+        :param max_queue_bytes: 書き込み待ちの上限（超えた分は記録せずに数える）
+        """
+        if os.path.isdir(path) or not os.path.splitext(path)[1]:
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, datetime.now().strftime("%Y%m%d_%H%M%S") + ".qkl")
+        self.path = path
+        self.max_queue_bytes = max_queue_bytes
+        self._start = time.monotonic()
+        self._file = open(path, 'wb')
+        self._file.write(_FILE_HEADER.pack(_MAGIC, _VERSION, time.time()))
+        self._queue = queue.SimpleQueue()
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self.recorded = 0  # 記録したフレーム数
+        self.dropped = 0   # 書き込みが追いつかず記録しなかったフレーム数
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, name="FrameRecorder", daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f"FrameRecorder ({self.path}) {self.stats()}"
+
+    def record(self, direction: int, identifier: int, data):
+        """フレームを1つ記録する
+        :param direction: RECEIVED または SENT
+        :param data: フレームのデータ（受信バッファのmemoryviewでもよい。ここでコピーする）
+        """
+        if self._closed:
+            return
+        size = len(data)
+        with self._lock:
+            if self._queued_bytes + size > self.max_queue_bytes:
+                self.dropped += 1
+                return
+            self._queued_bytes += size + _RECORD.size
+        header = _RECORD.pack(time.monotonic() - self._start, direction, identifier, size)
+        self._queue.put(header + bytes(data))
+        self.recorded += 1
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            # 溜まっている分はまとめて書き込む
+            items = [item]
+            stop = False
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+            self._file.writelines(items)
+            self._file.flush()
+            with self._lock:
+                self._queued_bytes -= sum(len(item) for item in items)
+            if stop:
+                break
+        self._file.close()
+
+    def close(self):
+        """書き込み待ちのフレームをすべて書き込んでからファイルを閉じる"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> Dict[str, int]:
+        """記録したフレーム数・記録しなかったフレーム数・書き込み待ちのバイト数"""
+        return {'recorded': self.recorded, 'dropped': self.dropped, 'queued_bytes': self._queued_bytes}
+
+
+class FrameLog:
+    """FrameRecorderで記録したログを読むクラス
+    ファイルをメモリマップし、開いたときに識別子ごとのレコード位置と時刻の索引を作る。
+    データはコピーせずmemoryviewで返す。
+    """
+
+    def __init__(self, path: str):
+        """コンストラクタ
+        :param path: ログファイルのパス
+        :raises ValueError: ログファイルの形式が違う場合
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _FILE_HEADER.size:
+            self._file.close()
+            raise ValueError(f"ログファイルではありません: {path}")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, version, self.started = _FILE_HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise ValueError(f"ログファイルの形式が違います: {path}")
+        self._offsets = [None] * 256     # 識別子 -> レコード位置のarray
+        self._timestamps = [None] * 256  # 識別子 -> 時刻のarray
+        self._all = array('Q')
+        self.truncated = False  # 記録中に終了して末尾のレコードが欠けているか
+        self._build_index(size)
+
+    def __repr__(self):
+        return f"FrameLog ({self.path}) {len(self)}フレーム, {self.duration():.1f}秒"
+
+    def __len__(self):
+        return len(self._all)
+
+    def _build_index(self, size: int):
+        """レコードヘッダーだけをたどって索引を作る"""
+        buffer = self._mmap
+        offset = _FILE_HEADER.size
+        record_size = _RECORD.size
+        offsets = self._offsets
+        timestamps = self._timestamps
+        append_all = self._all.append
+        while offset + record_size <= size:
+            timestamp, direction, identifier, length = _RECORD.unpack_from(buffer, offset)
+            if offset + record_size + length > size:
+                self.truncated = True
+                break
+            if offsets[identifier] is None:
+                offsets[identifier] = array('Q')
+                timestamps[identifier] = array('d')
+            offsets[identifier].append(offset)
+            timestamps[identifier].append(timestamp)
+            append_all(offset)
+            offset += record_size + length
+        else:
+            self.truncated = offset != size
+
+    def close(self):
+        """メモリマップとファイルを閉じる"""
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            pass  # 返したmemoryviewが残っている間は、それが解放されたときに閉じられる
+        self._file.close()
+
+    def identifiers(self) -> list:
+        """記録されている識別子のリスト"""
+        return [i for i in range(256) if self._offsets[i] is not None]
+
+    def count(self, identifier: int) -> int:
+        """識別子ごとのフレーム数"""
+        offsets = self._offsets[identifier]
+        return 0 if offsets is None else len(offsets)
+
+    def duration(self) -> float:
+        """最初から最後のフレームまでの時間（秒）"""
+        if not self._all:
+            return 0.0
+        return self.read(self._all[-1])[0] - self.read(self._all[0])[0]
+
+    def read(self, offset: int):
+        """指定位置のレコードを読む
+        :return: (時刻, 方向, 識別子, データのmemoryview)
+        """
+        timestamp, direction, identifier, length = _RECORD.unpack_from(self._mmap, offset)
+        start = offset + _RECORD.size
+        return timestamp, direction, identifier, self._view[start:start + length]
+
+    def seek(self, identifier: int, timestamp: float) -> int:
+        """識別子のフレームのうち、指定時刻以降の最初のものの番号を返す（二分探索）"""
+        timestamps = self._timestamps[identifier]
+        if timestamps is None:
+            return 0
+        return bisect_left(timestamps, timestamp)
+
+    def at(self, identifier: int, index: int):
+        """識別子のindex番目のフレームを読む"""
+        return self.read(self._offsets[identifier][index])
+
+    def frames(self, identifier: int = None, direction: int = None, start: float = 0.0):
+        """フレームを時刻順に返すジェネレーター
+        :param identifier: 指定した場合はその識別子のみ
+        :param direction: 指定した場合はその方向（RECEIVED/SENT）のみ
+        :param start: この時刻（記録開始からの秒）以降のフレームのみ
+        """
+        if identifier is not None:
+            offsets = self._offsets[identifier] or ()
+            index = self.seek(identifier, start)
+        else:
+            offsets = self._all
+            # 全体の索引は時刻順なので、時刻で二分探索する
+            low, high = 0, len(offsets)
+            while low < high:
+                middle = (low + high) // 2
+                if _RECORD.unpack_from(self._mmap, offsets[middle])[0] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            index = low
+        for i in range(index, len(offsets)):
+            record = self.read(offsets[i])
+            if direction is None or record[1] == direction:
+                yield record
@@ -0,0 +1,369 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any
+
+from tools.config import read_config
+
+# すべてのロガーの親（カテゴリは quadken.<カテゴリ>）
+ROOT = 'quadken'
+
+# 直近のイベントのダンプファイル: マジック, バージョン, 1件のバイト数, 件数, カテゴリ数
+_DUMP_HEADER = struct.Struct('<4sBHIB')
+_MAGIC = b'QKEV'
+_VERSION = 1
+# 1件のイベント: 時刻（UNIX時間）, レベル, カテゴリ番号, メッセージのバイト数（後ろにメッセージが続く）
+_EVENT = struct.Struct('<dBBH')
+
+_COLORS = {logging.WARNING: "\033[93m", logging.ERROR: "\033[91m", logging.CRITICAL: "\033[91m"}
+_RESET = "\033[0m"
+
+_service = None
+_service_lock = threading.Lock()
+
+
+class EventRing:
+    """直近のイベントを固定長のバイナリで残すリングバッファ
+    1件ごとに確保済みのbytearrayへ書き込み、エラー時にsnapshot()でまとめて取り出す。
+    """
+
+    def __init__(self, size: int = 1024, slot_size: int = 128):
+        """コンストラクタ
+        :param size: 残すイベントの数
+        :param slot_size: 1件のバイト数（メッセージは切り詰める）
+        """
+        self.size = size
+        self.slot_size = slot_size
+        self._buffer = bytearray(size * slot_size)
+        self._max_message = slot_size - _EVENT.size
+        self._next = 0     # 次に書き込む位置
+        self._count = 0    # これまでに書き込んだ件数
+        self.categories = []   # カテゴリ番号 -> カテゴリ名
+        self._category_ids = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.size)
+
+    def category_id(self, category: str) -> int:
+        """カテゴリ名の番号（初めてのカテゴリは登録する）"""
+        category_id = self._category_ids.get(category)
+        if category_id is None:
+            category_id = self._category_ids[category] = min(len(self.categories), 255)
+            self.categories.append(category)
+        return category_id
+
+    def record(self, created: float, level: int, category: str, message: str):
+        """イベントを1件書き込む（古いものから上書きする）"""
+        encoded = message.encode('utf-8')[:self._max_message]
+        category_id = self.category_id(category)
+        with self._lock:
+            offset = self._next * self.slot_size
+            _EVENT.pack_into(self._buffer, offset, created, level, category_id, len(encoded))
+            start = offset + _EVENT.size
+            self._buffer[start:start + len(encoded)] = encoded
+            self._next = (self._next + 1) % self.size
+            self._count += 1
+
+    def snapshot(self) -> bytes:
+        """古い順に並べたダンプ（ヘッダー + カテゴリ名 + イベント）"""
+        with self._lock:
+            if self._count < self.size:
+                events = bytes(self._buffer[:self._next * self.slot_size])
+            else:
+                split = self._next * self.slot_size
+                events = bytes(self._buffer[split:]) + bytes(self._buffer[:split])
+            categories = list(self.categories)
+        header = _DUMP_HEADER.pack(_MAGIC, _VERSION, self.slot_size, len(events) // self.slot_size, len(categories))
+        names = b''.join(bytes([len(n)]) + n for n in (c.encode('utf-8')[:255] for c in categories))
+        return header + names + events
+
+    @staticmethod
+    def parse(data: bytes) -> list:
+        """snapshot()のダンプを読む
+        :return: [(時刻, レベル名, カテゴリ, メッセージ), ...]
+        :raises ValueError: ダンプの形式が違う場合
+        """
+        magic, version, slot_size, count, category_count = _DUMP_HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("イベントのダンプではありません")
+        offset = _DUMP_HEADER.size
+        categories = []
+        for _ in range(category_count):
+            length = data[offset]
+            categories.append(data[offset + 1:offset + 1 + length].decode('utf-8'))
+            offset += 1 + length
+        events = []
+        for index in range(count):
+            start = offset + index * slot_size
+            created, level, category_id, length = _EVENT.unpack_from(data, start)
+            message = data[start + _EVENT.size:start + _EVENT.size + length].decode('utf-8', errors='replace')
+            events.append((created, logging.getLevelName(level), categories[category_id], message))
+        return events
+
+
+class RateLimitFilter(logging.Filter):
+    """カテゴリごとの間引きと1秒あたりの件数制限
+    通したイベントだけをEventRingに残す（捨てるイベントはメッセージにしない）。
+    エラー以上はいつも通し、同じロガー・メッセージについてdump_interval秒に1回だけ直近のイベントを添付する。
+    捨てた件数は次に通したメッセージの後ろに付ける。
+    """
+
+    def __init__(self, ring: EventRing, categories: Dict[str, Any] = None, dump_level: int = logging.ERROR,
+                 dump_interval: float = 60.0):
+        """コンストラクタ
+        :param ring: 直近のイベントを残すEventRing
+        :param categories: カテゴリ -> {'rate': 1秒あたりの件数, 'sample': N件に1件}
+        :param dump_level: このレベル以上は制限せず、直近のイベントを添付する
+        :param dump_interval: 同じロガー・メッセージのエラーで直近のイベントを添付する間隔（秒）
+        """
+        super().__init__()
+        self.ring = ring
+        self.dump_level = dump_level
+        self.dump_interval = dump_interval
+        self._dumped = {}  # (ロガー名, メッセージ) -> 最後に直近のイベントを添付した時刻
+        self.dumps_skipped = 0  # 間隔内のため添付しなかったエラーの件数
+        # カテゴリ -> [1秒あたりの件数（Noneは制限なし）, 間引き, 残りの件数, 最後に補充した時刻, 数えた件数, 捨てた件数]
+        self._limits = {}
+        for category, limit in (categories or {}).items():
+            if not isinstance(limit, dict):
+                limit = {'rate': limit}
+            rate = limit.get('rate')
+            rate = None if rate is None else float(rate)
+            sample = int(limit.get('sample', 1) or 1)
+            self._limits[category] = [rate, sample, max(rate, 1.0) if rate else 0.0, 0.0, 0, 0]
+        self._resolved = {}  # ロガー名 -> カテゴリの制限（Noneは制限なし）
+        self.passed = {}      # カテゴリ -> 通した件数
+        self.suppressed = {}  # カテゴリ -> 捨てた件数
+
+    @staticmethod
+    def category(name: str) -> str:
+        """ロガー名からカテゴリを取り出す（quadken.relay -> relay）"""
+        return name[len(ROOT) + 1:] if name.startswith(ROOT + '.') else name
+
+    def _limit(self, name: str):
+        if name in self._resolved:
+            return self._resolved[name]
+        # tcp.debug -> tcp の順に近い設定を使う
+        category = self.category(name)
+        limit = None
+        while category:
+            limit = self._limits.get(category)
+            if limit is not None:
+                break
+            category = category.rpartition('.')[0]
+        self._resolved[name] = limit
+        return limit
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = self.category(record.name)
+        if record.levelno >= self.dump_level:
+            self._record(record, category)
+            if self._should_dump(record):
+                record.ring = self.ring.snapshot()
+            self.passed[category] = self.passed.get(category, 0) + 1
+            return True
+        limit = self._limit(record.name)
+        if limit is not None:
+            rate, sample, tokens, refilled, counted, dropped = limit
+            limit[4] = counted + 1
+            allowed = counted % sample == 0
+            if allowed and rate is not None:
+                # トークンバケット（1秒あたりrate件、最大でrate件まで続けて通す）
+                now = record.created
+                if now > refilled:
+                    tokens = min(max(rate, 1.0), tokens + (now - refilled) * rate)
+                    limit[3] = now
+                allowed = tokens >= 1.0
+                limit[2] = tokens - 1.0 if allowed else tokens
+            if not allowed:
+                limit[5] = dropped + 1
+                self.suppressed[category] = self.suppressed.get(category, 0) + 1
+                return False
+            if dropped:
+                record.suppressed = dropped
+                limit[5] = 0
+        self._record(record, category)
+        self.passed[category] = self.passed.get(category, 0) + 1
+        return True
+
+    def _record(self, record: logging.LogRecord, category: str):
+        """通すレコードをメッセージにしてEventRingに残す"""
+        # 引数（使い回すリストなど）が後から変わっても内容が変わらないよう、ここで一度だけメッセージにする
+        message = record.getMessage()
+        record.msg = message
+        record.args = None
+        self.ring.record(record.created, record.levelno, category, message)
+
+    def _should_dump(self, record: logging.LogRecord) -> bool:
+        """同じロガー・メッセージのエラーで、前に添付してからdump_interval秒たっているか"""
+        key = (record.name, record.msg)
+        last = self._dumped.get(key)
+        if last is not None and record.created - last < self.dump_interval:
+            self.dumps_skipped += 1
+            return False
+        if len(self._dumped) >= 256:
+            # 間隔を過ぎたものを捨て、メッセージごとに増え続けないようにする
+            self._dumped = {k: t for k, t in self._dumped.items() if record.created - t < self.dump_interval}
+        self._dumped[key] = record.created
+        return True
+
+
+class ConsoleFormatter(logging.Formatter):
+    """端末用の書式（メッセージのみ。レコードのtimestamp/colorで時刻と色を付ける）"""
+
+    def __init__(self, show_colors: bool = True):
+        super().__init__()
+        self.show_colors = show_colors
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            message += f" （{suppressed}件省略）"
+        if getattr(record, 'timestamp', False):
+            message = datetime.fromtimestamp(record.created).strftime("%H:%M:%S.%f")[:-3] + " " + message
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        color = getattr(record, 'color', None) or _COLORS.get(record.levelno)
+        if self.show_colors and color:
+            message = f"{color}{message}{_RESET}"
+        return message
+
+
+class RingDumpHandler(logging.Handler):
+    """エラーのレコードに添付された直近のイベントをファイルに書き出す（書き込みスレッドで動く）"""
+
+    def __init__(self, path: str, keep: int = 20):
+        """コンストラクタ
+        :param path: ダンプを保存するディレクトリ
+        :param keep: 残すダンプの数（超えたら古いものから消す）
+        """
+        super().__init__(logging.ERROR)
+        self.path = path
+        self.keep = keep
+        self.dumps = []  # 書き出したファイルのパス（残っているもの）
+
+    def emit(self, record: logging.LogRecord):
+        ring = getattr(record, 'ring', None)
+        if ring is None:
+            return
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            name = datetime.fromtimestamp(record.created).strftime("%Y%m%d_%H%M%S_%f") + ".qke"
+            path = os.path.join(self.path, name)
+            with open(path, 'wb') as f:
+                f.write(ring)
+            self.dumps.append(path)
+            while len(self.dumps) > self.keep:
+                os.remove(self.dumps.pop(0))
+        except OSError:
+            self.handleError(record)
+
+
+class LogService:
+    """キューと書き込みスレッドで端末に出力するロギング
+    ログを出す側はレコードをキューに入れるだけで、端末（SSH越し）への書き込みは
+    バックグラウンドのスレッドが行う。カテゴリごとに件数を制限し、直近のイベントは
+    EventRingに残してエラーのときにファイルへ書き出す。
+    """
+
+    def __init__(self, config: Dict[str, Any] = None, stream=None):
+        """コンストラクタ
+        :param config: ログの設定（省略時はconfig.yamlのlog）
+        :param stream: 出力先（省略時は標準出力）
+        """
+        config_error = None
+        if config is None:
+            try:
+                config = read_config('log')
+            except Exception as e:  # ログを開始してから知らせる
+                config, config_error = {}, e
+        self.config = config
+        self.ring = EventRing(config.get('ring_size', 1024), config.get('ring_slot', 128))
+        self.filter = RateLimitFilter(self.ring, config.get('categories', {}),
+                                      dump_interval=config.get('dump_interval', 60.0))
+        self._queue = queue.SimpleQueue()
+        self.handler = logging.handlers.QueueHandler(self._queue)
+        # カテゴリのロガーに個別のレベルを設定しても、levelより下のレコードは制限もリングへの記録もしない
+        self.handler.setLevel(config.get('level', 'DEBUG'))
+        self.handler.addFilter(self.filter)
+
+        console = logging.StreamHandler(stream if stream is not None else sys.stdout)
+        console.setLevel(config.get('console_level', 'INFO'))
+        console.setFormatter(ConsoleFormatter(config.get('show_colors', True)))
+        self.dump_handler = RingDumpHandler(config.get('dump_path', 'logs'), config.get('dump_keep', 20))
+        self.listener = logging.handlers.QueueListener(self._queue, console, self.dump_handler,
+                                                       respect_handler_level=True)
+
+        self.logger = logging.getLogger(ROOT)
+        self.logger.setLevel(config.get('level', 'DEBUG'))
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+        if config_error is not None:
+            logging.getLogger(f"{ROOT}.config").error("[設定エラー] %s", config_error)
+
+    def __repr__(self):
+        return f"LogService {self.stats()}"
+
+    def stop(self):
+        """キューに残ったレコードを書き出してから書き込みスレッドを止める"""
+        self.logger.removeHandler(self.handler)
+        self.listener.stop()
+
+    def dump(self) -> bytes:
+        """直近のイベントを取り出す"""
+        return self.ring.snapshot()
+
+    def stats(self) -> Dict[str, Any]:
+        """カテゴリごとの出力・省略した件数と、書き出したダンプ"""
+        return {'passed': dict(self.filter.passed), 'suppressed': dict(self.filter.suppressed),
+                'events': len(self.ring), 'dumps': list(self.dump_handler.dumps),
+                'dumps_skipped': self.filter.dumps_skipped}
+
+
+def setup(config: Dict[str, Any] = None, stream=None) -> LogService:
+    """ロギングを開始する（2回目以降は同じLogServiceを返す）
+    :param config: ログの設定（省略時はconfig.yamlのlog）
+    :param stream: 出力先（省略時は標準出力）
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = LogService(config, stream)
+            atexit.register(shutdown)
+        return _service
+
+
+def shutdown():
+    """ロギングを止める（残ったレコードは書き出す）"""
+    global _service
+    with _service_lock:
+        if _service is not None:
+            _service.stop()
+            _service = None
+
+
+def get_logger(category: str) -> logging.Logger:
+    """カテゴリのロガーを取得する（まだ開始していなければconfig.yamlの設定で開始する）
+    :param category: カテゴリ名（relay, bno, tcp.debug など）
+    """
+    setup()
+    return logging.getLogger(f"{ROOT}.{category}")
+
+
+if __name__ == "__main__":
+    # エラー時に書き出した直近のイベントを表示する
+    for dump_path in sys.argv[1:]:
+        with open(dump_path, 'rb') as f:
+            for created, level, category, message in EventRing.parse(f.read()):
+                timestamp = datetime.fromtimestamp(created).strftime("%H:%M:%S.%f")[:-3]
+                print(f"{timestamp} {level:8s} [{category}] {message}")
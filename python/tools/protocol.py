@@ -0,0 +1,241 @@
+import os
+import re
+import struct
+import yaml
+from tools.data_manager import DataManager, DataType, BATCH_IDENTIFIER
+from tools.tcp import CHUNK_IDENTIFIER, HEARTBEAT_IDENTIFIER
+from tools.telemetry import TELEMETRY_IDENTIFIER
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protocol.yaml')
+
+# Tcpが内部で使うため、メッセージに使えない識別子
+RESERVED_IDENTIFIERS = {0x00: "カメラ画像", CHUNK_IDENTIFIER: "分割フレーム", HEARTBEAT_IDENTIFIER: "ping/pong",
+                        BATCH_IDENTIFIER: "まとめたフレーム", TELEMETRY_IDENTIFIER: "ESPのテレメトリ"}
+HOSTS = ('PC', 'Rasp')
+
+# DataTypeとESP32のDataManager<T>の型の対応
+CPP_TYPES = {
+    DataType.UINT8: 'uint8_t',
+    DataType.UINT16: 'uint16_t',
+    DataType.UINT32: 'uint32_t',
+    DataType.INT8: 'int8_t',
+    DataType.INT16: 'int16_t',
+    DataType.INT32: 'int32_t',
+}
+_CPP_DECLARATION = re.compile(r'^\s*DataManager<(\w+)>\s+(\w+)\(\s*(0[xX][0-9A-Fa-f]+|\d+)\s*,\s*(\d+)\s*\)\s*;', re.MULTILINE)
+
+
+class Message:
+    """スキーマの1つのメッセージ"""
+
+    def __init__(self, name: str, spec: dict):
+        """コンストラクタ
+        :param name: メッセージ名
+        :param spec: protocol.yamlのmessagesの1項目
+        :raises ValueError: 項目が足りない・不正な場合
+        """
+        try:
+            self.name = name
+            self.identifier: int = spec['identifier']
+            self.data_type = DataType[spec['type']]
+            self.length: int = spec['length']
+            self.source: str = spec['source']
+            self.destination: list = list(spec['destination'])
+        except KeyError as e:
+            raise ValueError(f"メッセージ {name} の {e} が不正です")
+        self.ble_identifier: int = spec.get('ble_identifier', self.identifier)
+        self.relay: bool = spec.get('relay', True)
+        self.firmware: str = spec.get('firmware')
+
+    def __repr__(self):
+        return (f"Message {self.name} (0x{self.identifier:02X}, {self.length}×{self.data_type.name}, "
+                f"{self.source} -> {', '.join(self.destination)})")
+
+    def size(self) -> int:
+        """パックしたデータのバイト数"""
+        return struct.calcsize('<' + self.data_type.value) * self.length
+
+
+class Route:
+    """識別子ごとの受信先と中継先"""
+    __slots__ = ('message', 'manager', 'size', 'targets')
+
+    def __init__(self, message: Message, manager: DataManager, targets: list):
+        self.message = message
+        self.manager = manager
+        self.size = message.size()
+        self.targets = targets  # [(ESPのdevice番号, BLEでの識別子), ...]
+
+    def __repr__(self):
+        return f"Route {self.message.name} -> {self.targets}"
+
+
+class Protocol:
+    """protocol.yamlのスキーマを読み、DataManagerと中継表を作るクラス
+    起動時に一度だけ読み込み、受信時は256個の表から識別子で直接引く。
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        """コンストラクタ
+        :param path: スキーマファイルのパス
+        :raises ValueError: スキーマが不正な場合（識別子の重複・予約済みの識別子など）
+        """
+        self.path = path
+        with open(path, 'r', encoding='utf-8') as f:
+            schema = yaml.safe_load(f)
+        self.links = schema.get('links', {})
+        self.messages = {name: Message(name, spec) for name, spec in schema['messages'].items()}
+        self._routes = [None] * 256
+        self._telemetry = {}  # (ESPのdevice番号, BLEでの識別子) -> Route（ESPから届く通知）
+        self._managers = None
+        self._validate()
+
+    def __repr__(self):
+        return f"Protocol ({self.path}) {len(self.messages)}メッセージ"
+
+    def _validate(self):
+        known = set(HOSTS) | set(self.links)
+        identifiers = {}
+        ble_identifiers = {}
+        for message in self.messages.values():
+            if not 1 <= message.identifier <= 255 or message.identifier in RESERVED_IDENTIFIERS:
+                raise ValueError(f"{message.name}: 識別子 0x{message.identifier:02X} は使えません")
+            if message.identifier in identifiers:
+                raise ValueError(f"{message.name}: 識別子 0x{message.identifier:02X} は "
+                                 f"{identifiers[message.identifier]} と重複しています")
+            identifiers[message.identifier] = message.name
+            if message.length <= 0:
+                raise ValueError(f"{message.name}: 長さは1以上でなければなりません")
+            for link in [message.source] + message.destination:
+                if link not in known:
+                    raise ValueError(f"{message.name}: 不明な送信元・送信先 {link}")
+            if message.source in self.links:
+                if not message.firmware:
+                    raise ValueError(f"{message.name}: {message.source} から送るメッセージにはfirmwareの変数名が必要です")
+                key = (message.source, 'notify', message.ble_identifier)
+                if key in ble_identifiers:
+                    raise ValueError(f"{message.name}: {message.source} からの識別子 0x{message.ble_identifier:02X} は "
+                                     f"{ble_identifiers[key]} と重複しています")
+                ble_identifiers[key] = message.name
+            for link in message.destination:
+                if link in self.links:
+                    if not message.firmware:
+                        raise ValueError(f"{message.name}: {link} に送るメッセージにはfirmwareの変数名が必要です")
+                    key = (link, message.ble_identifier)
+                    if key in ble_identifiers:
+                        raise ValueError(f"{message.name}: {link} での識別子 0x{message.ble_identifier:02X} は "
+                                         f"{ble_identifiers[key]} と重複しています")
+                    ble_identifiers[key] = message.name
+
+    def build(self, arrays=()) -> dict:
+        """DataManagerを作り、中継表を作る（2回目以降は同じものを返す）
+        :param arrays: ArrayDataManager（NumPy配列）で持つメッセージ名
+        :return: メッセージ名 -> DataManager
+        """
+        if self._managers is not None:
+            return self._managers
+        managers = {}
+        for message in self.messages.values():
+            if message.name in arrays:
+                from tools.array_data_manager import ArrayDataManager  # NumPyが必要なときだけ読み込む
+                manager = ArrayDataManager(message.identifier, message.length, message.data_type)
+            else:
+                manager = DataManager(message.identifier, message.length, message.data_type)
+            targets = []
+            if message.relay:
+                targets = [(self.links[link]['device'], message.ble_identifier)
+                           for link in message.destination if link in self.links]
+            managers[message.name] = manager
+            self._routes[message.identifier] = Route(message, manager, targets)
+            if message.source in self.links:
+                device = self.links[message.source]['device']
+                self._telemetry[(device, message.ble_identifier)] = self._routes[message.identifier]
+        self._managers = managers
+        return managers
+
+    def route(self, identifier: int):
+        """識別子の受信先と中継先を取得する（build()のあとに使う）
+        :return: Route（スキーマにない識別子はNone）
+        """
+        return self._routes[identifier]
+
+    def telemetry_route(self, device: int, ble_identifier: int):
+        """ESPから届いた通知の受信先を取得する（build()のあとに使う）
+        :param device: ESPのdevice番号
+        :param ble_identifier: 通知の先頭の識別子
+        :return: Route（スキーマにない通知はNone）
+        """
+        return self._telemetry.get((device, ble_identifier))
+
+    def telemetry_routes(self) -> list:
+        """ESPから届く通知の受信先のリスト（build()のあとに使う）"""
+        return list(self._telemetry.values())
+
+    def validate(self, identifier: int, size: int) -> bool:
+        """スキーマにある識別子で、長さが合っているか"""
+        route = self._routes[identifier]
+        return route is not None and route.size == size
+
+    def identifiers(self, source: str) -> list:
+        """送信元ごとの識別子のリスト"""
+        return [m.identifier for m in self.messages.values() if m.source == source]
+
+    def batch_devices(self) -> set:
+        """まとめたフレーム（BATCH_IDENTIFIER）を受け取れるESPのdevice番号"""
+        return {link['device'] for link in self.links.values() if link.get('batch', False)}
+
+    def firmware_declarations(self, link: str) -> list:
+        """ESPのソースにあるべきDataManager<T>の宣言
+        :return: [(型, 変数名, 識別子, 長さ), ...]
+        """
+        declarations = []
+        for message in self.messages.values():
+            if link in message.destination or message.source == link:
+                declarations.append((CPP_TYPES[message.data_type], message.firmware,
+                                     message.ble_identifier, message.length))
+        return declarations
+
+    def cpp(self, link: str) -> str:
+        """ESPのソースに書くDataManager<T>の宣言を作る"""
+        lines = []
+        for ctype, name, identifier, length in self.firmware_declarations(link):
+            number = f"0x{identifier:02X}" if identifier >= 0x10 else str(identifier)
+            lines.append(f"DataManager<{ctype}> {name}({number}, {length});")
+        return "\n".join(lines)
+
+    def firmware_path(self, link: str) -> str:
+        """ESPのソースのパス（スキーマファイルからの相対パスを解決する）"""
+        return os.path.normpath(os.path.join(os.path.dirname(self.path), self.links[link]['firmware']))
+
+    def check_firmware(self, link: str, source: str = None) -> list:
+        """ESPのソースの宣言とスキーマを比べる
+        :param source: ESPのソース（省略時はlinksのfirmwareのファイルを読む）
+        :return: 食い違いの説明のリスト（一致していれば空）
+        """
+        if source is None:
+            with open(self.firmware_path(link), 'r', encoding='utf-8') as f:
+                source = f.read()
+        found = {}
+        for ctype, name, identifier, length in _CPP_DECLARATION.findall(source):
+            found[name] = (ctype, int(identifier, 0), int(length))
+        problems = []
+        for ctype, name, identifier, length in self.firmware_declarations(link):
+            if name not in found:
+                problems.append(f"{link}: {name} の宣言がありません")
+                continue
+            actual = found.pop(name)
+            if actual != (ctype, identifier, length):
+                problems.append(f"{link}: {name} は DataManager<{actual[0]}>({actual[1]}, {actual[2]}) ですが、"
+                                f"スキーマでは DataManager<{ctype}>({identifier}, {length}) です")
+        for name, actual in found.items():
+            problems.append(f"{link}: {name} (識別子 {actual[1]}) はスキーマにありません")
+        return problems
+
+
+if __name__ == "__main__":
+    # ESP32のソースに書くDataManager<T>の宣言を表示する
+    protocol = Protocol()
+    for link in protocol.links:
+        print(f"// {link} ({protocol.firmware_path(link)})")
+        print(protocol.cpp(link))
+        print()
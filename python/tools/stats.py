@@ -0,0 +1,10 @@
+def percentile(samples, p: float) -> float:
+    """直近のサンプルのパーセンタイル（並べ替えてp番目の位置の値）
+    :param samples: サンプル（deque・リスト・NumPy配列など）
+    :param p: 0〜1の割合（0.5で中央値、0.99でp99）
+    :return: パーセンタイルの値（サンプルがない場合はNone）
+    """
+    if len(samples) == 0:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
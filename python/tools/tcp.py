@@ -1,84 +1,1500 @@
 import asyncio
+import logging
 import struct
-import yaml
-import os
+from collections import deque
+import random
+import socket
 from typing import Dict, Any, Union
-from datetime import datetime
+from tools.frame_log import FrameRecorder, FrameLog, RECEIVED, SENT
+from tools.config import load_config
+from tools.log import get_logger
+from tools.stats import percentile
+
+# 1byte識別子 + 4byteビッグエンディアンサイズのヘッダー
+_HEADER = struct.Struct('>BI')
+
+# 受信時に最低限確保しておく空き領域
+_MIN_READ = 1 << 16
+
+# 予約済み識別子: 分割されたデータのチャンク
+CHUNK_IDENTIFIER = 0xFE
+# チャンクヘッダー: 元の識別子, フレームID, オフセット, 全体サイズ
+_CHUNK_HEADER = struct.Struct('>BHII')
+
+# 予約済み識別子: 死活監視のping/pong
+HEARTBEAT_IDENTIFIER = 0xFD
+# ping/pongの内容: 種類, pingを送った時刻, pongを返した時刻（それぞれ送信側の単調増加時刻）
+_HEARTBEAT = struct.Struct('>Bdd')
+_PING = 0
+_PONG = 1
+
+# UDPのレコードヘッダー: 識別子, シーケンス番号, サイズ
+_UDP_RECORD = struct.Struct('>BIH')
+
+# フレーム形式のバージョン
+FRAMING_V1 = 1  # 1byte識別子 + 4byteビッグエンディアンサイズ
+FRAMING_V2 = 2  # 1byte識別子 + 1byteシーケンス番号 + varint（7bitずつ、下位から）のサイズ
+# フレーム形式の通知は設定コマンド(0xFF)の1byteの値のうち、最上位ビットが立ったものを使う
+# （v1しか知らない相手には範囲外の設定値として読み捨てられる）
+FRAMING_IDENTIFIER = 0xFF
+_FRAMING_FLAG = 0x80   # 対応する最大のバージョンの通知（接続直後に従来の形式で送る）
+_FRAMING_SWITCH = 0x40  # 以降の自分の送信をこのバージョンにする
+_FRAMING_VERSION = 0x3F
+_MAX_VARINT = 5  # 32bitのサイズのvarintの最大バイト数
+# v2のヘッダー: 識別子, シーケンス番号, サイズ（1byteのvarint）
+_V2_SHORT = struct.Struct('BBB')
+# v2のヘッダー: 識別子, シーケンス番号, サイズ（2byteのvarint）
+_V2_MEDIUM = struct.Struct('BBBB')
+
+
+def _write_buffers(writer, buffers):
+    """ヘッダーとデータのバッファ列を1回の書き込みで送る
+    Python 3.12以降のwritelinesは連結せずにsendmsgでまとめて送る。それより前のwritelinesは
+    連結して1回writeする（連結のコピーはあるが、ヘッダーとデータを別々にwriteするとsendが2回になる）
+    """
+    writer.writelines(buffers)
+
+
+def _read_varint(buffer, pos: int, end: int):
+    """v2のヘッダーのvarintのサイズを読む
+    :return: (サイズ, 次の位置)。データが足りない場合はサイズがNone
+    :raises ValueError: 32bitを超える長さの場合
+    """
+    size = 0
+    shift = 0
+    while pos < end:
+        byte = buffer[pos]
+        pos += 1
+        size |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return size, pos
+        shift += 7
+        if shift >= 7 * _MAX_VARINT:
+            raise ValueError("varintのサイズが長すぎます")
+    return None, pos
+
+
+class SendScheduler:
+    """優先度付きの送信スケジューラー
+    識別子ごとの優先度（小さいほど優先）でレーンを分けて送信する。
+    chunk_sizeより大きなデータはフレームIDを付けたチャンクに分割し、
+    チャンクの合間に優先度の高いフレームを割り込ませる。
+    """
+
+    def __init__(self, protocol: "FrameProtocol", priorities: Dict[int, int] = None,
+                 default_priority: int = 1, chunk_size: int = 0):
+        """コンストラクタ
+        :param protocol: 送信に使うFrameProtocol
+        :param priorities: 識別子 -> 優先度 の辞書
+        :param default_priority: テーブルにない識別子の優先度
+        :param chunk_size: チャンクの最大サイズ（0で分割しない）
+        """
+        self._protocol = protocol
+        self._priorities = [default_priority] * 256
+        for identifier, priority in (priorities or {}).items():
+            self._priorities[identifier] = priority
+        self._lanes = [deque() for _ in range(max(self._priorities) + 1)]
+        self._chunk_size = chunk_size
+        self._frame_id = 0
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def submit(self, frames) -> asyncio.Future:
+        """フレームを送信キューに入れる
+        :param frames: (識別子, データ) のリスト
+        :return: すべてのフレームが書き込まれたら完了するFuture
+        """
+        loop = asyncio.get_running_loop()
+        chunk_size = self._chunk_size
+        if (not self._protocol.is_paused() and not any(self._lanes)
+                and not (chunk_size and any(len(data) > chunk_size for _, data in frames))):
+            # キューが空で分割するフレームもなければ、待ち合わせずにその場で書き込む
+            # （v2のヘッダーはシーケンス番号を進めるので、その場で書き込むと決まってから作る）
+            buffers = []
+            header = self._protocol.encode_header
+            for identifier, data in frames:
+                buffers.append(header(identifier, len(data)))
+                buffers.append(data)
+            _write_buffers(self._protocol.transport, buffers)
+            future = loop.create_future()
+            future.set_result(None)
+            return future
+
+        futures = []
+        for identifier, data in frames:
+            future = loop.create_future()
+            # [識別子, データ, 送信済みオフセット, フレームID, Future]
+            self._lanes[self._priorities[identifier]].append([identifier, data, 0, None, future])
+            futures.append(future)
+        self._wakeup.set()
+        return futures[0] if len(futures) == 1 else asyncio.gather(*futures)
+
+    def queued_bytes(self, identifier: int = None) -> int:
+        """キューに残っている未送信バイト数
+        :param identifier: 指定した場合はその識別子のみ
+        """
+        total = 0
+        for lane in self._lanes:
+            for entry in lane:
+                if identifier is None or entry[0] == identifier:
+                    total += len(entry[1]) - entry[2]
+        return total
+
+    def close(self):
+        """スケジューラーを停止し、未送信のフレームを失敗させる"""
+        self._task.cancel()
+        for lane in self._lanes:
+            while lane:
+                future = lane.popleft()[4]
+                if not future.done():
+                    future.set_exception(ConnectionResetError("接続が切断されました。"))
+
+    def _collect(self, urgent_only: bool):
+        """次に書き込むバッファを集める
+        :param urgent_only: Trueの場合は最優先レーンの分割不要なフレームのみ
+        :return: (バッファのリスト, 書き込み完了にするFutureのリスト)
+        """
+        buffers = []
+        written = []
+        header = self._protocol.encode_header
+        lanes = self._lanes[:1] if urgent_only else self._lanes
+        for lane in lanes:
+            while lane:
+                entry = lane[0]
+                identifier, data, offset = entry[0], entry[1], entry[2]
+                if not self._chunk_size or len(data) <= self._chunk_size:
+                    lane.popleft()
+                    buffers.append(header(identifier, len(data)))
+                    buffers.append(data)
+                    written.append(entry[4])
+                    continue
+                if urgent_only:
+                    return buffers, written
+
+                # 1チャンクだけ書き込み、次の呼び出しで優先度の高いレーンを確認する
+                if entry[3] is None:
+                    entry[3] = self._frame_id
+                    self._frame_id = (self._frame_id + 1) & 0xFFFF
+                chunk = memoryview(data)[offset:offset + self._chunk_size]
+                buffers.append(header(CHUNK_IDENTIFIER, _CHUNK_HEADER.size + len(chunk)))
+                buffers.append(_CHUNK_HEADER.pack(identifier, entry[3], offset, len(data)))
+                buffers.append(chunk)
+                entry[2] = offset + len(chunk)
+                if entry[2] >= len(data):
+                    lane.popleft()
+                    written.append(entry[4])
+                return buffers, written
+        return buffers, written
+
+    async def _run(self):
+        protocol = self._protocol
+        transport = protocol.transport
+        protocol.add_listener(self._wakeup.set)
+        while not protocol.is_closed():
+            # 送信バッファが閾値を超えている間も、最優先のフレームは書き込む
+            buffers, written = self._collect(protocol.is_paused())
+            if not buffers:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _write_buffers(transport, buffers)
+            for future in written:
+                if not future.done():
+                    future.set_result(None)
+            await asyncio.sleep(0)
+        self.close()
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """フレーム単位で送受信するプロトコル
+    受信データは再利用するbytearrayに直接読み込み、1回の受信で届いた複数フレームを
+    awaitせずにまとめて解析する。
+    ハンドラーが登録された識別子はバッファのmemoryviewのままハンドラーに渡し、
+    それ以外はコピーしてreceive()/async forで取り出せるようにする。
+    versionがFRAMING_V2以上なら接続直後に対応するバージョンを通知し、相手も対応していれば
+    送信方向ごとにv2（短いヘッダー + シーケンス番号）に切り替える。相手が通知しなければv1のまま。
+    """
+
+    def __init__(self, handlers: list = None, on_connect: callable = None, buffer_size: int = 1 << 18,
+                 version: int = FRAMING_V1):
+        """コンストラクタ
+        :param handlers: 識別子をインデックスとする256要素のハンドラーリスト
+        :param on_connect: 接続時に呼び出すコルーチン関数（引数はこのプロトコル）
+        :param buffer_size: 受信バッファの初期サイズ
+        :param version: 対応するフレーム形式の最大バージョン
+        """
+        self.transport = None
+        self._handlers = handlers if handlers is not None else [None] * 256
+        self._on_connect = on_connect
+        self._log = get_logger('tcp')
+        self._client_task = None
+        self.gate = None    # 識別子をインデックスとする、受け付けを制限するかのリスト
+        self.allow = None   # 制限された識別子を受け付けてよいかを返す関数
+        self.rejected = 0   # 制限により捨てたフレーム数
+        self.heartbeat = None  # pongを渡すHeartbeat
+        self.recorder = None   # 受信したフレームを記録するFrameRecorder
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # 未解析データの先頭
+        self._end = 0    # 受信済みデータの末尾
+        self._need = _HEADER.size  # 次のフレームの解析に必要なバイト数
+
+        # フレーム形式（送信・受信それぞれ相手の切り替えの通知で変わる）
+        self.version = version
+        self.peer_version = None     # 相手が通知した最大バージョン（通知がなければNone）
+        self.send_version = FRAMING_V1
+        self.receive_version = FRAMING_V1
+        self.encode_header = _HEADER.pack  # (識別子, サイズ) -> ヘッダー
+        self._send_seq = 0
+        self._receive_seq = 0
+        self.received = 0   # v2で受信したフレーム数
+        self.lost = 0       # シーケンス番号が飛んだ分のフレーム数
+        self.gaps = 0       # シーケンス番号が飛んだ回数
+        self.reordered = 0  # 前のシーケンス番号のフレームを受信した回数
+
+        self._frames = deque()
+        self._partials = {}  # 識別子 -> [フレームID, 組み立てバッファ, 受信済みバイト数]
+        self._waiter = None
+        self._paused = False
+        self._drain_waiter = None
+        self._listeners = []
+        self._exception = None
+        self._closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.version >= FRAMING_V2:
+            transport.write(self._framing_frame(_FRAMING_FLAG | self.version))
+        if self._on_connect:
+            self._client_task = asyncio.ensure_future(self._on_connect(self))
+
+    def connection_lost(self, exc):
+        self._exception = exc if exc is not None else EOFError("接続が切断されました。")
+        self._wake(self._waiter)
+        self._wake(self._drain_waiter)
+        if not self._closed.done():
+            self._closed.set_result(None)
+        for listener in self._listeners:
+            listener()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake(self._drain_waiter)
+        for listener in self._listeners:
+            listener()
+
+    def add_listener(self, listener: callable):
+        """送信再開・切断時に呼び出すコールバックを登録する"""
+        self._listeners.append(listener)
+
+    def is_paused(self) -> bool:
+        """送信バッファが閾値を超えて一時停止中か"""
+        return self._paused
+
+    def is_closed(self) -> bool:
+        """接続が切断されたか"""
+        return self._exception is not None
+
+    def get_buffer(self, sizehint):
+        if len(self._buffer) - self._end < _MIN_READ or self._start + self._need > len(self._buffer):
+            self._compact()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+        self._parse()
+
+    def eof_received(self):
+        return False
+
+    def _compact(self):
+        """未解析データをバッファ先頭に寄せる（足りなければ大きなバッファに移す）"""
+        pending = self._end - self._start
+        required = max(self._need, pending) + _MIN_READ
+        if required <= len(self._buffer) and pending <= self._start:
+            # 重ならない場合のみその場で移動する
+            self._buffer[:pending] = self._view[self._start:self._end]
+        else:
+            # ハンドラーが古いmemoryviewを保持していても壊れないよう、新しいバッファを確保する
+            buffer = bytearray(max(len(self._buffer), required))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._start = 0
+        self._end = pending
+
+    def _parse(self):
+        """バッファ内の完全なフレームをすべて解析する"""
+        if self.receive_version >= FRAMING_V2:
+            self._parse_v2()
+            return
+        buffer = self._buffer
+        view = self._view
+        start = self._start
+        end = self._end
+        header_size = _HEADER.size
+        while True:
+            if end - start < header_size:
+                self._need = header_size
+                break
+            identifier, size = _HEADER.unpack_from(buffer, start)
+            frame_end = start + header_size + size
+            if frame_end > end:
+                self._need = header_size + size
+                break
+            self._dispatch(identifier, view[start + header_size:frame_end])
+            start = frame_end
+            if identifier == FRAMING_IDENTIFIER and self.receive_version >= FRAMING_V2:
+                # 相手が切り替えたので、残りはv2として解析する
+                self._start = start
+                self._parse_v2()
+                return
+        if start == end:
+            start = end = 0
+        self._start = start
+        self._end = end
+
+    def _parse_v2(self):
+        """v2のフレームをすべて解析し、シーケンス番号から欠落・順序の入れ替わりを数える"""
+        buffer = self._buffer
+        view = self._view
+        start = self._start
+        end = self._end
+        expected = self._receive_seq
+        received = 0
+        unpack_from = _V2_SHORT.unpack_from
+        while True:
+            if end - start < 3:
+                self._need = 3
+                break
+            identifier, seq, size = unpack_from(buffer, start)
+            payload_start = start + 3
+            if size & 0x80:
+                try:
+                    size, payload_start = _read_varint(buffer, start + 2, end)
+                except ValueError as e:
+                    self._log.error("[受信エラー] %s", e)
+                    self.transport.abort()
+                    start = end
+                    break
+                if size is None:
+                    self._need = payload_start - start + 1
+                    break
+            frame_end = payload_start + size
+            if frame_end > end:
+                self._need = frame_end - start
+                break
+            if seq != expected:
+                gap = (seq - expected) & 0xFF
+                if gap < 0x80:
+                    self.lost += gap
+                    self.gaps += 1
+                    expected = (seq + 1) & 0xFF
+                else:
+                    self.reordered += 1
+            else:
+                expected = (expected + 1) & 0xFF
+            received += 1
+            self._dispatch(identifier, view[payload_start:frame_end])
+            start = frame_end
+        self._receive_seq = expected
+        self.received += received
+        if start == end:
+            start = end = 0
+        self._start = start
+        self._end = end
+
+    def _v2_header(self, identifier: int, size: int) -> bytes:
+        """v2のヘッダーを作る（送信順にシーケンス番号を付ける）"""
+        seq = self._send_seq
+        self._send_seq = (seq + 1) & 0xFF
+        if size < 0x80:
+            return _V2_SHORT.pack(identifier, seq, size)
+        if size < 0x4000:
+            return _V2_MEDIUM.pack(identifier, seq, (size & 0x7F) | 0x80, size >> 7)
+        header = bytearray((identifier, seq))
+        while size >= 0x80:
+            header.append((size & 0x7F) | 0x80)
+            size >>= 7
+        header.append(size)
+        return bytes(header)
+
+    @staticmethod
+    def _framing_frame(value: int) -> bytes:
+        """フレーム形式の通知（常にv1の形式）"""
+        return _HEADER.pack(FRAMING_IDENTIFIER, 1) + bytes((value,))
+
+    def _on_framing(self, value: int):
+        """相手のフレーム形式の通知を処理する"""
+        version = value & _FRAMING_VERSION
+        if value & _FRAMING_SWITCH:
+            if not FRAMING_V2 <= version <= self.version:
+                self._log.error("[受信エラー] 未対応のフレーム形式 v%s", version)
+                self.transport.abort()
+                return
+            # 相手はこの通知のあとからv2で送ってくる
+            self.receive_version = version
+            self._receive_seq = 0
+            return
+        self.peer_version = version
+        agreed = min(version, self.version)
+        if agreed >= FRAMING_V2 and self.send_version < FRAMING_V2 and not self.is_closed():
+            # 切り替えの通知より前に書き込んだものはv1、後はv2で届く
+            self.transport.write(self._framing_frame(_FRAMING_FLAG | _FRAMING_SWITCH | agreed))
+            self.send_version = agreed
+            self._send_seq = 0
+            self.encode_header = self._v2_header
+
+    def framing_stats(self) -> Dict[str, Any]:
+        """フレーム形式とシーケンス番号から数えた欠落・入れ替わりの統計"""
+        return {'send_version': self.send_version, 'receive_version': self.receive_version,
+                'received': self.received, 'lost': self.lost, 'gaps': self.gaps,
+                'reordered': self.reordered}
+
+    def _dispatch(self, identifier: int, payload: memoryview):
+        """フレームをハンドラーまたは受信キューに渡す"""
+        if identifier == CHUNK_IDENTIFIER:
+            self._reassemble(payload)
+            return
+        if identifier == HEARTBEAT_IDENTIFIER:
+            self._on_heartbeat(payload)
+            return
+        if identifier == FRAMING_IDENTIFIER and len(payload) == 1 and payload[0] & _FRAMING_FLAG:
+            self._on_framing(payload[0])
+            return
+        if self.recorder is not None:
+            self.recorder.record(RECEIVED, identifier, payload)
+        gate = self.gate
+        if gate is not None and gate[identifier] and not self.allow():
+            self.rejected += 1
+            return
+        handler = self._handlers[identifier]
+        if handler is None:
+            # バッファは再利用されるのでコピーしてキューに入れる
+            self._frames.append((identifier, bytes(payload)))
+            self._wake(self._waiter)
+            return
+        try:
+            handler(identifier, payload)
+        except Exception as e:
+            self._log.error("[受信ハンドラーエラー] 0x%02X: %s", identifier, e)
+
+    def _reassemble(self, payload: memoryview):
+        """チャンクを組み立て、揃ったら元の識別子のフレームとして渡す"""
+        identifier, frame_id, offset, total = _CHUNK_HEADER.unpack_from(payload)
+        chunk = payload[_CHUNK_HEADER.size:]
+        partial = self._partials.get(identifier)
+        if partial is None or partial[0] != frame_id:
+            if offset != 0:
+                return  # 先頭を受信していないフレームは捨てる
+            if partial is None or len(partial[1]) < total:
+                partial = [frame_id, bytearray(total), 0]
+                self._partials[identifier] = partial
+            partial[0] = frame_id
+            partial[2] = 0
+        buffer = partial[1]
+        buffer[offset:offset + len(chunk)] = chunk
+        partial[2] += len(chunk)
+        if partial[2] >= total:
+            partial[0] = None
+            self._dispatch(identifier, memoryview(buffer)[:total])
+
+    def _on_heartbeat(self, payload: memoryview):
+        """pingにはすぐにpongを返し、pongはHeartbeatに渡す"""
+        if len(payload) != _HEARTBEAT.size:
+            return
+        kind, sent, _ = _HEARTBEAT.unpack_from(payload)
+        if kind == _PING:
+            if not self.is_closed():
+                pong = _HEARTBEAT.pack(_PONG, sent, asyncio.get_running_loop().time())
+                self.transport.write(self.encode_header(HEARTBEAT_IDENTIFIER, len(pong)) + pong)
+        elif self.heartbeat is not None:
+            self.heartbeat.pong(sent)
+
+    def ping(self, now: float):
+        """pingを送る（送信キューを通さず、他のフレームの間に書き込む）"""
+        if not self.is_closed():
+            ping = _HEARTBEAT.pack(_PING, now, 0.0)
+            self.transport.write(self.encode_header(HEARTBEAT_IDENTIFIER, len(ping)) + ping)
+
+    def deliver(self, identifier: int, payload: memoryview):
+        """TCP以外で受信したフレームを、TCPで受信したものと同じように渡す"""
+        self._dispatch(identifier, payload)
+
+    @staticmethod
+    def _wake(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def receive(self):
+        """ハンドラー未登録のフレームを1つ受信する
+        :return: (識別子, サイズ, データ)
+        :raises EOFError: 接続が切断された場合
+        """
+        while not self._frames:
+            if self._exception is not None:
+                raise self._exception
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        identifier, data = self._frames.popleft()
+        return identifier, len(data), data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # 相手からの切断・リセットのどちらでもループを終える
+        try:
+            return await self.receive()
+        except (EOFError, ConnectionError):
+            raise StopAsyncIteration
+
+    async def drain(self):
+        """送信バッファが閾値を下回るまで待つ"""
+        if self._exception is not None:
+            raise ConnectionResetError("接続が切断されました。")
+        if not self._paused:
+            return
+        self._drain_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+        if self._exception is not None:
+            raise ConnectionResetError("接続が切断されました。")
+
+    async def wait_closed(self):
+        """接続が閉じられるまで待つ"""
+        await self._closed
+
+
+class Heartbeat:
+    """接続の死活監視とRTT計測
+    interval秒ごとにpingを送り、相手が返したpongのタイムスタンプからRTTを計測する。
+    miss_limit回分の間pongが届かなければ通信劣化とし、届いたら回復とする。
+    """
+
+    def __init__(self, protocol: FrameProtocol, interval: float = 0.5, miss_limit: int = 3,
+                 alpha: float = 0.125, window: int = 256, on_change: callable = None):
+        """コンストラクタ
+        :param protocol: pingを送る接続のプロトコル
+        :param interval: pingの送信間隔（秒）
+        :param miss_limit: 通信劣化とするまでに届かなかったpongの数
+        :param alpha: RTTの指数移動平均の係数
+        :param window: パーセンタイルの計算に使う直近のRTTの数
+        :param on_change: 劣化・回復時に呼び出す関数（引数は劣化中か）
+        """
+        self._protocol = protocol
+        self.interval = interval
+        self.miss_limit = miss_limit
+        self.alpha = alpha
+        self._samples = deque(maxlen=window)
+        self._on_change = on_change
+        self._log = get_logger('tcp')
+        self.srtt = None        # RTTの指数移動平均（秒）
+        self.last_rtt = None
+        self.sent = 0
+        self.received = 0
+        self.degraded = False
+        self._last_pong = asyncio.get_running_loop().time()
+        protocol.heartbeat = self
+        self._task = asyncio.ensure_future(self._run())
+
+    def __repr__(self):
+        return f"Heartbeat {self.stats()}"
+
+    def pong(self, sent: float):
+        """pongを受信した（sentはpingを送った時刻）"""
+        now = asyncio.get_running_loop().time()
+        rtt = now - sent
+        self.received += 1
+        self.last_rtt = rtt
+        self._samples.append(rtt)
+        self.srtt = rtt if self.srtt is None else (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self._last_pong = now
+        if self.degraded:
+            self._set_degraded(False)
+
+    def _set_degraded(self, degraded: bool):
+        self.degraded = degraded
+        if self._on_change is not None:
+            try:
+                self._on_change(degraded)
+            except Exception as e:
+                self._log.error("[通信状態ハンドラーエラー] %s", e)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while not self._protocol.is_closed():
+            self._protocol.ping(loop.time())
+            self.sent += 1
+            await asyncio.sleep(self.interval)
+            if not self.degraded and loop.time() - self._last_pong > self.interval * self.miss_limit:
+                self._set_degraded(True)
+
+    def stop(self):
+        """pingの送信を止める"""
+        self._task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """RTTの統計（秒）と送受信したping/pongの数"""
+        return {'srtt': self.srtt, 'p50': percentile(self._samples, 0.5), 'p99': percentile(self._samples, 0.99),
+                'last': self.last_rtt, 'sent': self.sent, 'received': self.received,
+                'degraded': self.degraded}
+
+
+class Session:
+    """1つのTCP接続の状態
+    接続ごとに受信プロトコルと送信スケジューラーを持つ。
+    """
+
+    def __init__(self, transport, protocol: FrameProtocol, scheduler_config: Dict[str, Any],
+                 heartbeat_config: Dict[str, Any] = None, on_link_change: callable = None):
+        """コンストラクタ
+        :param scheduler_config: 送信スケジューラーの設定
+        :param heartbeat_config: 死活監視の設定（Noneまたはenabledがfalseなら監視しない）
+        :param on_link_change: 通信劣化・回復時に呼び出す関数（引数はSessionと劣化中か）
+        """
+        chunk_size = scheduler_config.get('chunk_size', 0)
+        send_buffer = scheduler_config.get('send_buffer')
+        if send_buffer:
+            # カーネルの送信バッファに溜まる分も割り込めないため、小さくしておく
+            sock = transport.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+        if chunk_size:
+            transport.set_write_buffer_limits(high=chunk_size * 2)
+        self.transport = transport
+        self.protocol = protocol
+        self.addr = transport.get_extra_info('peername')
+        self.scheduler = SendScheduler(
+            protocol,
+            priorities=scheduler_config.get('priority'),
+            default_priority=scheduler_config.get('default_priority', 1),
+            chunk_size=chunk_size,
+        )
+        self.has_lease = False
+        self._udp = None
+        self._udp_identifiers = None
+        self.udp_peer = None  # UDPの送信先
+        self.heartbeat = None
+        if heartbeat_config and heartbeat_config.get('enabled', True):
+            self.heartbeat = Heartbeat(
+                protocol,
+                interval=heartbeat_config.get('interval', 0.5),
+                miss_limit=heartbeat_config.get('miss_limit', 3),
+                alpha=heartbeat_config.get('alpha', 0.125),
+                window=heartbeat_config.get('window', 256),
+                on_change=on_link_change and (lambda degraded: on_link_change(self, degraded)),
+            )
+
+    def __repr__(self):
+        role = "操縦" if self.has_lease else "閲覧"
+        return f"Session {self.addr} ({role})"
+
+    def is_closed(self) -> bool:
+        return self.protocol.is_closed()
+
+    async def close(self):
+        """接続を閉じる"""
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        try:
+            self.scheduler.close()
+            self.transport.close()
+            await self.protocol.wait_closed()
+        except (ConnectionResetError, OSError):
+            pass
+
+    async def wait_closed(self):
+        """接続が閉じられるまで待つ"""
+        await self.protocol.wait_closed()
+
+    def attach_udp(self, udp, identifiers: list, peer):
+        """制御フレームをUDPで送るようにする
+        :param udp: 送信に使うUdpControlProtocol
+        :param identifiers: UDPで送るかを識別子をインデックスとして表す256要素のリスト
+        :param peer: UDPの送信先（クライアントの場合はNone）
+        """
+        self._udp = udp
+        self._udp_identifiers = identifiers
+        self.udp_peer = peer
+
+    def submit(self, frames) -> asyncio.Future:
+        """フレームを送信キューに入れる（UDPで送る識別子はすぐに送る）
+        :return: 書き込まれたら完了するFuture
+        """
+        if self.is_closed():
+            raise ConnectionResetError("接続が切断されました。")
+        if self._udp_identifiers is not None:
+            tcp_frames = []
+            for identifier, data in frames:
+                if self._udp_identifiers[identifier]:
+                    self._udp.send(identifier, data, self.udp_peer)
+                else:
+                    tcp_frames.append((identifier, data))
+            if not tcp_frames:
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(None)
+                return future
+            frames = tcp_frames
+        return self.scheduler.submit(frames)
+
+    async def send(self, identifier: int, data: bytes):
+        """データを送信し、書き込まれるまで待つ"""
+        await self.submit(((identifier, data),))
+
+    async def send_many(self, frames):
+        """複数のデータをまとめて送信する"""
+        await self.submit(frames)
+
+    def send_nowait(self, identifier: int, data: bytes) -> asyncio.Future:
+        """書き込みを待たずに送信キューに入れる
+        :return: 書き込まれたら完了するFuture
+        """
+        future = self.submit(((identifier, data),))
+        # 待たれないFutureの例外で警告が出ないようにする
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def write_buffer_size(self, identifier: int = None) -> int:
+        """未送信のバイト数（トランスポートのバッファ + 送信キュー）
+        :param identifier: 指定した場合、送信キューはその識別子のみ数える
+        """
+        return self.transport.get_write_buffer_size() + self.scheduler.queued_bytes(identifier)
+
+    async def receive(self):
+        """ハンドラー未登録のデータを受信する"""
+        return await self.protocol.receive()
+
+    def frames(self):
+        """ハンドラー未登録のデータを async for で受信する"""
+        return self.protocol
 
 
 class Tcp:
-    """TCP通信を管理するクラス"""
+    """TCP通信を管理するクラス
+    クライアントとして使う場合は1つのSession、サーバーとして使う場合は接続ごとのSessionを持つ。
+    サーバーでは送信データを全Sessionに配信し、制御フレームは操縦権（リース）を持つ
+    1つのSessionからのみ受け付ける。
+    """
 
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, scheduler_config: Dict[str, Any] = None,
+                 server_config: Dict[str, Any] = None, heartbeat_config: Dict[str, Any] = None,
+                 record_config: Dict[str, Any] = None, framing_config: Dict[str, Any] = None):
+        """コンストラクタ
+        :param scheduler_config: 送信スケジューラーの設定（省略時はconfig.yamlのtcp.scheduler）
+        :param server_config: サーバーモードの設定（省略時はconfig.yamlのtcp.server）
+        :param heartbeat_config: 死活監視の設定（省略時はconfig.yamlのtcp.heartbeat）
+        :param record_config: 送受信フレームの記録の設定（省略時はconfig.yamlのtcp.record）
+        :param framing_config: フレーム形式の設定（省略時はconfig.yamlのtcp.framing）
+        """
         self.host = host
         self.port = port
-        self.reader = None
-        self.writer = None
+        self.session = None  # クライアントとして接続中のSession
+        self.address = None  # 解決済みのIPアドレス（クライアント）
+        self.sessions = []   # 接続中のすべてのSession
+        self._server = False
+        self._handlers = [None] * 256
+        tcp_config = None
+        if None in (scheduler_config, server_config, heartbeat_config, record_config, framing_config):
+            tcp_config = load_config('tcp')
+        if scheduler_config is None:
+            scheduler_config = tcp_config.get('scheduler', {})
+        if server_config is None:
+            server_config = tcp_config.get('server', {})
+        if heartbeat_config is None:
+            heartbeat_config = tcp_config.get('heartbeat', {})
+        if framing_config is None:
+            framing_config = tcp_config.get('framing', {})
+        self._scheduler_config = scheduler_config
+        self._heartbeat_config = heartbeat_config
+        # 対応するフレーム形式の最大バージョン（相手が対応していなければv1で送受信する）
+        self.framing_version = framing_config.get('version', FRAMING_V2)
+        self._link_listeners = []
+
+        # 送受信したフレームの記録（接続し直しても同じファイルに記録し続ける）
+        if record_config is None:
+            record_config = tcp_config.get('record', {})
+        self.recorder = None
+        if record_config.get('enabled', False):
+            self.recorder = FrameRecorder(record_config.get('path', 'logs'))
+
+        # 操縦権（リース）
+        self._control = [False] * 256
+        for identifier in server_config.get('control_identifiers', [0x11, 0x12, 0x02, 0xFF, 0xFC]):
+            self._control[identifier] = True
+        self._lease_grace = server_config.get('lease_grace', 5.0)
+        self._lease_takeover = server_config.get('lease_takeover', True)
+        self.viewer_frame_interval = server_config.get('viewer_frame_interval', 0.0)
+        self.lease = None
+        self._reserved_host = None   # 切断したリース保持者のホスト
+        self._reserved_until = 0.0   # そのホストのためにリースを空けておく期限
 
     def __repr__(self):
         return f"TCP ({self.host}:{self.port})"
-    
+
+    @property
+    def transport(self):
+        return self.session.transport if self.session else None
+
+    @property
+    def protocol(self):
+        return self.session.protocol if self.session else None
+
+    @property
+    def scheduler(self):
+        return self.session.scheduler if self.session else None
+
+    @property
+    def heartbeat(self):
+        """クライアントとして接続中の死活監視（RTTの統計はheartbeat.stats()）"""
+        return self.session.heartbeat if self.session else None
+
+    def on_link_change(self, listener: callable):
+        """通信劣化・回復時に呼び出す関数を登録する
+        :param listener: (Session, 劣化中か) を引数に呼び出される関数
+        """
+        self._link_listeners.append(listener)
+
+    def _notify_link(self, session: Session, degraded: bool):
+        for listener in self._link_listeners:
+            listener(session, degraded)
+
+    def on(self, identifier: int, handler: callable):
+        """識別子ごとの受信ハンドラーを登録する
+        ハンドラーは受信コールバック内で (識別子, memoryview) を引数に呼び出される。
+        memoryviewは受信バッファを指しているため、呼び出し後に保持してはいけない。
+        :param handler: 登録するハンドラー（Noneで解除）
+        """
+        self._handlers[identifier] = handler
+
+    def _open_session(self, transport, protocol: FrameProtocol) -> Session:
+        protocol.recorder = self.recorder
+        session = Session(transport, protocol, self._scheduler_config,
+                          self._heartbeat_config, self._notify_link)
+        self.sessions.append(session)
+        protocol.add_listener(lambda: self._on_session_closed(session))
+        return session
+
+    async def resolve(self, refresh: bool = False) -> str:
+        """ホスト名をIPアドレスに解決する
+        結果はキャッシュし、再接続のたびにmDNS（takapi.localなど）を問い合わせないようにする
+        :param refresh: キャッシュを使わずに解決し直す
+        """
+        if self.address is None or refresh:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+            self.address = infos[0][4][0]
+        return self.address
+
     async def connect(self):
         """TCPサーバーに接続する"""
-        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        loop = asyncio.get_running_loop()
+        address = await self.resolve()
+        transport, protocol = await loop.create_connection(
+            lambda: FrameProtocol(self._handlers, version=self.framing_version), address, self.port)
+        self.session = self._open_session(transport, protocol)
         return self.host, self.port
     
     async def start_server(self, handle_client: callable):
-        """TCPサーバーを開始し、クライアント接続を待機する"""
-        server = await asyncio.start_server(self.callback(handle_client), self.host, self.port)
+        """TCPサーバーを開始し、クライアント接続を待機する
+        :param handle_client: 接続ごとに呼び出されるコルーチン関数（引数はSession）
+        """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: FrameProtocol(self._handlers, self.callback(handle_client), version=self.framing_version),
+            self.host, self.port)
         address = server.sockets[0].getsockname()
+        self._server = True
         return server, address
     
     def callback(self, handle_client: callable):
         """クライアント接続時に呼び出されるコールバック関数を返す"""
-        async def client_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-            self.reader = reader
-            self.writer = writer
-            addr = writer.get_extra_info('peername')
-            await handle_client(addr)
+        async def client_handler(protocol: FrameProtocol):
+            session = self._open_session(protocol.transport, protocol)
+            protocol.gate = self._control
+            protocol.allow = lambda: self._acquire_lease(session)
+            if self._lease_takeover and self.lease is not None and self.lease.addr[0] == session.addr[0]:
+                # Wi-Fiの切断で古い接続が残ったまま操縦者が再接続してきた場合は、古い接続を閉じて引き継ぐ
+                stale = self.lease
+                self.lease = None
+                stale.has_lease = False
+                stale.transport.abort()
+            self._acquire_lease(session)
+            await handle_client(session)
         return client_handler
+
+    def _acquire_lease(self, session: Session) -> bool:
+        """Sessionが操縦権を持っているか確認し、空いていれば与える"""
+        if self.lease is session:
+            return True
+        if self.lease is not None or session.is_closed():
+            return False
+        # 切断した操縦者の再接続のため、猶予期間中は同じホストにだけ与える
+        loop = asyncio.get_running_loop()
+        if self._reserved_host is not None and loop.time() < self._reserved_until:
+            if session.addr[0] != self._reserved_host:
+                return False
+        self.lease = session
+        session.has_lease = True
+        self._reserved_host = None
+        return True
+
+    def _on_session_closed(self, session: Session):
+        # リスナーは送信再開時にも呼ばれる
+        if not session.is_closed() or session not in self.sessions:
+            return
+        self.sessions.remove(session)
+        if self.lease is session:
+            self.lease = None
+            session.has_lease = False
+            self._reserved_host = session.addr[0]
+            self._reserved_until = asyncio.get_running_loop().time() + self._lease_grace
     
     async def close(self):
-        """TCP接続を閉じる"""
-        if self.writer:
-            try:
-                self.writer.close()
-                await self.writer.wait_closed()
-            except (ConnectionResetError, OSError):
-                pass
-            finally:
-                self.writer = None
-                self.reader = None
+        """TCP接続を閉じる（サーバーの場合はすべてのSession）"""
+        sessions = list(self.sessions)
+        await asyncio.gather(*(session.close() for session in sessions))
+        self.session = None
     
     async def send(self, identifier: int, data: bytes):
-        """データを送信する"""
-        if not self.writer:
+        """データを送信する
+        送信スケジューラーを通し、書き込まれるまで待つ。
+        サーバーの場合は全Sessionに同じバッファを配信し、操縦者への書き込みだけを待つ
+        （接続がなければ何もしない）
+        """
+        if self.recorder is not None:
+            self.recorder.record(SENT, identifier, data)
+        if self.session:
+            await self.session.send(identifier, data)
+            return
+        if not self._server:
             raise ConnectionError("TCP接続が確立されていません。")
-        
-        size = len(data)
-        header = struct.pack('B', identifier) + struct.pack('>I', size)
-        self.writer.write(header + data)
-        await self.writer.drain()
+        waiting = None
+        for session in list(self.sessions):
+            future = session.send_nowait(identifier, data)
+            if session is self.lease:
+                waiting = future
+        if waiting is not None:
+            await waiting
+
+    async def send_many(self, frames):
+        """複数のデータをまとめて送信する
+        全フレームをまとめて書き込み、drainを1回だけ行う
+        :param frames: (識別子, データ) のリスト
+        """
+        if self.recorder is not None:
+            for identifier, data in frames:
+                self.recorder.record(SENT, identifier, data)
+        if self.session:
+            await self.session.send_many(frames)
+            return
+        if not self._server:
+            raise ConnectionError("TCP接続が確立されていません。")
+        for session in list(self.sessions):
+            if session is not self.lease:
+                future = session.submit(frames)
+                future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if self.lease:
+            await self.lease.send_many(frames)
+
+    def send_nowait(self, identifier: int, data: bytes) -> asyncio.Future:
+        """書き込みを待たずに送信キューに入れる
+        :return: 書き込まれたら完了するFuture
+        """
+        if self.recorder is not None:
+            self.recorder.record(SENT, identifier, data)
+        if self.session:
+            return self.session.send_nowait(identifier, data)
+        if not self._server:
+            raise ConnectionError("TCP接続が確立されていません。")
+        futures = [session.send_nowait(identifier, data) for session in self.sessions]
+        return asyncio.gather(*futures, return_exceptions=True)
+
+    def write_buffer_size(self, identifier: int = None) -> int:
+        """未送信のバイト数（トランスポートのバッファ + 送信キュー）
+        サーバーの場合は最も詰まっているSessionの値
+        :param identifier: 指定した場合、送信キューはその識別子のみ数える
+        """
+        sizes = [session.write_buffer_size(identifier) for session in self.sessions]
+        return max(sizes, default=0)
 
     async def receive(self):
-        """データを受信する"""
-        if not self.reader:
+        """ハンドラー未登録のデータを受信する（クライアント用）"""
+        if not self.session:
             raise ConnectionError("TCP接続が確立されていません。")
         
-        try:
-            header_byte = await self.reader.readexactly(5)
-            identifier = struct.unpack('B', header_byte[0:1])[0]
-            size = struct.unpack('>I', header_byte[1:5])[0]
-            data = await self.reader.readexactly(size)
-        except asyncio.IncompleteReadError as e:
-            if e.partial == b'':
-                raise EOFError("接続が切断されました。") from e
+        return await self.session.receive()
+
+    def frames(self):
+        """ハンドラー未登録のデータを async for で受信する（クライアント用）"""
+        if not self.session:
+            raise ConnectionError("TCP接続が確立されていません。")
+
+        return self.session.frames()
+
+
+class UdpControlProtocol(asyncio.DatagramProtocol):
+    """制御フレーム用のUDPプロトコル
+    各レコードにシーケンス番号を付け、受信側は送信元・識別子ごとに古いレコードを捨てる（最新値のみ）。
+    redundancyを有効にすると、直前に送ったレコードも同じデータグラムに入れて送り、
+    1つのデータグラムが失われても次のデータグラムで回復できるようにする。
+    """
+
+    def __init__(self, deliver: callable, redundancy: bool = True):
+        """コンストラクタ
+        :param deliver: 受理したレコードを渡す関数 (識別子, memoryview, 送信元アドレス)
+        :param redundancy: 直前のレコードを重複して送るか
+        """
+        self.transport = None
+        self.peer = None  # 最後にデータグラムを受信した相手
+        self._deliver = deliver
+        self._redundancy = redundancy
+        self._seq = 0
+        self._previous = {}  # 送信先 -> 直前のレコード
+        self._last_seq = {}  # 送信元 -> 識別子ごとの最後のシーケンス番号
+        self.received = 0   # 受信したレコード数
+        self.accepted = 0   # 受理したレコード数
+        self.discarded = 0  # 古い・重複で捨てたレコード数
+        self.recovered = 0  # 重複送信分から回復したレコード数
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.peer = addr
+        last_seq = self._last_seq.get(addr)
+        if last_seq is None:
+            last_seq = self._last_seq[addr] = [None] * 256
+        view = memoryview(data)
+        offset = 0
+        index = 0
+        while offset + _UDP_RECORD.size <= len(view):
+            identifier, seq, size = _UDP_RECORD.unpack_from(view, offset)
+            offset += _UDP_RECORD.size
+            payload = view[offset:offset + size]
+            offset += size
+            if len(payload) != size:
+                break
+            self.received += 1
+            last = last_seq[identifier]
+            # 32bitの周回を考慮し、前回より新しいものだけを受理する
+            if last is not None and not 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000:
+                self.discarded += 1
             else:
-                raise
-        except asyncio.CancelledError:
+                last_seq[identifier] = seq
+                self.accepted += 1
+                if index == 0 and len(view) > offset:
+                    # 後ろにレコードが続く先頭のレコードは、重複送信された直前のレコード
+                    self.recovered += 1
+                self._deliver(identifier, payload, addr)
+            index += 1
+
+    def error_received(self, exc):
+        pass
+
+    def send(self, identifier: int, data: bytes, addr=None):
+        """レコードを1つ送信する（同じ相手に直前に送ったレコードを前に付ける）"""
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        record = (_UDP_RECORD.pack(identifier, self._seq, len(data)), data)
+        self.transport.sendto(b''.join(self._previous.get(addr, ()) + record), addr)
+        if self._redundancy:
+            self._previous[addr] = (record[0], bytes(data))
+
+    def forget(self, addr):
+        """切断した相手のシーケンス番号と直前のレコードの記録を消す"""
+        self._last_seq.pop(addr, None)
+        self._previous.pop(addr, None)
+
+    def reset(self):
+        """すべての相手の記録を消す"""
+        self._last_seq.clear()
+        self._previous.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {'received': self.received, 'accepted': self.accepted,
+                'discarded': self.discarded, 'recovered': self.recovered}
+
+
+class UdpTcp(Tcp):
+    """制御フレームだけをUDPで送受信するTcp
+    サーボ・BLDCなどのスナップショットはUDPで送り、1つのパケットが失われても
+    後続のフレームが待たされないようにする。カメラ画像や設定コマンドはTCPのまま。
+    サーバーではデータグラムの送信元ホストからSessionを対応付ける。
+    """
+
+    def __init__(self, host: str, port: int, udp_config: Dict[str, Any] = None,
+                 scheduler_config: Dict[str, Any] = None, server_config: Dict[str, Any] = None):
+        """コンストラクタ
+        :param udp_config: UDPの設定（省略時はconfig.yamlのtcp.udp）
+        """
+        super().__init__(host, port, scheduler_config, server_config)
+        if udp_config is None:
+            udp_config = load_config('tcp').get('udp', {})
+        self.udp_port = udp_config.get('port', port + 1)
+        self._udp_identifiers = [False] * 256
+        for identifier in udp_config.get('identifiers', [0x11, 0x12, 0x02, 0x03, 0xFC]):
+            self._udp_identifiers[identifier] = True
+        self._redundancy = udp_config.get('redundancy', True)
+        self.udp = None
+        self._udp_transport = None
+        self._udp_server = False
+        self._udp_peers = {}  # UDPの送信元 -> Session
+
+    def __repr__(self):
+        return f"TCP+UDP ({self.host}:{self.port}, udp:{self.udp_port})"
+
+    def _deliver(self, identifier: int, payload: memoryview, addr):
+        session = self._udp_session(addr) if self._udp_server else self.session
+        if session is not None:
+            session.protocol.deliver(identifier, payload)
+
+    def _udp_session(self, addr):
+        """UDPの送信元に対応するSessionを返す"""
+        session = self._udp_peers.get(addr)
+        if session is None:
+            # 同じホストからのTCP接続のうち、まだUDPの送信元が決まっていないものに対応付ける
+            candidates = [s for s in self.sessions if s.addr[0] == addr[0] and s.udp_peer is None]
+            if not candidates:
+                return None
+            session = self.lease if self.lease in candidates else candidates[-1]
+            session.attach_udp(self.udp, self._udp_identifiers, addr)
+            self._udp_peers[addr] = session
+        return session
+
+    def _on_session_closed(self, session: Session):
+        super()._on_session_closed(session)
+        if session.udp_peer is not None and self._udp_peers.get(session.udp_peer) is session:
+            del self._udp_peers[session.udp_peer]
+            self.udp.forget(session.udp_peer)
+
+    async def connect(self):
+        """TCPサーバーに接続し、UDPの送信先を設定する"""
+        result = await super().connect()
+        loop = asyncio.get_running_loop()
+        self._udp_transport, self.udp = await loop.create_datagram_endpoint(
+            lambda: UdpControlProtocol(self._deliver, self._redundancy),
+            remote_addr=(self.address, self.udp_port))
+        self.session.attach_udp(self.udp, self._udp_identifiers, None)
+        return result
+
+    async def start_server(self, handle_client: callable):
+        """TCPサーバーとUDPの受信を開始する
+        サーバー側は相手から受信するまで送信先がわからないので、それまではTCPで送る
+        """
+        result = await super().start_server(handle_client)
+        loop = asyncio.get_running_loop()
+        self._udp_transport, self.udp = await loop.create_datagram_endpoint(
+            lambda: UdpControlProtocol(self._deliver, self._redundancy),
+            local_addr=(self.host, self.udp_port))
+        self._udp_server = True
+        return result
+
+    async def close(self):
+        """TCP接続を閉じる（クライアントの場合はUDPも閉じる）"""
+        await super().close()
+        if self._udp_transport and not self._udp_server:
+            self._udp_transport.close()
+            self._udp_transport = None
+            self.udp = None
+
+
+class LatestSender:
+    """最新のデータだけを送る送信器（カメラ画像用）
+    put()は待たずにデータを1つだけの枠に入れ、送信タスクが接続ごとの回線の空き具合に合わせて送る。
+    接続ごとに、未送信のバイト数がhigh_waterを超えたらlow_waterを下回るまで送信を止め、
+    その間に来た古いデータは新しいデータで上書きして捨てる。
+    サーバーでは全Sessionに同じバッファを送り、操縦権のないSessionには
+    tcp.viewer_frame_interval より短い間隔では送らない。
+    """
+
+    def __init__(self, tcp: Tcp, identifier: int, high_water: int = 64 * 1024,
+                 low_water: int = 16 * 1024, poll_interval: float = 0.01):
+        """コンストラクタ
+        :param tcp: 送信に使うTcp
+        :param identifier: 送信する識別子
+        :param high_water: 混雑と判断する未送信バイト数
+        :param low_water: 混雑が解消したと判断する未送信バイト数
+        :param poll_interval: 混雑中に未送信バイト数を確認する間隔（秒）
+        """
+        self._tcp = tcp
+        self._identifier = identifier
+        self.high_water = high_water
+        self.low_water = low_water
+        self.poll_interval = poll_interval
+        self._latest = None
+        self._version = 0
+        self._delivered = True  # 最新のデータをどこかのSessionに送ったか
+        self._ready = asyncio.Event()
+        self._states = {}  # Session -> [送信済みのバージョン, 混雑中か, 最後に送った時刻]
+        self.captured = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return f"LatestSender (0x{self._identifier:02X}) {self.stats()}"
+
+    def put(self, data: bytes):
+        """送信するデータを入れる（送信を待たない）"""
+        self.captured += 1
+        if not self._delivered:
+            self.dropped += 1
+        self._latest = data
+        self._version += 1
+        self._delivered = False
+        self._ready.set()
+
+    def stats(self) -> Dict[str, int]:
+        """取得・送信・破棄したフレーム数（どのSessionにも送られなかったものを破棄とする）"""
+        return {'captured': self.captured, 'sent': self.sent, 'dropped': self.dropped}
+
+    def _is_congested(self, session, state: list) -> bool:
+        size = session.write_buffer_size()
+        if state[1]:
+            state[1] = size > self.low_water
+        else:
+            state[1] = size > self.high_water
+        return state[1]
+
+    def _send_pending(self) -> bool:
+        """まだ最新のデータを受け取っていないSessionに送る
+        :return: 混雑や間隔制限で送れなかったSessionがあるか
+        """
+        sessions = self._tcp.sessions
+        if len(self._states) > len(sessions):
+            self._states = {s: state for s, state in self._states.items() if s in sessions}
+        loop = asyncio.get_running_loop()
+        interval = self._tcp.viewer_frame_interval
+        waiting = False
+        for session in sessions:
+            state = self._states.get(session)
+            if state is None:
+                state = self._states[session] = [0, False, 0.0]
+            if state[0] == self._version:
+                continue
+            now = loop.time()
+            if self._is_congested(session, state) or (not session.has_lease and now - state[2] < interval):
+                waiting = True
+                continue
+            try:
+                session.send_nowait(self._identifier, self._latest)
+            except ConnectionError:
+                continue
+            state[0] = self._version
+            state[2] = now
+            if not self._delivered:
+                self._delivered = True
+                self.sent += 1
+                if self._tcp.recorder is not None:
+                    self._tcp.recorder.record(SENT, self._identifier, self._latest)
+        return waiting
+
+    async def run(self):
+        """送信ループ（タスクとして起動する）"""
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._send_pending():
+                self._ready.set()
+                await asyncio.sleep(self.poll_interval)
+
+
+class Reconnector:
+    """切断時に自動で再接続するクライアント
+    接続に失敗するたびに待ち時間を伸ばし（ランダムに揺らして）再試行する。
+    解決済みのアドレスはTcp側にキャッシュされ、続けて失敗した場合のみ解決し直す。
+    再接続できたらsnapshotで得た最後の制御フレームを送り直す。
+    """
+
+    def __init__(self, tcp: Tcp, snapshot: callable = None, reconnect_config: Dict[str, Any] = None):
+        """コンストラクタ
+        :param tcp: 接続に使うTcp（DataManagerやハンドラーは接続をまたいで保持される）
+        :param snapshot: 再接続後に送り直すフレーム [(識別子, データ), ...] を返す関数
+        :param reconnect_config: 再接続の設定（省略時はconfig.yamlのtcp.reconnect）
+        """
+        if reconnect_config is None:
+            reconnect_config = load_config('tcp').get('reconnect', {})
+        self._tcp = tcp
+        self._snapshot = snapshot
+        self.initial_delay = reconnect_config.get('initial_delay', 0.1)
+        self.max_delay = reconnect_config.get('max_delay', 5.0)
+        self.factor = reconnect_config.get('factor', 2.0)
+        self.jitter = reconnect_config.get('jitter', 0.5)
+        self.resolve_failures = reconnect_config.get('resolve_failures', 3)
+        self._random = random.Random()
+        self._log = get_logger('tcp')
+        self._lost_at = None
+        self.connected_once = False
+        self.attempts = 0       # 接続を試みた回数
+        self.reconnects = 0     # 再接続に成功した回数
+        self.recovery_times = []  # 切断から再接続（スナップショット送信）までの時間（秒）
+
+    def __repr__(self):
+        return f"Reconnector ({self._tcp}) {self.stats()}"
+
+    def delay(self, failures: int) -> float:
+        """failures回続けて失敗した後の待ち時間"""
+        delay = min(self.max_delay, self.initial_delay * self.factor ** failures)
+        return delay * (1 - self.jitter * self._random.random())
+
+    def _on_event(self):
+        if self._tcp.protocol is not None and self._tcp.protocol.is_closed() and self._lost_at is None:
+            self._lost_at = asyncio.get_running_loop().time()
+
+    async def connect(self):
+        """接続できるまで再試行する
+        2回目以降の呼び出しは再接続として扱い、古い接続を閉じてからスナップショットを送り直す
+        :return: (ホスト, ポート)
+        """
+        loop = asyncio.get_running_loop()
+        if self.connected_once and self._lost_at is None:
+            self._lost_at = loop.time()
+        await self._tcp.close()
+        failures = 0
+        while True:
+            self.attempts += 1
+            try:
+                result = await self._tcp.connect()
+                break
+            except OSError as e:
+                # ConnectionRefusedError・名前解決の失敗(socket.gaierror)・ネットワーク到達不能など
+                failures += 1
+                delay = self.delay(failures - 1)
+                self._log.warning("⚠️ 接続失敗 (%d回目): %s - %.2f秒後に再試行", failures, e, delay)
+                if failures % self.resolve_failures == 0:
+                    self._tcp.address = None  # アドレスが変わった可能性があるので解決し直す
+                await asyncio.sleep(delay)
+
+        if self._tcp.protocol is not None:
+            self._tcp.protocol.add_listener(self._on_event)
+        if self.connected_once:
+            if self._snapshot is not None:
+                await self._tcp.send_many(self._snapshot())
+            self.reconnects += 1
+            self.recovery_times.append(loop.time() - self._lost_at)
+            self._log.info("🔁 再接続しました（%.0fms）", self.recovery_times[-1] * 1000)
+        self.connected_once = True
+        self._lost_at = None
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """接続試行回数・再接続回数・最後の復旧時間（秒）"""
+        return {'attempts': self.attempts, 'reconnects': self.reconnects,
+                'last_recovery': self.recovery_times[-1] if self.recovery_times else None}
+
+
+class ReplayServer:
+    """記録したログをRasp.pyの代わりに再生するサーバー
+    接続してきたPCに、ログのフレームを記録時の間隔（speed倍速）で送る。
+    PCから届いたフレームは読み捨てる。
+    """
+
+    def __init__(self, log: FrameLog, host: str, port: int, speed: float = 1.0, direction: int = SENT,
+                 identifiers: list = None, start: float = 0.0, loop: bool = False):
+        """コンストラクタ
+        :param log: 再生するログ
+        :param speed: 再生速度（2.0で2倍速、0で待たずに全力で送る）
+        :param direction: 再生するフレームの方向（Raspで記録したログはSENT、PCで記録したログはRECEIVED）
+        :param identifiers: 再生する識別子のリスト（省略時はすべて）
+        :param start: 再生を始める時刻（記録開始からの秒）
+        :param loop: 最後まで再生したら最初から繰り返すか
+        """
+        self.log = log
+        self.speed = speed
+        self.direction = direction
+        self.identifiers = identifiers
+        self.start = start
+        self.loop = loop
+        self.tcp = Tcp(host, port, server_config={'control_identifiers': []}, record_config={})
+        self._log = get_logger('replay')
+        self.replayed = 0   # 送ったフレーム数
+        self.max_lag = 0.0  # 予定の送信時刻からの最大の遅れ（秒）
+
+    def __repr__(self):
+        return f"ReplayServer ({self.log.path}) {self.stats()}"
+
+    async def start_server(self):
+        """サーバーを開始する"""
+        return await self.tcp.start_server(self._serve)
+
+    async def _drain(self, session: Session):
+        async for _ in session.frames():
             pass
 
-        return identifier, size, data
+    async def _serve(self, session: Session):
+        self._log.info("▶️ 再生開始: %s (%s倍速)", session, self.speed)
+        drain_task = asyncio.create_task(self._drain(session))
+        try:
+            while True:
+                await self._replay(session)
+                if not self.loop:
+                    break
+            self._log.info("⏹️ 再生終了: %s", self.stats())
+            await session.wait_closed()
+        except ConnectionError:
+            self._log.warning("❌ 切断: %s", session)
+        finally:
+            drain_task.cancel()
+            await session.close()
+
+    async def _replay(self, session: Session):
+        """ログを1回再生する"""
+        loop = asyncio.get_running_loop()
+        wanted = None
+        if self.identifiers is not None:
+            wanted = [False] * 256
+            for identifier in self.identifiers:
+                wanted[identifier] = True
+        base = loop.time()
+        first = None
+        for timestamp, direction, identifier, data in self.log.frames(direction=self.direction, start=self.start):
+            if wanted is not None and not wanted[identifier]:
+                continue
+            if first is None:
+                first = timestamp
+            if self.speed > 0:
+                due = base + (timestamp - first) / self.speed
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+            await session.send(identifier, data)
+            self.replayed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """送ったフレーム数と最大の遅れ（秒）"""
+        return {'replayed': self.replayed, 'max_lag': self.max_lag}
+
+
+class _SendPreview:
+    """DebugTcpの送信内容の表示（ログのメッセージにするときにだけ文字列を作る）"""
+    __slots__ = ('identifier', 'data', 'data_types')
+
+    def __init__(self, identifier: int, data: bytes, data_types: Dict[int, str]):
+        self.identifier = identifier
+        self.data = data
+        self.data_types = data_types
+
+    def __str__(self):
+        identifier, data = self.identifier, self.data
+        data_type = self.data_types.get(identifier, f"不明(0x{identifier:02X})")
+        info = f"識別子: 0x{identifier:02X} ({data_type}), サイズ: {len(data)}バイト"
+        # 簡単なデータプレビュー
+        if len(data) > 0:
+            preview = ' '.join(f'{b:02X}' for b in data[:min(12, len(data))])
+            if len(data) > 12:
+                preview += f" ... (残り{len(data) - 12}バイト)"
+            info += f", データ: {preview}"
+        return info
 
 
 class DebugTcp:
@@ -87,12 +1503,21 @@ class DebugTcp:
     def __init__(self, host: str, port: int):
         self.host = host
         self.port = port
-        self.reader = None
-        self.writer = None
+        self.transport = None
+        self.protocol = None
         self.connected = False
+        self.address = None  # 疑似接続なので名前解決しない（Tcpと同じ属性を持たせる）
+        self._handlers = [None] * 256
+        self.has_lease = True
+        self.viewer_frame_interval = 0.0
+        self.recorder = None
         
         # 設定を読み込み
         self.config = self._load_debug_config()
+        # 出力はキューと書き込みスレッドで行い、tcp.debugの件数制限に従う（config.yamlのlog）
+        self._log = get_logger('tcp.debug')
+        self._extra = {'timestamp': self.config.get('show_timestamp', True),
+                       'color': "\033[96m" if self.config.get('show_colors', True) else None}
         
         # データ識別子の基本マッピング
         self.data_types = {
@@ -102,21 +1527,27 @@ class DebugTcp:
 
     def __repr__(self):
         return f"DebugTCP ({self.host}:{self.port})"
+
+    @property
+    def sessions(self):
+        """疑似接続自身を唯一のSessionとして扱う"""
+        return [self]
+
+    @property
+    def heartbeat(self):
+        """疑似接続なので死活監視はしない"""
+        return None
+
+    def on_link_change(self, listener: callable):
+        """疑似接続なので通信劣化は起きない"""
+    
+    def on(self, identifier: int, handler: callable):
+        """受信ハンドラーの登録（疑似受信データもハンドラーに渡す）"""
+        self._handlers[identifier] = handler
     
     def _load_debug_config(self) -> Dict[str, bool]:
         """デバッグ設定を読み込む"""
-        try:
-            config_path = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
-            if os.path.exists(config_path):
-                with open(config_path, 'r', encoding='utf-8') as f:
-                    config = yaml.safe_load(f)
-                    return config.get('tcp', {}).get('debug_options', {
-                        'show_timestamp': True, 'show_colors': True
-                    })
-        except Exception as e:
-            print(f"\033[91m[設定エラー] {e}\033[0m")
-        
-        return {'show_timestamp': True, 'show_colors': True}
+        return load_config('tcp').get('debug_options', {'show_timestamp': True, 'show_colors': True})
     
     async def connect(self):
         """疑似TCP接続"""
@@ -136,9 +1567,9 @@ class DebugTcp:
     
     def callback(self, handle_client: callable):
         """疑似クライアント接続コールバック"""
-        async def client_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def client_handler(protocol: FrameProtocol):
             self._print_debug("疑似クライアント接続", "")
-            await handle_client(('127.0.0.1', 0))
+            await handle_client(self)
         return client_handler
     
     async def close(self):
@@ -146,86 +1577,85 @@ class DebugTcp:
         if self.connected:
             self.connected = False
             self._print_debug("TCP接続を疑似切断", "")
-        self.writer = None
-        self.reader = None
+        self.transport = None
+        self.protocol = None
     
     async def send(self, identifier: int, data: bytes):
         """データ送信のデバッグ出力"""
         if not self.connected:
             raise ConnectionError("TCP接続が確立されていません。")
         
-        try:
-            data_type = self.data_types.get(identifier, f"不明(0x{identifier:02X})")
-            info = f"識別子: 0x{identifier:02X} ({data_type}), サイズ: {len(data)}バイト"
-            
-            # 簡単なデータプレビュー
-            if len(data) > 0:
-                preview = ' '.join(f'{b:02X}' for b in data[:min(12, len(data))])
-                if len(data) > 12:
-                    preview += f" ... (残り{len(data) - 12}バイト)"
-                info += f", データ: {preview}"
-            
-            self._print_debug("TCP送信", info)
-            
-        except Exception as e:
-            self._print_error(f"デバッグ出力エラー: {e}")
+        if not self._log.isEnabledFor(logging.INFO):
+            return
+        # 表示する文字列は件数制限で通したときだけ作る
+        self._log.info("[DEBUG] %s: %s", "TCP送信", _SendPreview(identifier, data, self.data_types),
+                       extra=self._extra)
+
+    async def send_many(self, frames):
+        """複数データ送信のデバッグ出力"""
+        for identifier, data in frames:
+            await self.send(identifier, data)
+
+    def send_nowait(self, identifier: int, data: bytes) -> asyncio.Future:
+        """待たないデータ送信のデバッグ出力"""
+        return asyncio.ensure_future(self.send(identifier, data))
+
+    def write_buffer_size(self, identifier: int = None) -> int:
+        """疑似接続なので常に0"""
+        return 0
 
     async def receive(self):
         """疑似データ受信"""
         if not self.connected:
             raise ConnectionError("TCP接続が確立されていません。")
         
-        self._print_debug("データ受信待機中", "")
-        await asyncio.sleep(5)
-        return 0x03, 3, b'\x00\x00\xbf'  # 疑似データを返す
+        while True:
+            self._print_debug("データ受信待機中", "")
+            await asyncio.sleep(5)
+            identifier, data = 0x03, b'\x00\x00\xbf'  # 疑似データ
+            handler = self._handlers[identifier]
+            if handler is None:
+                return identifier, len(data), data
+            handler(identifier, memoryview(data))
+
+    def frames(self):
+        """疑似データを async for で受信する"""
+        async def generator():
+            while True:
+                yield await self.receive()
+        return generator()
     
     def _print_debug(self, action: str, info: str):
         """デバッグメッセージを出力"""
-        try:
-            timestamp = ""
-            if self.config.get('show_timestamp', True):
-                timestamp = datetime.now().strftime("%H:%M:%S.%f")[:-3] + " "
-            
-            color = "\033[96m" if self.config.get('show_colors', True) else ""
-            reset = "\033[0m" if self.config.get('show_colors', True) else ""
-            
-            message = f"{color}[DEBUG] {timestamp}{action}"
-            if info:
-                message += f": {info}"
-            message += reset
-            
-            print(message)
-        except Exception:
-            print(f"[DEBUG] {action}: {info}")
+        if info:
+            self._log.info("[DEBUG] %s: %s", action, info, extra=self._extra)
+        else:
+            self._log.info("[DEBUG] %s", action, extra=self._extra)
     
     def _print_error(self, message: str):
         """エラーメッセージを出力"""
-        try:
-            color = "\033[91m" if self.config.get('show_colors', True) else ""
-            reset = "\033[0m" if self.config.get('show_colors', True) else ""
-            print(f"{color}[エラー] {message}{reset}")
-        except Exception:
-            print(f"[エラー] {message}")
+        self._log.error("[エラー] %s", message)
 
 
-def create_tcp(host: str, port: int) -> Union[Tcp, DebugTcp]:
-    """設定に基づいてTcpインスタンスを作成する"""
+def create_tcp(host: str, port: int, server: bool = False) -> Union[Tcp, UdpTcp, DebugTcp]:
+    """設定に基づいてTcpインスタンスを作成する
+    :param server: サーバー側（Rasp.py）で使うか。DebugTcpはサーバーとして使えないため、
+                   debug_modeに関係なくTcpかUdpTcpを作る
+    """
     try:
-        config_path = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
-        debug_mode = False  # デフォルト
-        
-        if os.path.exists(config_path):
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config = yaml.safe_load(f)
-                debug_mode_value = config.get('tcp', {}).get('debug_mode', 'off')
-                # 'on', True, 1 などをTrueとして扱う
-                debug_mode = debug_mode_value in ['on', True, 1, 'true', 'True']
+        config = load_config('tcp')
+        debug_mode_value = config.get('debug_mode', 'off')
+        # 'on', True, 1 などをTrueとして扱う
+        debug_mode = debug_mode_value in ['on', True, 1, 'true', 'True']
+        control_transport = config.get('control_transport', 'tcp')
         
-        if debug_mode:
+        if debug_mode and not server:
             return DebugTcp(host, port)
+        elif control_transport == 'udp':
+            return UdpTcp(host, port)
         else:
             return Tcp(host, port)
             
     except Exception as e:
-        print(f"\033[91m[設定エラー] {e} - 本番モードで動作します\033[0m")
+        get_logger('tcp').error("[設定エラー] %s - 本番モードで動作します", e)
         return Tcp(host, port)
\ No newline at end of file
@@ -0,0 +1,221 @@
+import asyncio
+import struct
+import time
+from collections import deque
+from typing import Dict, Any
+
+from tools.stats import percentile
+
+# ESPからの通知を集計したフレームの識別子
+# 形式: [件数 1byte] + 件数 × ([識別子 1byte][サンプル数 uint16][最新][最小][最大][平均])
+# （最新〜平均はそれぞれメッセージのDataManagerと同じ形式。長さは識別子から決まる）
+TELEMETRY_IDENTIFIER = 0xFB
+_ENTRY_HEADER = struct.Struct('<BH')
+# リングバッファの1件: 受信時刻（time.monotonic）, device番号, 識別子, データのバイト数（後ろにデータが続く）
+_SLOT_HEADER = struct.Struct('<dBBH')
+
+
+class TelemetryWindow:
+    """1つのメッセージの集計間隔ごとの最新・最小・最大・平均"""
+    __slots__ = ('route', 'format', 'count', 'latest', 'min', 'max', 'sum', 'received_at')
+
+    def __init__(self, route):
+        """コンストラクタ
+        :param route: Protocol.telemetry_route()のRoute
+        """
+        self.route = route
+        message = route.message
+        self.format = struct.Struct('<' + message.data_type.value * message.length)
+        self.count = 0
+        self.latest = None
+        self.min = None
+        self.max = None
+        self.sum = None
+        self.received_at = None  # 最新の値を受信した時刻
+
+    def add(self, values: list, received_at: float):
+        """1つのサンプルを集計に加える"""
+        if self.count == 0:
+            self.min = list(values)
+            self.max = list(values)
+            self.sum = list(values)
+        else:
+            low, high, total = self.min, self.max, self.sum
+            for i, value in enumerate(values):
+                if value < low[i]:
+                    low[i] = value
+                elif value > high[i]:
+                    high[i] = value
+                total[i] += value
+        self.latest = list(values)
+        self.received_at = received_at
+        self.count += 1
+
+    def mean(self) -> list:
+        """平均（整数の型なので四捨五入する）"""
+        return [round(total / self.count) for total in self.sum]
+
+    def pack(self) -> bytes:
+        """フレームの1件分にする"""
+        pack = self.format.pack
+        return (_ENTRY_HEADER.pack(self.route.message.identifier, min(self.count, 0xFFFF)) +
+                pack(*self.latest) + pack(*self.min) + pack(*self.max) + pack(*self.mean()))
+
+    def reset(self):
+        self.count = 0
+
+
+class Telemetry:
+    """ESPからの通知をリングバッファに溜め、一定間隔で集計してPCに送る
+    通知のコールバックでは受信時刻とバイト列をリングバッファにコピーするだけで、タスクは作らない。
+    送信タスクがinterval秒ごとにProtocolのDataManagerでデコードし、メッセージごとの
+    最新・最小・最大・平均を1つのフレーム（TELEMETRY_IDENTIFIER）にまとめて送る。
+    リングバッファが溢れた場合は古い通知から上書きする。
+    """
+
+    def __init__(self, protocol, send: callable, interval: float = 0.5, capacity: int = 1024, window: int = 256):
+        """コンストラクタ
+        :param protocol: 受信先を作ったProtocol（build()のあと）
+        :param send: 集計したフレームを送る関数（async send(識別子, データ)）
+        :param interval: 集計してPCに送る間隔（秒）
+        :param capacity: リングバッファに溜める通知の数
+        :param window: パーセンタイルの計算に使う直近の通知の数
+        """
+        self._protocol = protocol
+        self._send = send
+        self.interval = interval
+        self.capacity = capacity
+        routes = protocol.telemetry_routes()
+        self._windows = {id(route): TelemetryWindow(route) for route in routes}
+        self._max_size = max([route.size for route in routes], default=0)
+        self._stride = _SLOT_HEADER.size + self._max_size
+        self._ring = bytearray(capacity * self._stride)
+        self._view = memoryview(self._ring)
+        self._next = 0    # 次に書き込む位置
+        self._count = 0   # 溜まっている通知の数
+        self._latencies = deque(maxlen=window)  # 受信してからデコードするまで（秒）
+        self.received = 0     # 受け取った通知の数
+        self.overwritten = 0  # デコードする前に上書きした通知の数
+        self.invalid = 0      # スキーマにない・長さが合わない通知の数
+        self.max_depth = 0    # 溜まった通知の数の最大値
+        self.frames = 0       # PCに送ったフレームの数
+        self.bytes_sent = 0   # PCに送ったバイト数
+        self.send_errors = 0  # 送れなかったフレームの数
+
+    def __repr__(self):
+        return f"Telemetry {self.stats()}"
+
+    def receive(self, device_num: int, identifier: int, data):
+        """通知を受け取る（Bleの通知のコールバック）
+        :param data: 識別子を除いたデータ（bytes・bytearray・memoryview）
+        """
+        self.received += 1
+        size = len(data)
+        if size > self._max_size:
+            self.invalid += 1
+            return
+        offset = self._next * self._stride
+        _SLOT_HEADER.pack_into(self._ring, offset, time.monotonic(), device_num, identifier, size)
+        start = offset + _SLOT_HEADER.size
+        self._ring[start:start + size] = data
+        self._next = (self._next + 1) % self.capacity
+        if self._count == self.capacity:
+            self.overwritten += 1
+        else:
+            self._count += 1
+            if self._count > self.max_depth:
+                self.max_depth = self._count
+
+    def drain(self, now: float = None) -> int:
+        """溜まった通知をデコードして集計する
+        :return: 集計した通知の数
+        """
+        if now is None:
+            now = time.monotonic()
+        count = self._count
+        index = (self._next - count) % self.capacity
+        decoded = 0
+        for _ in range(count):
+            offset = index * self._stride
+            received_at, device_num, identifier, size = _SLOT_HEADER.unpack_from(self._ring, offset)
+            index = (index + 1) % self.capacity
+            route = self._protocol.telemetry_route(device_num, identifier)
+            if route is None or route.size != size:
+                self.invalid += 1
+                continue
+            start = offset + _SLOT_HEADER.size
+            route.manager.unpack_from(self._view[start:start + size])
+            self._windows[id(route)].add(route.manager.get(), received_at)
+            self._latencies.append(now - received_at)
+            decoded += 1
+        self._count = 0
+        return decoded
+
+    def flush(self) -> bytes:
+        """集計をフレームにして次の集計を始める
+        :return: フレーム（集計した通知がなければNone）
+        """
+        windows = [window for window in self._windows.values() if window.count]
+        if not windows:
+            return None
+        frame = bytes([len(windows)]) + b''.join(window.pack() for window in windows)
+        for window in windows:
+            window.reset()
+        return frame
+
+    async def run(self):
+        """interval秒ごとに集計してPCに送るループ（タスクとして起動する）"""
+        while True:
+            await asyncio.sleep(self.interval)
+            self.drain()
+            frame = self.flush()
+            if frame is None:
+                continue
+            try:
+                await self._send(TELEMETRY_IDENTIFIER, frame)
+            except Exception:  # PCが接続していない（ConnectionError）など。次の集計を送る
+                self.send_errors += 1
+                continue
+            self.frames += 1
+            self.bytes_sent += len(frame)
+
+    @staticmethod
+    def unpack(protocol, data) -> Dict[str, Dict[str, Any]]:
+        """集計したフレームを読む（PC側）。最新の値はメッセージのDataManagerにも入れる
+        :param protocol: 受信先を作ったProtocol（build()のあと）
+        :param data: TELEMETRY_IDENTIFIERで受信したバイト列（memoryviewでもよい）
+        :return: メッセージ名 -> {'samples', 'latest', 'min', 'max', 'mean'}
+        :raises ValueError: スキーマにない識別子、または長さが合わない場合
+        """
+        if len(data) < 1:
+            raise ValueError("テレメトリのフレームが空です。")
+        result = {}
+        offset = 1
+        for _ in range(data[0]):
+            if len(data) < offset + _ENTRY_HEADER.size:
+                raise ValueError("テレメトリのフレームが途中で切れています。")
+            identifier, samples = _ENTRY_HEADER.unpack_from(data, offset)
+            offset += _ENTRY_HEADER.size
+            route = protocol.route(identifier)
+            if route is None:
+                raise ValueError(f"識別子 0x{identifier:02X} はスキーマにありません。")
+            size = route.size
+            if len(data) < offset + size * 4:
+                raise ValueError("テレメトリのフレームが途中で切れています。")
+            message = route.message
+            fmt = struct.Struct('<' + message.data_type.value * message.length)
+            latest, low, high, mean = (list(fmt.unpack_from(data, offset + size * i)) for i in range(4))
+            route.manager.unpack_from(data, offset)
+            offset += size * 4
+            result[message.name] = {'samples': samples, 'latest': latest, 'min': low, 'max': high, 'mean': mean}
+        if offset != len(data):
+            raise ValueError(f"テレメトリのフレームの長さが不正です。期待される長さ: {offset}, 実際の長さ: {len(data)}")
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """受け取った・上書きした・捨てた通知の数、送ったフレーム数と、受信からデコードまでの時間（秒）"""
+        return {'received': self.received, 'overwritten': self.overwritten, 'invalid': self.invalid,
+                'depth': self._count, 'max_depth': self.max_depth,
+                'frames': self.frames, 'bytes': self.bytes_sent, 'send_errors': self.send_errors,
+                'latency_p50': percentile(self._latencies, 0.5),
+                'latency_p99': percentile(self._latencies, 0.99)}
@@ -54,6 +54,7 @@ void detachServos();
 void detachBLDCMotors();
 void detachAll();
 void onBLEDisconnected();
+void applyData(const uint8_t identifier);
 
 
 // サーボのセットアップ関数
@@ -139,6 +140,14 @@ void receiveCallback(const uint8_t identifier, const std::vector<uint8_t>& data)
     Serial.print(byte);
     Serial.print(" ");
   }
+  if (identifier == BATCH_IDENTIFIER) {
+    // サーボとBLDCが1回の書き込みでまとめて送られてくる
+    Serial.println();
+    for (const uint8_t batch_identifier : DataManagerBase::unpackBatch(data)) {
+      applyData(batch_identifier);
+    }
+    return;
+  }
   DataManagerBase::unpackAny(identifier, data);
   Serial.print("受信したデータ (ID: ");
   Serial.print(identifier);
@@ -148,7 +157,11 @@ void receiveCallback(const uint8_t identifier, const std::vector<uint8_t>& data)
     Serial.print(" ");
   }
   Serial.println();
-  
+  applyData(identifier);
+}
+
+// 受信して更新されたデータをサーボ・BLDCモーターに反映する
+void applyData(const uint8_t identifier) {
   if (identifier == 0xFF) {
     // Config message received
     const auto& config_values = config_data.get();